@@ -0,0 +1,145 @@
+# database/async_db.py
+"""
+نظير غير متزامن (asyncio) لـ database/db.py.
+
+- حلقة أحداث واحدة تعمل في خيط خلفي (daemon) يتشاركها كل من يحتاج async.
+- عميل Supabase غير متزامن يُنشأ عند أول استخدام فوق httpx.AsyncClient
+  بنفس سياسة النقل (مهلات/إعادة محاولة/قاطع دائرة مشترك) من database/transport.
+- aget_table(...) و a*_rpc(...) تُستدعى بـ await داخل الحلقة.
+- run(coro) جسر للكود المتزامن (خيوط telebot والعمال): ينفّذ coroutine على
+  الحلقة وينتظر نتيجتها؛ و spawn(coro) يطلقها دون انتظار.
+
+مثال (من كود متزامن):
+    from database.async_db import run, aget_table
+    async def _q():
+        t = await aget_table("transactions")
+        return await t.select("id").eq("user_id", uid).execute()
+    res = run(_q(), timeout=10)
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Dict, Optional
+
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+
+from database.db import SUPABASE_URL, SUPABASE_KEY, DEFAULT_TABLE
+from database.transport import build_async_http_client
+
+# ---------- حلقة الأحداث الخلفية ----------
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _loop_main(loop: asyncio.AbstractEventLoop, ready: threading.Event) -> None:
+    asyncio.set_event_loop(loop)
+    loop.call_soon(ready.set)
+    loop.run_forever()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """حلقة الأحداث المشتركة (تُشغَّل في خيط خلفي عند أول طلب)."""
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            threading.Thread(target=_loop_main, args=(loop, ready), name="db-async-loop", daemon=True).start()
+            ready.wait()
+            _loop = loop
+    return _loop
+
+
+def spawn(coro: Awaitable[Any]) -> Future:
+    """يطلق coroutine على الحلقة المشتركة ويرجع concurrent.futures.Future (بدون انتظار)."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """ينفّذ coroutine على الحلقة المشتركة وينتظر النتيجة (للاستدعاء من خيوط متزامنة فقط)."""
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run() لا يُستدعى من داخل حلقة async_db نفسها؛ استخدم await")
+    fut = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return fut.result(timeout)
+    except Exception:
+        fut.cancel()
+        raise
+
+
+# ---------- العميل غير المتزامن ----------
+_aclient: Optional[AsyncClient] = None
+_aclient_lock: Optional[asyncio.Lock] = None
+
+
+async def aclient() -> AsyncClient:
+    """أرجِع عميل Supabase غير المتزامن الموحّد (يُنشأ مرة واحدة داخل الحلقة)."""
+    global _aclient, _aclient_lock
+    if _aclient is not None:
+        return _aclient
+    if _aclient_lock is None:
+        _aclient_lock = asyncio.Lock()
+    async with _aclient_lock:
+        if _aclient is None:
+            _aclient = await acreate_client(
+                SUPABASE_URL,
+                SUPABASE_KEY,
+                options=AsyncClientOptions(httpx_client=build_async_http_client()),
+            )
+    return _aclient
+
+
+async def aget_table(table_name: Optional[str] = None):
+    """
+    النظير غير المتزامن لـ get_table: يرجع request builder يُنفَّذ بـ await ... .execute().
+    """
+    name = (table_name or DEFAULT_TABLE)
+    if not name:
+        raise RuntimeError("No table name provided and SUPABASE_TABLE_NAME is not set.")
+    return (await aclient()).table(name)
+
+
+async def arpc(fn: str, params: Optional[Dict[str, Any]] = None):
+    """استدعاء دالة Postgres (RPC) بشكل غير متزامن."""
+    return await (await aclient()).rpc(fn, params or {}).execute()
+
+
+# ---------- RPC المحفظة (نظائر db.*_rpc) ----------
+async def acreate_hold_rpc(user_id: int, amount: int, order_id: Optional[str] = None, ttl_seconds: Optional[int] = 900):
+    """ينشئ حجزًا (hold)؛ .data تحوي UUID للحجز عند النجاح."""
+    params: Dict[str, Any] = {
+        "p_user_id": user_id,
+        "p_amount": amount,
+        "p_order_id": order_id,
+        "p_ttl_seconds": ttl_seconds,
+    }
+    return await arpc("create_hold", params)
+
+
+async def acapture_hold_rpc(hold_id: str):
+    """يصفّي الحجز؛ .data تكون True/False."""
+    return await arpc("capture_hold", {"p_hold_id": hold_id})
+
+
+async def arelease_hold_rpc(hold_id: str):
+    """يلغي الحجز؛ .data تكون True/False."""
+    return await arpc("release_hold", {"p_hold_id": hold_id})
+
+
+async def atransfer_amount_rpc(from_user: int, to_user: int, amount: int):
+    """تحويل رصيد آمن يحترم المتاح فقط؛ .data تكون True/False."""
+    return await arpc("transfer_amount", {"p_from_user": from_user, "p_to_user": to_user, "p_amount": amount})
+
+
+async def atry_deduct_rpc(user_id: int, amount: int):
+    """خصم مباشر آمن يحترم المتاح فقط؛ .data تكون True/False."""
+    return await arpc("try_deduct", {"p_user_id": user_id, "p_amount": amount})
@@ -2,7 +2,8 @@
 import os
 from typing import Optional, Any, Dict
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+from database.transport import build_http_client
 
 # حمّل متغيرات البيئة من .env عند التشغيل المحلي
 load_dotenv()
@@ -25,8 +26,13 @@ if not SUPABASE_KEY:
 if not SUPABASE_URL.startswith("http"):
     raise RuntimeError("SUPABASE_URL must start with http/https")
 
-# عميل موحّد (Singleton)
-_supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# عميل موحّد (Singleton) فوق طبقة نقل مشتركة (pool + مهلات + إعادة محاولة + قاطع دائرة)
+# ملاحظة: البوت يستخدم PostgREST فقط عبر هذا العميل (لا storage/functions).
+_supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(httpx_client=build_http_client()),
+)
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Missing SUPABASE_URL or SUPABASE_KEY")
 
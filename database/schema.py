@@ -0,0 +1,96 @@
+# database/schema.py
+"""
+كتالوج مخطط قاعدة البيانات (الجداول وأعمدتها) في الذاكرة.
+
+يُحمَّل مرة من وصف OpenAPI الذي يقدمه PostgREST على /rest/v1/ (نفس عميل Supabase
+ونفس طبقة النقل)، ويُحدَّث كل SUPABASE_SCHEMA_TTL ثانية. بدل إرسال استعلام
+select(col).limit(0) لكل عمود نخمّنه:
+    from database import schema
+    schema.column_exists("purchases", "created_at")            # True/False/None
+    schema.resolve_column("holds", ["expire_at", "created_at"]) # أول عمود موجود
+
+None = الكتالوج غير متاح (OpenAPI معطّل/خطأ شبكة) → على المنادي الرجوع لطريقته القديمة.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from database.db import client
+
+SCHEMA_TTL = float(os.getenv("SUPABASE_SCHEMA_TTL", "600") or 600)
+_RETRY_AFTER = 60.0  # بعد فشل التحميل لا نعيد المحاولة قبل دقيقة
+
+_lock = threading.Lock()
+_tables: Optional[Dict[str, FrozenSet[str]]] = None
+_loaded_at = 0.0
+_failed_at = 0.0
+
+
+def _fetch() -> Dict[str, FrozenSet[str]]:
+    resp = client().postgrest.session.get("", headers={"Accept": "application/openapi+json"})
+    resp.raise_for_status()
+    spec = resp.json() or {}
+    defs = spec.get("definitions") or {}
+    if not defs:
+        raise ValueError("OpenAPI spec has no definitions")
+    return {name: frozenset((d.get("properties") or {}).keys()) for name, d in defs.items()}
+
+
+def catalogue(force: bool = False) -> Optional[Dict[str, FrozenSet[str]]]:
+    """{table: frozenset(columns)} أو None لو لم يُحمَّل أبدًا. عند فشل التحديث تبقى النسخة السابقة."""
+    global _tables, _loaded_at, _failed_at
+    now = time.monotonic()
+    if not force and _tables is not None and now - _loaded_at < SCHEMA_TTL:
+        return _tables
+    if not force and now - _failed_at < _RETRY_AFTER:
+        return _tables
+    with _lock:
+        if not force and _tables is not None and time.monotonic() - _loaded_at < SCHEMA_TTL:
+            return _tables
+        try:
+            _tables = _fetch()
+            _loaded_at = time.monotonic()
+        except Exception as e:
+            _failed_at = time.monotonic()
+            logging.warning("[schema] OpenAPI catalogue load failed: %s", e)
+    return _tables
+
+
+def invalidate() -> None:
+    """يجبر التحميل من جديد في أول استخدام (بعد ترحيل مثلًا)."""
+    global _loaded_at, _failed_at
+    _loaded_at = 0.0
+    _failed_at = 0.0
+
+
+def columns(table: str) -> Optional[FrozenSet[str]]:
+    """أعمدة الجدول؛ frozenset() لو الجدول غير موجود، None لو الكتالوج غير متاح."""
+    cat = catalogue()
+    if cat is None:
+        return None
+    return cat.get(table, frozenset())
+
+
+def has_table(table: str) -> Optional[bool]:
+    cat = catalogue()
+    return None if cat is None else table in cat
+
+
+def column_exists(table: str, col: str) -> Optional[bool]:
+    cols = columns(table)
+    return None if cols is None else col in cols
+
+
+def resolve_column(table: str, candidates: Iterable[str]) -> Optional[str]:
+    """أول عمود موجود من candidates (بالترتيب)، أو None."""
+    cols = columns(table)
+    if not cols:
+        return None
+    for c in candidates:
+        if c in cols:
+            return c
+    return None
@@ -0,0 +1,72 @@
+-- 0006_user_state_version.sql
+-- تحكم تفاؤلي بالتزامن لجدول user_state:
+--   * عمود version يزيد مع كل كتابة.
+--   * user_state_commit(p_rows) يطبّق دفعة كتابات في طلب واحد، وكل صف يُكتب فقط
+--     إذا كان version في القاعدة يساوي expected_version الذي قرأه التطبيق.
+--     الصف المتعارض لا يُكتب ويُرجَع conflict = true ليعيد التطبيق التحميل والدمج.
+alter table public.user_state add column if not exists version bigint not null default 0;
+
+create or replace function public.user_state_commit(p_rows jsonb)
+returns table(user_id bigint, state_key text, version bigint, conflict boolean)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+  r record;
+  v bigint;
+begin
+  for r in
+    select *
+    from jsonb_to_recordset(p_rows)
+      as x(user_id bigint, state_key text, vars jsonb, expires_at timestamptz, expected_version bigint)
+  loop
+    v := null;
+    user_id := r.user_id;
+    state_key := r.state_key;
+
+    if r.vars is null or r.vars = '{}'::jsonb then
+      -- حذف الصف: فقط إن لم يتغير منذ قرأناه
+      if r.expected_version is null then
+        conflict := exists (
+          select 1 from public.user_state s
+          where s.user_id = r.user_id and s.state_key = r.state_key
+        );
+      else
+        delete from public.user_state s
+        where s.user_id = r.user_id
+          and s.state_key = r.state_key
+          and s.version = r.expected_version;
+        conflict := not found and exists (
+          select 1 from public.user_state s
+          where s.user_id = r.user_id and s.state_key = r.state_key
+        );
+      end if;
+      version := null;
+      return next;
+      continue;
+    end if;
+
+    if r.expected_version is null then
+      -- صف جديد: يفشل إن أنشأه كاتب آخر في الأثناء
+      insert into public.user_state as s (user_id, state_key, vars, expires_at, version, updated_at)
+      values (r.user_id, r.state_key, r.vars, r.expires_at, 1, now())
+      on conflict (user_id, state_key) do nothing
+      returning s.version into v;
+    else
+      update public.user_state s
+         set vars = r.vars,
+             expires_at = coalesce(r.expires_at, s.expires_at),
+             version = s.version + 1,
+             updated_at = now()
+       where s.user_id = r.user_id
+         and s.state_key = r.state_key
+         and s.version = r.expected_version
+      returning s.version into v;
+    end if;
+
+    version := v;
+    conflict := v is null;
+    return next;
+  end loop;
+end;
+$$;
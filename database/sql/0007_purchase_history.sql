@@ -0,0 +1,26 @@
+-- 0007_purchase_history.sql
+-- نموذج قراءة موحّد لسجل المشتريات (بدل الاستعلام من تسعة جداول في كل عرض):
+--   * يُكتب بالتوازي من دوال add_*_purchase في services/wallet_service.py.
+--   * source/source_id يشيران للصف الأصلي (للـ backfill بدون تكرار).
+--   * الصفحات تُقرأ بـ keyset على (user_id, created_at desc, id desc).
+create table if not exists public.purchase_history (
+  id bigserial primary key,
+  user_id bigint not null,
+  source text not null,
+  source_id text,
+  title text not null,
+  price integer not null default 0,
+  identifier text,
+  created_at timestamptz not null default now()
+);
+
+create index if not exists purchase_history_user_created_idx
+  on public.purchase_history(user_id, created_at desc, id desc);
+create index if not exists purchase_history_created_at_idx
+  on public.purchase_history(created_at);
+create unique index if not exists purchase_history_source_uidx
+  on public.purchase_history(source, source_id);
+
+alter table public.purchase_history enable row level security;
+create policy if not exists "service all purchase_history" on public.purchase_history
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
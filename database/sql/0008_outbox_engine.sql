@@ -0,0 +1,80 @@
+-- 0008_outbox_engine.sql
+-- محرّك تسليم notifications_outbox:
+--   * outbox_claim: حجز دفعة صفوف مستحقة بـ FOR UPDATE SKIP LOCKED + مهلة حجز
+--     (claimed_until) حتى تعمل عدة نسخ من العامل بالتوازي دون تكرار الإرسال.
+--   * outbox_complete: تسجيل نتائج الدفعة كلها بجملة واحدة:
+--     نجاح → sent_at، فشل → tries+1 و next_attempt_at بتراجع أُسّي (أو retry_after)،
+--     وبعد p_max_tries (أو خطأ دائم) → dead_at (رسائل ميتة لا تُعاد).
+alter table public.notifications_outbox add column if not exists tries integer not null default 0;
+alter table public.notifications_outbox add column if not exists next_attempt_at timestamptz;
+alter table public.notifications_outbox add column if not exists claimed_by text;
+alter table public.notifications_outbox add column if not exists claimed_until timestamptz;
+alter table public.notifications_outbox add column if not exists dead_at timestamptz;
+alter table public.notifications_outbox add column if not exists last_error text;
+
+create index if not exists idx_outbox_due
+  on public.notifications_outbox (coalesce(next_attempt_at, scheduled_at))
+  where sent_at is null and dead_at is null;
+
+create or replace function public.outbox_claim(p_worker text, p_limit integer default 100, p_lease_seconds integer default 120)
+returns setof public.notifications_outbox
+language sql
+as $$
+  with c as (
+    select o.id
+    from public.notifications_outbox o
+    where o.sent_at is null
+      and o.dead_at is null
+      and o.scheduled_at <= now()
+      and coalesce(o.next_attempt_at, o.scheduled_at) <= now()
+      and (o.claimed_until is null or o.claimed_until < now())
+    order by coalesce(o.next_attempt_at, o.scheduled_at)
+    limit p_limit
+    for update skip locked
+  )
+  update public.notifications_outbox o
+     set claimed_by = p_worker,
+         claimed_until = now() + make_interval(secs => p_lease_seconds)
+    from c
+   where o.id = c.id
+  returning o.*;
+$$;
+
+create or replace function public.outbox_complete(
+  p_results jsonb,
+  p_max_tries integer default 6,
+  p_backoff_base double precision default 30,
+  p_backoff_cap double precision default 3600
+)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  update public.notifications_outbox o
+     set sent_at = case when r.ok then now() else o.sent_at end,
+         -- retry_after (429/لم يُحاوَل بسبب التوقف) لا يُحسب محاولة فاشلة
+         tries = case when r.ok or r.retry_after is not null then o.tries else coalesce(o.tries, 0) + 1 end,
+         next_attempt_at = case
+           when r.ok then null
+           else now() + make_interval(secs => coalesce(
+             r.retry_after,
+             least(p_backoff_cap, p_backoff_base * power(2, coalesce(o.tries, 0)))
+           ))
+         end,
+         dead_at = case
+           when not r.ok and (coalesce(r.permanent, false)
+                              or (r.retry_after is null and coalesce(o.tries, 0) + 1 >= p_max_tries)) then now()
+           else null
+         end,
+         last_error = case when r.ok then null else left(r.error, 500) end,
+         claimed_by = null,
+         claimed_until = null
+    from jsonb_to_recordset(p_results)
+      as r(id text, ok boolean, error text, retry_after double precision, permanent boolean)
+   where o.id::text = r.id;
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
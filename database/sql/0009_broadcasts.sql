@@ -0,0 +1,54 @@
+-- 0009_broadcasts.sql
+-- حملات البث الجماعي (بديل الحلقات داخل هاندلر الأدمن):
+--   * broadcast_campaigns: الحملة + حالتها (running/paused/cancelled/done) + العدّادات.
+--   * broadcast_recipients: مستلم لكل صف مع نتيجته (pending/sent/blocked/deactivated/failed)
+--     — هو مؤشر الاستئناف بعد إعادة التشغيل.
+--   * bot_blocked_users: من حظر البوت يُستثنى تلقائيًا من الحملات القادمة.
+create table if not exists public.broadcast_campaigns (
+  id bigserial primary key,
+  created_by bigint,
+  kind text not null default 'message' check (kind in ('message','poll')),
+  payload jsonb not null default '{}'::jsonb,
+  status text not null default 'running' check (status in ('running','paused','cancelled','done')),
+  total integer not null default 0,
+  sent integer not null default 0,
+  blocked integer not null default 0,
+  deactivated integer not null default 0,
+  failed integer not null default 0,
+  progress_chat_id bigint,
+  progress_message_id bigint,
+  lease_owner text,
+  lease_until timestamptz,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now(),
+  finished_at timestamptz
+);
+create index if not exists broadcast_campaigns_status_idx on public.broadcast_campaigns(status);
+
+create table if not exists public.broadcast_recipients (
+  campaign_id bigint not null references public.broadcast_campaigns(id) on delete cascade,
+  user_id bigint not null,
+  name text,
+  status text not null default 'pending' check (status in ('pending','sent','blocked','deactivated','failed')),
+  error text,
+  attempted_at timestamptz,
+  primary key (campaign_id, user_id)
+);
+create index if not exists broadcast_recipients_pending_idx
+  on public.broadcast_recipients(campaign_id, user_id) where status = 'pending';
+
+create table if not exists public.bot_blocked_users (
+  user_id bigint primary key,
+  reason text,
+  blocked_at timestamptz not null default now()
+);
+
+alter table public.broadcast_campaigns enable row level security;
+alter table public.broadcast_recipients enable row level security;
+alter table public.bot_blocked_users enable row level security;
+create policy if not exists "service all broadcast_campaigns" on public.broadcast_campaigns
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
+create policy if not exists "service all broadcast_recipients" on public.broadcast_recipients
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
+create policy if not exists "service all bot_blocked_users" on public.bot_blocked_users
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
@@ -0,0 +1,73 @@
+-- 0010_queue_dispatcher.sql
+-- موزّع طابور pending_requests على الأدمن:
+--   * dispatch lease: الطلب المعروض على الأدمن محجوز حتى lease_until؛ لو لم يُحسم
+--     خلالها يعود للطابور ويُعاد عرضه (بدل payload.locked_by بلا انتهاء).
+--   * استلام الأدمن (📌 استلمت) = claimed_by + تمديد lease_until؛ انتهاء المهلة يحرر الطلب.
+--   * available_at: التأجيل يؤخر إعادة العرض دون أن يشغل خانة من التزامن.
+--   * queue_claim: يحجز حتى (p_max_inflight - المعروض حاليًا) طلبًا بـ FOR UPDATE SKIP LOCKED.
+--   * إشعار pg_notify('pending_requests') عند كل إدراج ليستيقظ الموزّع فورًا (LISTEN اختياري).
+alter table public.pending_requests add column if not exists lease_owner text;
+alter table public.pending_requests add column if not exists lease_until timestamptz;
+alter table public.pending_requests add column if not exists dispatched_at timestamptz;
+alter table public.pending_requests add column if not exists available_at timestamptz;
+alter table public.pending_requests add column if not exists claimed_by bigint;
+alter table public.pending_requests add column if not exists claimed_by_username text;
+
+create index if not exists idx_pending_requests_created_at on public.pending_requests (created_at);
+create index if not exists idx_pending_requests_lease_until
+  on public.pending_requests (lease_until)
+  where lease_until is not null;
+
+create or replace function public.queue_claim(p_worker text, p_max_inflight integer default 3, p_lease_seconds integer default 900)
+returns setof public.pending_requests
+language plpgsql
+as $$
+declare
+  v_slots integer;
+begin
+  -- نسخة واحدة تحسب الخانات الفارغة في كل لحظة (وإلا تتجاوز عدة نسخ الحد معًا)
+  perform pg_advisory_xact_lock(hashtext('pending_requests_dispatch'));
+
+  select greatest(0, p_max_inflight - count(*)) into v_slots
+    from public.pending_requests
+   where lease_until > now();
+  if v_slots = 0 then
+    return;
+  end if;
+
+  return query
+  with c as (
+    select p.id
+    from public.pending_requests p
+    where (p.lease_until is null or p.lease_until <= now())
+      and (p.available_at is null or p.available_at <= now())
+    order by p.created_at
+    limit v_slots
+    for update skip locked
+  )
+  update public.pending_requests p
+     set lease_owner = p_worker,
+         lease_until = now() + make_interval(secs => p_lease_seconds),
+         dispatched_at = now(),
+         claimed_by = null,
+         claimed_by_username = null
+    from c
+   where p.id = c.id
+  returning p.*;
+end;
+$$;
+
+create or replace function public.pending_requests_notify()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform pg_notify('pending_requests', new.id::text);
+  return new;
+end;
+$$;
+
+drop trigger if exists trg_pending_requests_notify on public.pending_requests;
+create trigger trg_pending_requests_notify
+  after insert on public.pending_requests
+  for each row execute function public.pending_requests_notify();
@@ -0,0 +1,48 @@
+-- 0011_pending_payload_patch.sql
+-- تعديل payload في pending_requests على الخادم بطلب واحد:
+--   * jsonb_merge_patch: دمج RFC 7396 (المفتاح بقيمة null يُحذف، الكائنات تُدمج تداخليًا،
+--     وأي قيمة أخرى — ومنها المصفوفات — تستبدل القديمة).
+--   * pending_payload_patch: يطبّق الدمج ويزيد payload_version؛ مع p_expected_version
+--     يصبح compare-and-set (لا يكتب لو تغيّر الصف منذ قراءته) ويرجع صفرًا من الصفوف.
+alter table public.pending_requests add column if not exists payload_version bigint not null default 0;
+
+create or replace function public.jsonb_merge_patch(p_target jsonb, p_patch jsonb)
+returns jsonb
+language plpgsql
+immutable
+as $$
+declare
+  v_out jsonb;
+  v_key text;
+  v_val jsonb;
+begin
+  if p_patch is null or jsonb_typeof(p_patch) <> 'object' then
+    return p_patch;
+  end if;
+  v_out := case when jsonb_typeof(p_target) = 'object' then p_target else '{}'::jsonb end;
+  for v_key, v_val in select key, value from jsonb_each(p_patch) loop
+    if jsonb_typeof(v_val) = 'null' then
+      v_out := v_out - v_key;
+    else
+      v_out := jsonb_set(v_out, array[v_key], public.jsonb_merge_patch(v_out -> v_key, v_val), true);
+    end if;
+  end loop;
+  return v_out;
+end;
+$$;
+
+create or replace function public.pending_payload_patch(
+  p_id bigint,
+  p_patch jsonb,
+  p_expected_version bigint default null
+)
+returns table (id bigint, payload jsonb, payload_version bigint)
+language sql
+as $$
+  update public.pending_requests r
+     set payload = public.jsonb_merge_patch(coalesce(r.payload, '{}'::jsonb), p_patch),
+         payload_version = r.payload_version + 1
+   where r.id = p_id
+     and (p_expected_version is null or r.payload_version = p_expected_version)
+  returning r.id::bigint, r.payload, r.payload_version;
+$$;
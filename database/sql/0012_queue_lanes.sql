@@ -0,0 +1,89 @@
+-- 0012_queue_lanes.sql
+-- مسارات أولوية لطابور pending_requests:
+--   * lane: فئة الطلب (من payload.type) و sla_due_at: موعد SLA (created_at + هدف المسار).
+--     التطبيق يضبطهما عند الإدراج (services/queue_service.QUEUE_LANES)؛ هنا تعبئة الصفوف القديمة
+--     بنفس الجدول (أي تعديل على الأهداف هناك يُنسخ هنا عند الحاجة).
+--   * queue_claim صار يقبل p_ids: قائمة مرتّبة يختارها المجدول العادل الموزون في التطبيق؛
+--     يحجز منها بالترتيب حتى يمتلئ حد التزامن. بدون p_ids: الأقرب موعدًا (EDF).
+alter table public.pending_requests add column if not exists lane text;
+alter table public.pending_requests add column if not exists sla_due_at timestamptz;
+
+update public.pending_requests p
+   set lane = l.lane,
+       sla_due_at = p.created_at + make_interval(mins => l.sla_minutes)
+  from (
+    select r.id,
+           case
+             when r.payload->>'type' in ('recharge', 'wallet_recharge', 'deposit') then 'recharge'
+             when r.payload->>'type' in ('cash_transfer', 'companies_transfer') then 'transfers'
+             when r.payload->>'type' in ('order') then 'games'
+             when r.payload->>'type' in ('syr_unit', 'syr_bill', 'syr_kazia', 'mtn_unit', 'mtn_bill',
+                                         'mtn_kazia', 'internet', 'university_fees') then 'bills'
+             when r.payload->>'type' in ('ads') then 'ads'
+             when r.payload->>'type' in ('media') then 'media'
+             when r.payload->>'type' in ('wholesale') then 'wholesale'
+             else 'other'
+           end as lane,
+           case
+             when r.payload->>'type' in ('recharge', 'wallet_recharge', 'deposit') then 5
+             when r.payload->>'type' in ('cash_transfer', 'companies_transfer', 'order') then 10
+             when r.payload->>'type' in ('syr_unit', 'syr_bill', 'syr_kazia', 'mtn_unit', 'mtn_bill',
+                                         'mtn_kazia', 'internet', 'university_fees') then 15
+             when r.payload->>'type' in ('ads', 'media') then 60
+             when r.payload->>'type' in ('wholesale') then 120
+             else 30
+           end as sla_minutes
+    from public.pending_requests r
+    where r.lane is null
+  ) l
+ where p.id = l.id;
+
+create index if not exists idx_pending_requests_sla_due_at on public.pending_requests (sla_due_at);
+
+drop function if exists public.queue_claim(text, integer, integer);
+
+create or replace function public.queue_claim(
+  p_worker text,
+  p_max_inflight integer default 3,
+  p_lease_seconds integer default 900,
+  p_ids bigint[] default null
+)
+returns setof public.pending_requests
+language plpgsql
+as $$
+declare
+  v_slots integer;
+begin
+  perform pg_advisory_xact_lock(hashtext('pending_requests_dispatch'));
+
+  select greatest(0, p_max_inflight - count(*)) into v_slots
+    from public.pending_requests
+   where lease_until > now();
+  if v_slots = 0 then
+    return;
+  end if;
+
+  return query
+  with c as (
+    select p.id
+    from public.pending_requests p
+    where (p.lease_until is null or p.lease_until <= now())
+      and (p.available_at is null or p.available_at <= now())
+      and (p_ids is null or p.id = any (p_ids))
+    order by case when p_ids is null then null else array_position(p_ids, p.id::bigint) end,
+             coalesce(p.sla_due_at, p.created_at),
+             p.created_at
+    limit v_slots
+    for update skip locked
+  )
+  update public.pending_requests p
+     set lease_owner = p_worker,
+         lease_until = now() + make_interval(secs => p_lease_seconds),
+         dispatched_at = now(),
+         claimed_by = null,
+         claimed_by_username = null
+    from c
+   where p.id = c.id
+  returning p.*;
+end;
+$$;
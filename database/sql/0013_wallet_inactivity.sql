@@ -0,0 +1,63 @@
+-- 0013_wallet_inactivity.sql
+-- حساب خمول المحافظ لكل المستخدمين بجملة واحدة (بدل طلب HTTP لكل مستخدم × كل جدول نشاط):
+--   آخر نشاط = الأحدث بين updated_at (أو created_at) في جدول العملاء وآخر سجل في
+--   transactions/purchases، ثم تصنيف كل محفظة في شريحة تحذير حسب أيام الخمول:
+--     '6d'     : خمول >= p_delete_days - 6
+--     '3d'     : خمول >= p_delete_days - 3
+--     '0d'     : خمول >= p_delete_days - 1 (اليوم الأخير)
+--     'delete' : خمول >= p_delete_days
+-- اسم جدول العملاء يُمرَّر (SUPABASE_TABLE_NAME قابل للتغيير) ويُحمى بـ format('%I').
+create index if not exists idx_transactions_user_timestamp on public.transactions (user_id, "timestamp");
+create index if not exists idx_purchases_user_created_at on public.purchases (user_id, created_at);
+
+create or replace function public.wallet_inactivity(
+  p_users_table text,
+  p_delete_days integer default 33,
+  p_min_idle_days integer default null
+)
+returns table (user_id bigint, last_activity timestamptz, idle_days integer, bucket text)
+language plpgsql
+stable
+as $$
+declare
+  v_user_ts text;
+begin
+  if exists (
+    select 1 from information_schema.columns c
+     where c.table_schema = 'public' and c.table_name = p_users_table and c.column_name = 'updated_at'
+  ) then
+    v_user_ts := 'coalesce(u.updated_at, u.created_at)';
+  else
+    v_user_ts := 'u.created_at';
+  end if;
+
+  return query execute format($q$
+    with act as (
+      select a.user_id, max(a.ts) as ts
+      from (
+        select t.user_id::bigint as user_id, t."timestamp"::timestamptz as ts from public.transactions t
+        union all
+        select p.user_id::bigint, p.created_at::timestamptz from public.purchases p
+      ) a
+      group by a.user_id
+    ), la as (
+      select u.user_id::bigint as user_id,
+             greatest(%s::timestamptz, act.ts) as last_activity
+      from public.%I u
+      left join act on act.user_id = u.user_id::bigint
+    )
+    select la.user_id,
+           la.last_activity,
+           floor(extract(epoch from now() - la.last_activity) / 86400)::integer,
+           case
+             when la.last_activity <= now() - make_interval(days => $1)     then 'delete'
+             when la.last_activity <= now() - make_interval(days => $1 - 1) then '0d'
+             when la.last_activity <= now() - make_interval(days => $1 - 3) then '3d'
+             else '6d'
+           end
+    from la
+    where la.last_activity <= now() - make_interval(days => $2)
+  $q$, v_user_ts, p_users_table)
+  using p_delete_days, coalesce(p_min_idle_days, p_delete_days - 6);
+end;
+$$;
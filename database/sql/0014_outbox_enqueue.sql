@@ -0,0 +1,40 @@
+-- 0014_outbox_enqueue.sql
+-- إدراج جماعي في notifications_outbox مع منع التكرار على الخادم:
+--   * فهرس فريد جزئي: رسالة واحدة معلّقة لكل (user_id, kind) — المرسلة/الميتة لا تمنع الجديدة.
+--   * outbox_enqueue: يدرج مصفوفة JSON كاملة بجملة واحدة ON CONFLICT DO NOTHING
+--     (PostgREST لا يستطيع استهداف فهرس جزئي في on_conflict، لذلك دالة).
+
+-- تنظيف التكرارات المعلّقة الحالية (نُبقي الأقدم) قبل إنشاء الفهرس
+delete from public.notifications_outbox o
+ using public.notifications_outbox k
+ where o.sent_at is null and o.dead_at is null
+   and k.sent_at is null and k.dead_at is null
+   and o.user_id = k.user_id
+   and o.kind = k.kind
+   and o.id > k.id;
+
+create unique index if not exists ux_outbox_pending_user_kind
+  on public.notifications_outbox (user_id, kind)
+  where sent_at is null and dead_at is null;
+
+create or replace function public.outbox_enqueue(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  insert into public.notifications_outbox (user_id, kind, message, parse_mode, scheduled_at, created_at)
+  select r.user_id,
+         r.kind,
+         r.message,
+         coalesce(r.parse_mode, 'HTML'),
+         coalesce(r.scheduled_at, now()),
+         now()
+    from jsonb_to_recordset(p_rows)
+      as r(user_id bigint, kind text, message text, parse_mode text, scheduled_at timestamptz)
+  on conflict (user_id, kind) where sent_at is null and dead_at is null do nothing;
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
@@ -0,0 +1,195 @@
+-- 0015_daily_rollups.sql
+-- تجميعات يومية للتقارير (تُقرأ بصفوف قليلة مهما كبر التاريخ):
+--   daily_rollups(day, metric, dim) → value (مجموع) و count (عدد).
+--   المقاييس:
+--     deposits / spend          : من transactions (إيداع/تحويل من — شراء/خصم) كما في التقارير القديمة
+--     credits                   : كل حركة موجبة في transactions (ملخص اليوم/الأسبوع)
+--     user_in / user_out (dim=user_id) : كل حركة موجبة/سالبة لكل مستخدم (أفضل العملاء)
+--     sales                     : purchases (price)
+--     product (dim=product_name): عدد مرات الشراء لكل منتج
+--     category (dim=source)     : purchase_history حسب فئة الشراء (بدون مصدر purchases العام)
+--     discount                  : discount_uses (value = مقدار التخفيض)
+--     admin_deposit / admin_spend (dim=admin_id) : admin_ledger
+--     queue_new                 : طلبات الطابور الجديدة (زيادات من التطبيق عبر rollup_apply)
+--
+-- rollup_compact يضيف الصفوف الجديدة فقط (بعد آخر id معالَج لكل مصدر في rollup_watermarks)،
+-- فيعمل بزيادات صغيرة ويجب أن يمر قبل تنظيف الـ14 ساعة للجداول المؤقتة (التطبيق يشغّله كل دقيقتين).
+create table if not exists public.daily_rollups (
+  day date not null,
+  metric text not null,
+  dim text not null default '',
+  value bigint not null default 0,
+  count bigint not null default 0,
+  updated_at timestamptz not null default now(),
+  primary key (day, metric, dim)
+);
+create index if not exists idx_daily_rollups_metric_day on public.daily_rollups (metric, day);
+
+create table if not exists public.rollup_watermarks (
+  source text primary key,
+  last_id bigint not null default 0,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.daily_rollups enable row level security;
+alter table public.rollup_watermarks enable row level security;
+create policy if not exists "service all daily_rollups" on public.daily_rollups
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
+create policy if not exists "service all rollup_watermarks" on public.rollup_watermarks
+  for all using (auth.role() = 'service_role') with check (auth.role() = 'service_role');
+
+-- زيادات جاهزة من التطبيق: [{day, metric, dim, value, count}, ...]
+create or replace function public.rollup_apply(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  insert into public.daily_rollups as d (day, metric, dim, value, count)
+  select r.day, r.metric, coalesce(r.dim, ''), sum(coalesce(r.value, 0)), sum(coalesce(r.count, 0))
+    from jsonb_to_recordset(p_rows) as r(day date, metric text, dim text, value bigint, count bigint)
+   group by 1, 2, 3
+  on conflict (day, metric, dim) do update
+     set value = d.value + excluded.value,
+         count = d.count + excluded.count,
+         updated_at = now();
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
+
+create or replace function public.rollup_compact()
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_last bigint;
+  v_max bigint;
+  v_out jsonb := '{}'::jsonb;
+  -- صفوف أحدث من هذا لا تُعالج بعد (إدراجات قيد التنفيذ قد تأخذ id أصغر)
+  v_settle constant interval := interval '30 seconds';
+begin
+  -- نسخة واحدة فقط تضغط في نفس اللحظة
+  if not pg_try_advisory_xact_lock(hashtext('rollup_compact')) then
+    return v_out;
+  end if;
+
+  -- ===== transactions =====
+  select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'transactions';
+  select max(t.id) into v_max from public.transactions t
+   where t.id > v_last and t."timestamp"::timestamptz <= now() - v_settle;
+  if v_max is not null then
+    insert into public.daily_rollups as d (day, metric, dim, value, count)
+    select m.day, m.metric, m.dim, sum(m.v), count(*)
+      from (
+        select (t."timestamp"::timestamptz at time zone 'UTC')::date as day,
+               case
+                 when t.amount > 0 and (t.description like 'إيداع%' or t.description like 'تحويل من%') then 'deposits'
+                 when t.amount < 0 and (t.description like 'شراء%' or t.description like 'خصم%') then 'spend'
+               end as metric,
+               ''::text as dim,
+               abs(t.amount)::bigint as v
+          from public.transactions t
+         where t.id > v_last and t.id <= v_max
+        union all
+        select (t."timestamp"::timestamptz at time zone 'UTC')::date, 'credits', '', t.amount::bigint
+          from public.transactions t
+         where t.id > v_last and t.id <= v_max and t.amount > 0
+        union all
+        select (t."timestamp"::timestamptz at time zone 'UTC')::date,
+               case when t.amount > 0 then 'user_in' else 'user_out' end,
+               t.user_id::text,
+               abs(t.amount)::bigint
+          from public.transactions t
+         where t.id > v_last and t.id <= v_max and t.amount <> 0
+      ) m
+     where m.metric is not null
+     group by 1, 2, 3
+    on conflict (day, metric, dim) do update
+       set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+    insert into public.rollup_watermarks (source, last_id, updated_at) values ('transactions', v_max, now())
+    on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+    v_out := v_out || jsonb_build_object('transactions', v_max - v_last);
+  end if;
+
+  -- ===== purchases =====
+  select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'purchases';
+  select max(p.id) into v_max from public.purchases p
+   where p.id > v_last and p.created_at::timestamptz <= now() - v_settle;
+  if v_max is not null then
+    insert into public.daily_rollups as d (day, metric, dim, value, count)
+    select m.day, m.metric, m.dim, sum(m.v), count(*)
+      from (
+        select (p.created_at::timestamptz at time zone 'UTC')::date as day, 'sales'::text as metric, ''::text as dim,
+               coalesce(p.price, 0)::bigint as v
+          from public.purchases p
+         where p.id > v_last and p.id <= v_max
+        union all
+        select (p.created_at::timestamptz at time zone 'UTC')::date, 'product', coalesce(nullif(p.product_name, ''), 'غير مسمى'), 0
+          from public.purchases p
+         where p.id > v_last and p.id <= v_max
+      ) m
+     group by 1, 2, 3
+    on conflict (day, metric, dim) do update
+       set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+    insert into public.rollup_watermarks (source, last_id, updated_at) values ('purchases', v_max, now())
+    on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+    v_out := v_out || jsonb_build_object('purchases', v_max - v_last);
+  end if;
+
+  -- ===== purchase_history (حسب الفئة) =====
+  select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'purchase_history';
+  select max(h.id) into v_max from public.purchase_history h
+   where h.id > v_last and h.created_at <= now() - v_settle;
+  if v_max is not null then
+    insert into public.daily_rollups as d (day, metric, dim, value, count)
+    select (h.created_at at time zone 'UTC')::date, 'category', h.source, sum(coalesce(h.price, 0)), count(*)
+      from public.purchase_history h
+     where h.id > v_last and h.id <= v_max and h.source <> 'purchases'
+     group by 1, 2, 3
+    on conflict (day, metric, dim) do update
+       set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+    insert into public.rollup_watermarks (source, last_id, updated_at) values ('purchase_history', v_max, now())
+    on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+    v_out := v_out || jsonb_build_object('purchase_history', v_max - v_last);
+  end if;
+
+  -- ===== discount_uses =====
+  select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'discount_uses';
+  select max(u.id) into v_max from public.discount_uses u
+   where u.id > v_last and u.created_at <= now() - v_settle;
+  if v_max is not null then
+    insert into public.daily_rollups as d (day, metric, dim, value, count)
+    select (u.created_at at time zone 'UTC')::date, 'discount', '', sum(u.amount_before - u.amount_after), count(*)
+      from public.discount_uses u
+     where u.id > v_last and u.id <= v_max
+     group by 1, 2, 3
+    on conflict (day, metric, dim) do update
+       set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+    insert into public.rollup_watermarks (source, last_id, updated_at) values ('discount_uses', v_max, now())
+    on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+    v_out := v_out || jsonb_build_object('discount_uses', v_max - v_last);
+  end if;
+
+  -- ===== admin_ledger =====
+  select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'admin_ledger';
+  select max(l.id) into v_max from public.admin_ledger l
+   where l.id > v_last and l.created_at::timestamptz <= now() - v_settle;
+  if v_max is not null then
+    insert into public.daily_rollups as d (day, metric, dim, value, count)
+    select (l.created_at::timestamptz at time zone 'UTC')::date, 'admin_' || l.action, l.admin_id::text,
+           sum(coalesce(l.amount, 0)), count(*)
+      from public.admin_ledger l
+     where l.id > v_last and l.id <= v_max and l.action in ('deposit', 'spend')
+     group by 1, 2, 3
+    on conflict (day, metric, dim) do update
+       set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+    insert into public.rollup_watermarks (source, last_id, updated_at) values ('admin_ledger', v_max, now())
+    on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+    v_out := v_out || jsonb_build_object('admin_ledger', v_max - v_last);
+  end if;
+
+  return v_out;
+end;
+$$;
@@ -0,0 +1,163 @@
+-- 0016_rollup_compact_isolation.sql
+-- rollup_compact: كل مصدر في كتلة فرعية مستقلة (begin ... exception) — خطأ في جدول واحد
+-- (نوع id/timestamp مختلف، RLS، ...) يُرجع تغييرات ذلك المصدر فقط ولا يوقف البقية.
+-- أخطاء المصادر تعود في المفتاح errors: {"errors": {"<source>": "<رسالة>"}}،
+-- والتطبيق (services/rollup_service) يرجع لمسح الجداول الخام للمقاييس المتأثرة.
+create or replace function public.rollup_compact()
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_last bigint;
+  v_max bigint;
+  v_out jsonb := '{}'::jsonb;
+  v_err jsonb := '{}'::jsonb;
+  -- صفوف أحدث من هذا لا تُعالج بعد (إدراجات قيد التنفيذ قد تأخذ id أصغر)
+  v_settle constant interval := interval '30 seconds';
+begin
+  -- نسخة واحدة فقط تضغط في نفس اللحظة
+  if not pg_try_advisory_xact_lock(hashtext('rollup_compact')) then
+    return v_out;
+  end if;
+
+  -- ===== transactions =====
+  begin
+    select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'transactions';
+    select max(t.id) into v_max from public.transactions t
+     where t.id > v_last and t."timestamp"::timestamptz <= now() - v_settle;
+    if v_max is not null then
+      insert into public.daily_rollups as d (day, metric, dim, value, count)
+      select m.day, m.metric, m.dim, sum(m.v), count(*)
+        from (
+          select (t."timestamp"::timestamptz at time zone 'UTC')::date as day,
+                 case
+                   when t.amount > 0 and (t.description like 'إيداع%' or t.description like 'تحويل من%') then 'deposits'
+                   when t.amount < 0 and (t.description like 'شراء%' or t.description like 'خصم%') then 'spend'
+                 end as metric,
+                 ''::text as dim,
+                 abs(t.amount)::bigint as v
+            from public.transactions t
+           where t.id > v_last and t.id <= v_max
+          union all
+          select (t."timestamp"::timestamptz at time zone 'UTC')::date, 'credits', '', t.amount::bigint
+            from public.transactions t
+           where t.id > v_last and t.id <= v_max and t.amount > 0
+          union all
+          select (t."timestamp"::timestamptz at time zone 'UTC')::date,
+                 case when t.amount > 0 then 'user_in' else 'user_out' end,
+                 t.user_id::text,
+                 abs(t.amount)::bigint
+            from public.transactions t
+           where t.id > v_last and t.id <= v_max and t.amount <> 0
+        ) m
+       where m.metric is not null
+       group by 1, 2, 3
+      on conflict (day, metric, dim) do update
+         set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+      insert into public.rollup_watermarks (source, last_id, updated_at) values ('transactions', v_max, now())
+      on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+      v_out := v_out || jsonb_build_object('transactions', v_max - v_last);
+    end if;
+  exception when others then
+    v_err := v_err || jsonb_build_object('transactions', sqlerrm);
+  end;
+
+  -- ===== purchases =====
+  begin
+    select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'purchases';
+    select max(p.id) into v_max from public.purchases p
+     where p.id > v_last and p.created_at::timestamptz <= now() - v_settle;
+    if v_max is not null then
+      insert into public.daily_rollups as d (day, metric, dim, value, count)
+      select m.day, m.metric, m.dim, sum(m.v), count(*)
+        from (
+          select (p.created_at::timestamptz at time zone 'UTC')::date as day, 'sales'::text as metric, ''::text as dim,
+                 coalesce(p.price, 0)::bigint as v
+            from public.purchases p
+           where p.id > v_last and p.id <= v_max
+          union all
+          select (p.created_at::timestamptz at time zone 'UTC')::date, 'product', coalesce(nullif(p.product_name, ''), 'غير مسمى'), 0
+            from public.purchases p
+           where p.id > v_last and p.id <= v_max
+        ) m
+       group by 1, 2, 3
+      on conflict (day, metric, dim) do update
+         set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+      insert into public.rollup_watermarks (source, last_id, updated_at) values ('purchases', v_max, now())
+      on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+      v_out := v_out || jsonb_build_object('purchases', v_max - v_last);
+    end if;
+  exception when others then
+    v_err := v_err || jsonb_build_object('purchases', sqlerrm);
+  end;
+
+  -- ===== purchase_history (حسب الفئة) =====
+  begin
+    select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'purchase_history';
+    select max(h.id) into v_max from public.purchase_history h
+     where h.id > v_last and h.created_at <= now() - v_settle;
+    if v_max is not null then
+      insert into public.daily_rollups as d (day, metric, dim, value, count)
+      select (h.created_at at time zone 'UTC')::date, 'category', h.source, sum(coalesce(h.price, 0)), count(*)
+        from public.purchase_history h
+       where h.id > v_last and h.id <= v_max and h.source <> 'purchases'
+       group by 1, 2, 3
+      on conflict (day, metric, dim) do update
+         set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+      insert into public.rollup_watermarks (source, last_id, updated_at) values ('purchase_history', v_max, now())
+      on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+      v_out := v_out || jsonb_build_object('purchase_history', v_max - v_last);
+    end if;
+  exception when others then
+    v_err := v_err || jsonb_build_object('purchase_history', sqlerrm);
+  end;
+
+  -- ===== discount_uses =====
+  begin
+    select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'discount_uses';
+    select max(u.id) into v_max from public.discount_uses u
+     where u.id > v_last and u.created_at <= now() - v_settle;
+    if v_max is not null then
+      insert into public.daily_rollups as d (day, metric, dim, value, count)
+      select (u.created_at at time zone 'UTC')::date, 'discount', '', sum(u.amount_before - u.amount_after), count(*)
+        from public.discount_uses u
+       where u.id > v_last and u.id <= v_max
+       group by 1, 2, 3
+      on conflict (day, metric, dim) do update
+         set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+      insert into public.rollup_watermarks (source, last_id, updated_at) values ('discount_uses', v_max, now())
+      on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+      v_out := v_out || jsonb_build_object('discount_uses', v_max - v_last);
+    end if;
+  exception when others then
+    v_err := v_err || jsonb_build_object('discount_uses', sqlerrm);
+  end;
+
+  -- ===== admin_ledger =====
+  begin
+    select coalesce(max(last_id), 0) into v_last from public.rollup_watermarks where source = 'admin_ledger';
+    select max(l.id) into v_max from public.admin_ledger l
+     where l.id > v_last and l.created_at::timestamptz <= now() - v_settle;
+    if v_max is not null then
+      insert into public.daily_rollups as d (day, metric, dim, value, count)
+      select (l.created_at::timestamptz at time zone 'UTC')::date, 'admin_' || l.action, l.admin_id::text,
+             sum(coalesce(l.amount, 0)), count(*)
+        from public.admin_ledger l
+       where l.id > v_last and l.id <= v_max and l.action in ('deposit', 'spend')
+       group by 1, 2, 3
+      on conflict (day, metric, dim) do update
+         set value = d.value + excluded.value, count = d.count + excluded.count, updated_at = now();
+      insert into public.rollup_watermarks (source, last_id, updated_at) values ('admin_ledger', v_max, now())
+      on conflict (source) do update set last_id = excluded.last_id, updated_at = now();
+      v_out := v_out || jsonb_build_object('admin_ledger', v_max - v_last);
+    end if;
+  exception when others then
+    v_err := v_err || jsonb_build_object('admin_ledger', sqlerrm);
+  end;
+
+  if v_err <> '{}'::jsonb then
+    v_out := v_out || jsonb_build_object('errors', v_err);
+  end if;
+  return v_out;
+end;
+$$;
@@ -0,0 +1,46 @@
+-- 0017_outbox_complete_owner.sql
+-- outbox_complete يسجّل النتيجة فقط للصف الذي ما زال محجوزًا لنفس العامل (claimed_by = p_worker):
+-- عامل متأخر انتهت مهلة حجزه لا يكتب فوق نتيجة حجز أحدث. الاستثناء: نجاح الإرسال
+-- (ok) يُسجَّل sent_at دائمًا لو لم يُسجَّل بعد — الرسالة وصلت فعلًا، وهذا يمنع إرسالها مجددًا.
+drop function if exists public.outbox_complete(jsonb, integer, double precision, double precision);
+
+create or replace function public.outbox_complete(
+  p_results jsonb,
+  p_worker text,
+  p_max_tries integer default 6,
+  p_backoff_base double precision default 30,
+  p_backoff_cap double precision default 3600
+)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  update public.notifications_outbox o
+     set sent_at = case when r.ok then now() else o.sent_at end,
+         -- retry_after (429/لم يُحاوَل بسبب التوقف) لا يُحسب محاولة فاشلة
+         tries = case when r.ok or r.retry_after is not null then o.tries else coalesce(o.tries, 0) + 1 end,
+         next_attempt_at = case
+           when r.ok then null
+           else now() + make_interval(secs => coalesce(
+             r.retry_after,
+             least(p_backoff_cap, p_backoff_base * power(2, coalesce(o.tries, 0)))
+           ))
+         end,
+         dead_at = case
+           when not r.ok and (coalesce(r.permanent, false)
+                              or (r.retry_after is null and coalesce(o.tries, 0) + 1 >= p_max_tries)) then now()
+           else null
+         end,
+         last_error = case when r.ok then null else left(r.error, 500) end,
+         claimed_by = null,
+         claimed_until = null
+    from jsonb_to_recordset(p_results)
+      as r(id text, ok boolean, error text, retry_after double precision, permanent boolean)
+   where o.id::text = r.id
+     and (o.claimed_by = p_worker or (r.ok and o.sent_at is null));
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
@@ -0,0 +1,327 @@
+# database/transport.py
+"""
+طبقة نقل HTTP موحّدة لكل استدعاءات Supabase (PostgREST + RPC).
+
+تُحقن داخل عميل Supabase في database/db.py، فيستفيد منها كل من يستدعي
+get_table(...).execute() أو rpc(...).execute() بدون أي تعديل:
+- pool اتصالات قابل للضبط (keep-alive + HTTP/2 عند توفر حزمة h2).
+- مهلات منفصلة لعمليات القراءة (GET/HEAD) والكتابة (POST/PATCH/DELETE...).
+- سياسة إعادة محاولة مشتركة (backoff أُسّي مع jitter) لا تكرر إلا الطلبات الآمنة.
+- قاطع دائرة (circuit breaker) يوقف الطلبات مؤقتًا عند تتابع الأعطال.
+- مخطط زمن استجابة (histogram) لكل جدول/RPC ونوع عملية.
+
+الضبط عبر متغيرات البيئة SUPABASE_* (انظر القيم الافتراضية أدناه).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+# ---------- الإعدادات ----------
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+POOL_MAX_CONNECTIONS = int(_env_float("SUPABASE_POOL_MAX", 20))
+POOL_MAX_KEEPALIVE   = int(_env_float("SUPABASE_POOL_KEEPALIVE", 10))
+POOL_KEEPALIVE_TTL   = _env_float("SUPABASE_KEEPALIVE_EXPIRY", 30.0)
+HTTP2_ENABLED        = (os.getenv("SUPABASE_HTTP2", "1") == "1")
+
+CONNECT_TIMEOUT = _env_float("SUPABASE_CONNECT_TIMEOUT", 5.0)
+READ_TIMEOUT    = _env_float("SUPABASE_READ_TIMEOUT", 10.0)
+WRITE_TIMEOUT   = _env_float("SUPABASE_WRITE_TIMEOUT", 20.0)
+POOL_TIMEOUT    = _env_float("SUPABASE_POOL_TIMEOUT", 5.0)
+
+RETRY_ATTEMPTS  = int(_env_float("SUPABASE_RETRIES", 3))
+RETRY_BASE      = _env_float("SUPABASE_BACKOFF_BASE", 0.3)
+RETRY_CAP       = _env_float("SUPABASE_BACKOFF_MAX", 4.0)
+
+BREAKER_THRESHOLD = int(_env_float("SUPABASE_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN  = _env_float("SUPABASE_BREAKER_COOLDOWN", 15.0)
+
+_READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+_IDEMPOTENT_METHODS = _READ_METHODS | {"PUT", "DELETE", "PATCH"}
+_RETRY_STATUSES = {502, 503, 504}
+
+# أخطاء تعني أن الطلب لم يصل للخادم أصلًا: آمن إعادتها لأي نوع طلب
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """قاطع الدائرة مفتوح: Supabase متعطل حاليًا ونرفض الطلب فورًا بدل الانتظار."""
+
+
+# ---------- سياسة إعادة المحاولة ----------
+class RetryPolicy:
+    def __init__(self, attempts: int = RETRY_ATTEMPTS, base: float = RETRY_BASE, cap: float = RETRY_CAP):
+        self.attempts = max(1, int(attempts))
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        # full jitter: توزيع عشوائي حتى السقف الأُسّي لتفادي تزامن الخيوط
+        return random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+
+    @staticmethod
+    def is_idempotent(request: httpx.Request) -> bool:
+        if request.method in _IDEMPOTENT_METHODS:
+            return True
+        # upsert في PostgREST (POST + resolution=...) آمن للتكرار
+        prefer = request.headers.get("prefer", "")
+        return request.method == "POST" and "resolution=" in prefer and "/rpc/" not in request.url.path
+
+    def retry_on_error(self, request: httpx.Request, exc: Exception) -> bool:
+        if isinstance(exc, CircuitOpenError):
+            return False
+        if isinstance(exc, _NOT_SENT_ERRORS):
+            return True
+        return isinstance(exc, httpx.TransportError) and self.is_idempotent(request)
+
+    def retry_on_status(self, request: httpx.Request, status: int) -> bool:
+        return status in _RETRY_STATUSES and self.is_idempotent(request)
+
+
+# ---------- قاطع الدائرة ----------
+class CircuitBreaker:
+    """closed → (threshold أعطال متتالية) → open → (cooldown) → half-open: طلب تجريبي واحد."""
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = max(1, int(threshold))
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.cooldown or self._probe_in_flight:
+                raise CircuitOpenError("Supabase circuit breaker is open")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logging.error("[db] circuit breaker opened after %s failures", self._failures)
+                self._opened_at = time.monotonic()
+
+
+# ---------- مخططات زمن الاستجابة ----------
+LATENCY_BUCKETS: Tuple[float, ...] = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyHistogram:
+    __slots__ = ("counts", "total", "sum", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # الخانة الأخيرة = +Inf
+        self.total = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+_hist_lock = threading.Lock()
+_histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+
+def _target_of(path: str) -> str:
+    # /rest/v1/<table> أو /rest/v1/rpc/<fn>
+    parts = [p for p in path.split("/") if p]
+    if "rpc" in parts:
+        i = parts.index("rpc")
+        return "rpc:" + (parts[i + 1] if i + 1 < len(parts) else "?")
+    if len(parts) >= 3 and parts[0] == "rest":
+        return parts[2]
+    return parts[-1] if parts else "/"
+
+def _observe(target: str, op: str, seconds: float, error: bool) -> None:
+    with _hist_lock:
+        h = _histograms.get((target, op))
+        if h is None:
+            h = _histograms[(target, op)] = LatencyHistogram()
+        h.observe(seconds, error)
+
+def latency_snapshot() -> Dict[Tuple[str, str], Dict[str, object]]:
+    """نسخة من المخططات: {(target, op): {buckets, counts, count, sum, errors}}."""
+    with _hist_lock:
+        return {
+            k: {
+                "buckets": LATENCY_BUCKETS,
+                "counts": list(h.counts),
+                "count": h.total,
+                "sum": h.sum,
+                "errors": h.errors,
+            }
+            for k, h in _histograms.items()
+        }
+
+
+# ---------- النقل ----------
+# قاطع دائرة واحد مشترك بين النقل المتزامن وغير المتزامن (نفس الخادم)
+_shared_breaker = CircuitBreaker()
+
+def breaker_state() -> str:
+    return _shared_breaker.state
+
+class _TransportBase:
+    def __init__(self, inner, policy: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None):
+        self.inner = inner
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or _shared_breaker
+        self.read_timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT)
+        self.write_timeout = httpx.Timeout(WRITE_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT)
+
+    def _prepare(self, request: httpx.Request) -> Tuple[str, str]:
+        is_read = request.method in _READ_METHODS
+        request.extensions["timeout"] = (self.read_timeout if is_read else self.write_timeout).as_dict()
+        return _target_of(request.url.path), ("read" if is_read else "write")
+
+
+class SupabaseTransport(_TransportBase, httpx.BaseTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        target, op = self._prepare(request)
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            t0 = time.perf_counter()
+            try:
+                resp = self.inner.handle_request(request)
+            except httpx.TransportError as e:
+                _observe(target, op, time.perf_counter() - t0, True)
+                self.breaker.record_failure()
+                if attempt + 1 < self.policy.attempts and self.policy.retry_on_error(request, e):
+                    logging.warning("[db] %s %s retry %s/%s: %r", request.method, target, attempt + 1, self.policy.attempts, e)
+                    time.sleep(self.policy.delay(attempt))
+                    attempt += 1
+                    continue
+                raise
+
+            status = resp.status_code
+            _observe(target, op, time.perf_counter() - t0, status >= 500)
+            if status >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if attempt + 1 < self.policy.attempts and self.policy.retry_on_status(request, status):
+                resp.read()
+                resp.close()
+                logging.warning("[db] %s %s HTTP %s retry %s/%s", request.method, target, status, attempt + 1, self.policy.attempts)
+                time.sleep(self.policy.delay(attempt))
+                attempt += 1
+                continue
+            return resp
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+class AsyncSupabaseTransport(_TransportBase, httpx.AsyncBaseTransport):
+    """نفس سياسة SupabaseTransport لعميل httpx.AsyncClient (انتظار غير حاجب بين المحاولات)."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        target, op = self._prepare(request)
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            t0 = time.perf_counter()
+            try:
+                resp = await self.inner.handle_async_request(request)
+            except httpx.TransportError as e:
+                _observe(target, op, time.perf_counter() - t0, True)
+                self.breaker.record_failure()
+                if attempt + 1 < self.policy.attempts and self.policy.retry_on_error(request, e):
+                    logging.warning("[db] async %s %s retry %s/%s: %r", request.method, target, attempt + 1, self.policy.attempts, e)
+                    await asyncio.sleep(self.policy.delay(attempt))
+                    attempt += 1
+                    continue
+                raise
+
+            status = resp.status_code
+            _observe(target, op, time.perf_counter() - t0, status >= 500)
+            if status >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if attempt + 1 < self.policy.attempts and self.policy.retry_on_status(request, status):
+                await resp.aread()
+                await resp.aclose()
+                logging.warning("[db] async %s %s HTTP %s retry %s/%s", request.method, target, status, attempt + 1, self.policy.attempts)
+                await asyncio.sleep(self.policy.delay(attempt))
+                attempt += 1
+                continue
+            return resp
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except Exception:
+        return False
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_TTL,
+    )
+
+def use_http2() -> bool:
+    return HTTP2_ENABLED and _http2_available()
+
+def build_http_client() -> httpx.Client:
+    """عميل httpx مشترك لعميل Supabase (postgrest يضبط base_url والترويسات عليه)."""
+    inner = httpx.HTTPTransport(http2=use_http2(), limits=pool_limits())
+    return httpx.Client(
+        transport=SupabaseTransport(inner),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+        follow_redirects=True,
+    )
+
+def build_async_http_client() -> httpx.AsyncClient:
+    """النظير غير المتزامن لـ build_http_client (يُستخدم في database/async_db)."""
+    inner = httpx.AsyncHTTPTransport(http2=use_http2(), limits=pool_limits())
+    return httpx.AsyncClient(
+        transport=AsyncSupabaseTransport(inner),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+        follow_redirects=True,
+    )
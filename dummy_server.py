@@ -1,12 +1,12 @@
-import os, http.server, socketserver
+import os
+from services.metrics import MetricsHandler, MetricsServer
 
 PORT = int(os.environ.get("PORT", 10000))
 
-class Handler(http.server.SimpleHTTPRequestHandler):
-    def log_message(self, format, *args):
-        pass
+class Handler(MetricsHandler):
+    pass
 
 def run_dummy():
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
+    with MetricsServer(("", PORT), Handler) as httpd:
         print(f"🔌 Dummy server listening on port {PORT}")
         httpd.serve_forever()
@@ -37,7 +37,6 @@ def _admin_back_cancel_kb():
     return kb
 
 import threading
-import time
 
 from services.ads_service import add_channel_ad
 
@@ -175,6 +174,11 @@ from services.queue_service import (
     delete_pending_request,
     postpone_request,
     queue_cooldown_start,
+    active_claim,
+    claim_request,
+    mutate_payload,
+    sla_text as queue_sla_text,
+    list_by_sla as queue_list_by_sla,
 )
 from services.wallet_service import (
     register_user_if_not_exist,
@@ -222,12 +226,14 @@ def allowed(user_id: int, perm: str) -> bool:
 from handlers.products import PRODUCTS
 
 # لوحة المزايا (المحفظة وطرق الشحن…)
-from services.feature_flags import ensure_seed, list_features, set_feature_active, list_features_grouped
+from services.feature_flags import ensure_seed, list_features, set_feature_active, set_features_active, list_features_grouped
 
 # محاولة استيراد منظّم الشحن لإزالة القفل المحلي بعد القبول/الإلغاء (استيراد كسول وآمن)
 from services.validators import parse_user_id, parse_duration_choice
 from services.notification_service import notify_user
 from services.ban_service import ban_user, unban_user
+from services.broadcast_service import create_campaign, register_controls, NAME_PLACEHOLDER
+from services.telegram_sender import call_limited, send_message as tg_send_message
 try:
     from handlers import recharge as recharge_handlers
 except Exception:
@@ -583,13 +589,13 @@ def _features_group_items_markup(group_name: str, page: int = 0, page_size: int
 
 def _prune_admin_msg_from_payload(request_id: int, payload: dict, admin_id: int, message_id: int):
     """يشيل رسالة الأدمن الحالية من payload.admin_msgs (لو موجودة) ويحدّث الصف."""
-    try:
-        admin_msgs = (payload.get("admin_msgs") or [])
+    def _prune(cur):
+        admin_msgs = (cur.get("admin_msgs") or [])
         new_msgs = [x for x in admin_msgs if not (x.get("admin_id") == admin_id and x.get("message_id") == message_id)]
-        if len(new_msgs) != len(admin_msgs):
-            new_payload = dict(payload)
-            new_payload["admin_msgs"] = new_msgs
-            get_table("pending_requests").update({"payload": new_payload}).eq("id", request_id).execute()
+        return {"admin_msgs": new_msgs} if len(new_msgs) != len(admin_msgs) else None
+    try:
+        new_payload = mutate_payload(request_id, _prune)
+        if new_payload is not None:
             return new_payload
     except Exception:
         pass
@@ -658,6 +664,24 @@ def _notify_and_close_expired_discounts():
 
 def register(bot, history):
 
+    # === البث الجماعي: حملة في الخلفية (services/broadcast_service) بدل حلقة داخل المعالج ===
+    register_controls(bot, lambda uid: uid in ADMINS or uid == ADMIN_MAIN_ID)
+
+    def _start_broadcast(c, kind, payload):
+        """ينشئ الحملة؛ عند الفشل يُبلغ الأدمن وينهي الخطوة ويرجع None."""
+        try:
+            return create_campaign(bot, c.message.chat.id, kind, payload,
+                                   _collect_clients_with_names(), created_by=c.from_user.id)
+        except Exception as e:
+            logging.exception("[ADMIN] create broadcast campaign failed: %s", e)
+            _broadcast_pending.pop(c.from_user.id, None)
+            try:
+                bot.answer_callback_query(c.id, "❌ تعذّر بدء البث.")
+            except Exception:
+                pass
+            bot.send_message(c.message.chat.id, "❌ تعذّر إنشاء حملة البث. حاول لاحقًا.")
+            return None
+
     # === Global back/cancel handlers (ensure they run before per-step handlers) ===
     @bot.callback_query_handler(func=lambda c: c.data in ("admin:home","adm_flow:cancel"))
     def _admin_cb_back_or_cancel(c):
@@ -1134,13 +1158,7 @@ def register(bot, history):
                     pass
                 except Exception: pass
                 return
-            for it in grouped.get(group, []) or []:
-                k = it.get("key")
-                if k:
-                    try:
-                        set_feature_active(k, bool(to))
-                    except Exception:
-                        pass
+            set_features_active([it.get("key") for it in grouped.get(group, []) or []], bool(to))
             try:
                 bot.answer_callback_query(c.id, "تم التحديث.")
             except Exception:
@@ -1154,11 +1172,8 @@ def register(bot, history):
     cash_transfer.register(bot, history)
     companies_transfer.register_companies_transfer(bot, history)
 
-    # زرع مزايا افتراضية (مرة عند الإقلاع)
-    try:
-        ensure_seed()
-    except Exception:
-        pass
+    # زرع مزايا افتراضية (مرة عند الإقلاع) — في الخلفية، لا تؤخر تسجيل بقية الهاندلرز
+    threading.Thread(target=ensure_seed, name="features-seed", daemon=True).start()
 
     # إلغاء لأي وضع إدخال للأدمن (/cancel)
     @bot.message_handler(commands=['cancel'])
@@ -1242,7 +1257,7 @@ def register(bot, history):
         # جلب الطلب
         res = (
             get_table("pending_requests")
-            .select("user_id, request_text, payload")
+            .select("user_id, request_text, payload, claimed_by, claimed_by_username, lease_until")
             .eq("id", request_id)
             .execute()
         )
@@ -1255,16 +1270,15 @@ def register(bot, history):
         req_text = req.get("request_text") or ""
         name     = _user_name(bot, user_id)
 
-        # ✳️ إذا كان الطلب محجوز من أدمن آخر — نخرج فورًا (كما هو موجود أصلًا)
-        locked_by = payload.get('locked_by')
-        locked_by_username = payload.get('locked_by_username')
+        # ✳️ إذا كان الطلب مستلمًا من أدمن آخر (ومهلته سارية) — نخرج فورًا
+        holder = active_claim(req)
         admin_msgs = payload.get('admin_msgs') or []
-        if locked_by and int(locked_by) != int(call.from_user.id):
-            who = locked_by_username or _admin_mention(bot, locked_by)
+        if holder and holder[0] != int(call.from_user.id):
+            who = holder[1] or _admin_mention(bot, holder[0])
             return bot.answer_callback_query(call.id, f'🔒 محجوز بواسطة {who}')
 
         # 🛑 بوابة "لا تتجاوب الأزرار قبل استلمت"
-        if action != 'claim' and not payload.get('claimed'):
+        if action != 'claim' and not holder:
             return bot.answer_callback_query(call.id, "👋 اضغط «📌 استلمت» أولاً لتفعيل الأزرار.")
 
 
@@ -1280,52 +1294,29 @@ def register(bot, history):
                 except Exception:
                     pass
 
-        def _mark_locked_here():
+        def _mark_locked_here(who):
             try:
-                lock_line = f"🔒 محجوز بواسطة {locked_by_username or _admin_mention(bot, call.from_user.id)}\n"
+                lock_line = f"🔒 محجوز بواسطة {who}\n"
                 try:
                     bot.edit_message_text(lock_line + req_text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=call.message.reply_markup)
                 except Exception:
                     bot.edit_message_caption(lock_line + req_text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=call.message.reply_markup)
             except Exception:
                 pass
-                
-        # لو ما في قفل، فعِّل القفل (كما هو عندك)
-        if not locked_by:
-            try:
-                locked_by_username = _admin_mention(bot, call.from_user.id)
-                new_payload = dict(payload)
-                new_payload['locked_by'] = int(call.from_user.id)
-                new_payload['locked_by_username'] = locked_by_username
-
-                # 👇 تحديث ذرّي: لا ينجح إلا إذا كان القفل فارغًا حاليًا
-                res = (
-                    get_table('pending_requests')
-                    .update({'payload': new_payload})
-                    .eq('id', request_id)
-                    .filter('payload->>locked_by', 'is', 'null')
-                    .execute()
-                )
-                if not getattr(res, "data", None):
-                    return bot.answer_callback_query(call.id, "🔒 الطلب مُقفل للتو من أدمن آخر.")
-
-                _disable_others(except_aid=call.message.chat.id, except_mid=call.message.message_id)
-                _mark_locked_here()
-                payload = new_payload  # حدّث النسخة المحلية
-
-            except Exception as e:
-                logging.exception('[ADMIN] failed to set lock: %s', e)
-
 
         # === زر الاستلام (📌 استلمت) ===
         if action == 'claim':
+            # تحديث ذرّي بمهلة: لا ينجح إلا إذا كان الطلب حرًا أو مستلمًا مني أو انتهت مهلته
+            who = _admin_mention(bot, call.from_user.id)
             try:
-                # علِّم أنه "تم الاستلام" لتُفتح الأزرار لاحقًا
-                claimed_payload = dict(payload)
-                claimed_payload['claimed'] = True
-                get_table('pending_requests').update({'payload': claimed_payload}).eq('id', request_id).execute()
+                if not claim_request(request_id, call.from_user.id, who):
+                    return bot.answer_callback_query(call.id, "🔒 الطلب مُقفل للتو من أدمن آخر.")
             except Exception as e:
-                logging.exception('[ADMIN] failed to set claimed: %s', e)
+                logging.exception('[ADMIN] failed to claim request: %s', e)
+                return bot.answer_callback_query(call.id, "⚠️ تعذّر الاستلام، حاول مجددًا.")
+            if not holder:
+                _disable_others(except_aid=call.message.chat.id, except_mid=call.message.message_id)
+                _mark_locked_here(who)
             bot.answer_callback_query(call.id, '✅ تم الاستلام — أنت المتحكم بهذا الطلب الآن.')
             return
 
@@ -1342,15 +1333,7 @@ def register(bot, history):
                 remove_inline_keyboard(bot, call.message)
             except Exception:
                 pass
-            # ... بعد remove_inline_keyboard و قبل أو بعد postpone_request
-            new_payload = dict(payload)
-            for k in ("locked_by", "locked_by_username", "claimed"):
-                new_payload.pop(k, None)
-            try:
-                get_table('pending_requests').update({'payload': new_payload}).eq('id', request_id).execute()
-            except Exception:
-                pass
-
+            # يفك الاستلام ويعيد الطلب لآخر الدور
             postpone_request(request_id)
     
             # إبلاغ العميل برسالة اعتذار/تنظيم الدور
@@ -1871,23 +1854,17 @@ def register(bot, history):
             except Exception: pass
             return
         if c.data == "bw_confirm":
-            sent = 0
+            cid = None
             if st["dest"] == "clients":
-                for i, (uid, nm) in enumerate(_collect_clients_with_names(), 1):
-                    try:
-                        text = _append_bot_link_for_user(_funny_welcome_text(_h(nm)))
-                        bot.send_message(uid, text, parse_mode="HTML")
-                        sent += 1
-                    except Exception:
-                        pass
-                    if i % 25 == 0:
-                        time.sleep(1)
+                text = _append_bot_link_for_user(_funny_welcome_text(NAME_PLACEHOLDER))
+                cid = _start_broadcast(c, "message", {"text": text, "parse_mode": "HTML"})
+                if cid is None:
+                    return
             else:
                 dest = CHANNEL_USERNAME or FORCE_SUB_CHANNEL_USERNAME
                 try:
                     text = _append_bot_link_for_channel(_funny_welcome_text(None))
-                    bot.send_message(dest, text, parse_mode="HTML")
-                    sent = 1
+                    tg_send_message(bot, dest, text, parse_mode="HTML")
                 except Exception:
                     pass
             _broadcast_pending.pop(c.from_user.id, None)
@@ -1899,7 +1876,7 @@ def register(bot, history):
                 bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
                 pass
             except Exception: pass
-            bot.send_message(c.message.chat.id, f"✅ ترحيب أُرسل ({'القناة' if st['dest']=='channel' else f'{sent} عميل'}).")
+            bot.send_message(c.message.chat.id, f"✅ ترحيب أُرسل ({'القناة' if st['dest']=='channel' else f'الحملة #{cid} تعمل في الخلفية'}).")
 
     # =========================
     # 📢 عرض اليوم (مباشر)
@@ -1964,22 +1941,16 @@ def register(bot, history):
                     "💳 طرق دفع متعددة • ⚡️ تنفيذ فوري\n"
                     f"{BAND}")
 
-            sent = 0
+            cid = None
             if st["dest"] == "clients":
-                for i, (uid, _) in enumerate(_collect_clients_with_names(), 1):
-                    try:
-                        bot.send_message(uid, _append_bot_link_for_user(text), parse_mode="HTML")
-                        sent += 1
-                    except Exception:
-                        pass
-                    if i % 25 == 0:
-                        time.sleep(1)
+                cid = _start_broadcast(c, "message", {"text": _append_bot_link_for_user(text), "parse_mode": "HTML"})
+                if cid is None:
+                    return
             else:
                 dest = CHANNEL_USERNAME or FORCE_SUB_CHANNEL_USERNAME
                 try:
-                    bot.send_message(dest, _append_bot_link_for_channel(text), parse_mode="HTML")
+                    tg_send_message(bot, dest, _append_bot_link_for_channel(text), parse_mode="HTML")
 
-                    sent = 1
                 except Exception:
                     pass
             _broadcast_pending.pop(c.from_user.id, None)
@@ -1991,7 +1962,7 @@ def register(bot, history):
                 bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
                 pass
             except Exception: pass
-            bot.send_message(c.message.chat.id, f"✅ العرض أُرسل ({'القناة' if st['dest']=='channel' else f'{sent} عميل'}).")
+            bot.send_message(c.message.chat.id, f"✅ العرض أُرسل ({'القناة' if st['dest']=='channel' else f'الحملة #{cid} تعمل في الخلفية'}).")
 
 
     # =========================
@@ -2068,22 +2039,15 @@ def register(bot, history):
 
         if c.data == "bp_confirm":
             q, opts = st["q"], st["opts"]
-            sent = 0
+            cid = None
             if st["dest"] == "clients":
-                ids = list(_collect_clients_with_names())
-                for i, (uid, _) in enumerate(ids, 1):
-                    try:
-                        bot.send_poll(uid, question=q, options=opts, is_anonymous=True, allows_multiple_answers=False)
-                        sent += 1
-                    except Exception:
-                        pass
-                    if i % 25 == 0:
-                        time.sleep(1)
+                cid = _start_broadcast(c, "poll", {"question": q, "options": opts})
+                if cid is None:
+                    return
             else:
                 dest = CHANNEL_USERNAME or FORCE_SUB_CHANNEL_USERNAME
                 try:
-                    bot.send_poll(dest, question=q, options=opts, is_anonymous=True, allows_multiple_answers=False)
-                    sent = 1
+                    call_limited(bot.send_poll, dest, question=q, options=opts, is_anonymous=True, allows_multiple_answers=False)
                 except Exception:
                     pass
             _broadcast_pending.pop(c.from_user.id, None)
@@ -2095,7 +2059,7 @@ def register(bot, history):
                 bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
                 pass
             except Exception: pass
-            bot.send_message(c.message.chat.id, f"✅ الاستفتاء أُرسل ({'القناة' if st['dest']=='channel' else f'{sent} عميل'}).")
+            bot.send_message(c.message.chat.id, f"✅ الاستفتاء أُرسل ({'القناة' if st['dest']=='channel' else f'الحملة #{cid} تعمل في الخلفية'}).")
 
 
     # =========================
@@ -2148,21 +2112,15 @@ def register(bot, history):
             except Exception: pass
             return
         if c.data == "bf_confirm":
-            sent = 0
+            cid = None
             if st["dest"] == "clients":
-                for i, (uid, _) in enumerate(_collect_clients_with_names(), 1):
-                    try:
-                        bot.send_message(uid, _append_bot_link_for_user(st["text"]), parse_mode="HTML")
-                        sent += 1
-                    except Exception:
-                        pass
-                    if i % 25 == 0:
-                        time.sleep(1)
+                cid = _start_broadcast(c, "message", {"text": _append_bot_link_for_user(st["text"]), "parse_mode": "HTML"})
+                if cid is None:
+                    return
             else:
                 dest = CHANNEL_USERNAME or FORCE_SUB_CHANNEL_USERNAME
                 try:
-                    bot.send_message(dest, _append_bot_link_for_channel(st["text"]), parse_mode="HTML")
-                    sent = 1
+                    tg_send_message(bot, dest, _append_bot_link_for_channel(st["text"]), parse_mode="HTML")
                 except Exception:
                     pass
             _broadcast_pending.pop(c.from_user.id, None)
@@ -2174,7 +2132,7 @@ def register(bot, history):
                 bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
                 pass
             except Exception: pass
-            bot.send_message(c.message.chat.id, f"✅ الرسالة أُرسلت ({'القناة' if st['dest']=='channel' else f'{sent} عميل'}).")
+            bot.send_message(c.message.chat.id, f"✅ الرسالة أُرسلت ({'القناة' if st['dest']=='channel' else f'الحملة #{cid} تعمل في الخلفية'}).")
     
     @bot.message_handler(func=lambda m: m.text == "🛒 إدارة المنتجات" and _is_admin_msg(m))
     def admin_products_menu(m):
@@ -2187,16 +2145,9 @@ def register(bot, history):
     # ⏳ عرض طابور الانتظار للأدمن
     @bot.message_handler(func=lambda m: m.text == "⏳ طابور الانتظار" and _is_admin_msg(m))
     def admin_queue_list(m: types.Message):
-        # حمّل أول 30 طلب أقدم فالأحدث
+        # أقرب 30 طلبًا موعد SLA (قبل ترحيل 0012: الأقدم أولًا)
         try:
-            res = (
-                get_table("pending_requests")
-                .select("id,user_id,request_text,payload,created_at")
-                .order("created_at", desc=False)
-                .limit(30)
-                .execute()
-            )
-            rows = res.data or []
+            rows = queue_list_by_sla(30)
         except Exception as e:
             logging.exception("[ADMIN] load queue failed: %s", e)
             return bot.reply_to(m, "❌ تعذّر تحميل الطابور.")
@@ -2209,7 +2160,6 @@ def register(bot, history):
             uid     = r["user_id"]
             name    = _user_name(bot, uid)
             req_txt = (r.get("request_text") or "").strip()
-            payload = r.get("payload") or {}
 
             # لوحة الأزرار للطلب
             kb = types.InlineKeyboardMarkup(row_width=3)
@@ -2225,7 +2175,7 @@ def register(bot, history):
             )
 
             # نص الرسالة (نحافظ على HTML لو موجود)
-            head = f"🆕 طلب #{rid} — {name}\n"
+            head = f"🆕 طلب #{rid} — {name}\n{queue_sla_text(r)}\n"
             try:
                 sent = bot.send_message(m.chat.id, head + req_txt, parse_mode="HTML", reply_markup=kb)
             except Exception:
@@ -2233,10 +2183,9 @@ def register(bot, history):
 
             # خزّن مرجع رسالة الأدمن في payload.admin_msgs لدعم نظام القفل
             try:
-                admin_msgs = (payload.get("admin_msgs") or [])
-                admin_msgs.append({"admin_id": m.chat.id, "message_id": sent.message_id})
-                payload["admin_msgs"] = admin_msgs[-20:]  # احتفظ بآخر 20 فقط
-                get_table("pending_requests").update({"payload": payload}).eq("id", rid).execute()
+                entry = {"admin_id": m.chat.id, "message_id": sent.message_id}
+                # احتفظ بآخر 20 فقط (compare-and-set حتى لا تضيع إضافة أدمن آخر بالتزامن)
+                mutate_payload(rid, lambda cur: {"admin_msgs": ((cur.get("admin_msgs") or []) + [entry])[-20:]})
 
             except Exception as ee:
                 logging.exception("[ADMIN] update admin_msgs failed: %s", ee)
@@ -23,11 +23,11 @@ except Exception:
 from services.telegram_safety import remove_inline_keyboard
 from services.anti_spam import too_soon
 from services.ui_guards import confirm_guard  # ✅ حارس التأكيد الموحّد
-from database.db import get_table  # موجود للتوافق لو احتجته
 
 # جديد: فحص الصيانة + أعلام المزايا (Feature Flags)
 from services.system_service import is_maintenance, maintenance_message
 from services.feature_flags import block_if_disabled, is_feature_enabled
+from services.feature_flags import ensure_feature as _ff_ensure_feature
 from services.feature_flags import slugify
 
 # ===== (جديد) خصومات للوحدات والفواتير فقط — استثناء الكازية تمامًا =====
@@ -90,25 +90,12 @@ def _lamp(key: str) -> str:
 # ========== (جديد) تحكّم تفصيلي لكل كمية وحدات ==========
 # نستخدم نفس جدول features مع مفاتيح ديناميكية مثل:
 # units:syriatel:3068-وحدة  |  units:mtn:10000-وحدة
-_FEATURES_TABLE = "features"
-
-def _features_tbl():
-    return get_table(_FEATURES_TABLE)
-
 def key_units(carrier: str, unit_name: str) -> str:
     return f"units:{slugify(carrier)}:{slugify(unit_name)}"
 
 def ensure_feature(key: str, label: str, default_active: bool = True) -> None:
-    """يزرع سطر في features إن لم يوجد (idempotent)."""
-    try:
-        r = _features_tbl().select("key").eq("key", key).limit(1).execute()
-        if not getattr(r, "data", None):
-            _features_tbl().insert({"key": key, "label": label, "active": bool(default_active)}).execute()
-        else:
-            # تحدّث الملصق لو تغيّر
-            _features_tbl().update({"label": label}).eq("key", key).execute()
-    except Exception as e:
-        logging.exception("[bill_and_units] ensure_feature failed: %s", e)
+    """يزرع سطر في features إن لم يوجد (idempotent) — عبر لقطة الأعلام (بلا طلبات للموجود)."""
+    _ff_ensure_feature(key, label, default_active=default_active)
 
 def require_feature_or_alert(bot, chat_id: int, key: str, label: str) -> bool:
     """
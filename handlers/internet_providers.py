@@ -65,6 +65,12 @@ except Exception:
         def _feat_on(key: str, default: bool = True) -> bool:
             return default
 
+try:
+    from services.feature_flags import is_enabled_many as _feat_many
+except Exception:
+    def _feat_many(keys, default: bool = True):
+        return {k: _feat_on(k, default) for k in keys}
+
 # (اختياري) فتح قائمة الشحن عند الحاجة
 try:
     from handlers import keyboards
@@ -200,9 +206,11 @@ def _provider_inline_kb() -> types.InlineKeyboardMarkup:
     """الزر يبقى ظاهر دائمًا؛ نضيف وسم (موقوف 🔒) إن كان المزوّد متوقفًا."""
     kb = types.InlineKeyboardMarkup(row_width=3)
     btns = []
+    keys = {name: _prov_flag_key(name) for name in INTERNET_PROVIDERS}
+    flags = _feat_many([k for k in keys.values() if k is not None])
     for name in INTERNET_PROVIDERS:
-        key = _prov_flag_key(name)
-        disabled = (key is not None and not _feat_on(key, True))
+        key = keys[name]
+        disabled = (key is not None and not flags.get(key, True))
         label = f"🌐 {name}" + (" (موقوف 🔒)" if disabled else "")
         btns.append(types.InlineKeyboardButton(label, callback_data=f"{CB_PROV_PREFIX}:{name}"))
     kb.add(*btns)
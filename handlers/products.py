@@ -41,7 +41,8 @@ except Exception:
 from database.models.product import Product
 
 # (جديد) فلاغات المزايا للمنتجات الفردية
-from services.feature_flags import is_feature_enabled  # نستخدمه لتعطيل منتج معيّن (مثل 660 شدة)
+from services.feature_flags import is_feature_enabled, is_enabled_many  # نستخدمه لتعطيل منتج معيّن (مثل 660 شدة)
+from services.feature_flags import ensure_feature as _ff_ensure_feature
 from services.feature_flags import UNAVAILABLE_MSG
 
 # حارس التأكيد الموحّد: يحذف الكيبورد + يعمل Debounce
@@ -181,11 +182,6 @@ def _visible_category_label(order: dict, product: Product) -> str:
 
 # ================= (جديد) تحكّم تفصيلي ON/OFF لكل زر كمية =================
 # نستخدم جدول features نفسه بمفاتيح منسّقة لكل خيار (SKU)
-_FEATURES_TABLE = "features"
-
-def _features_tbl():
-    return get_table(_FEATURES_TABLE)
-
 def _slug(s: str) -> str:
     return (s or "").strip().replace(" ", "-").replace("ـ", "-").lower()
 
@@ -194,15 +190,8 @@ def key_product_option(category: str, product_name: str) -> str:
     return f"product:{_slug(category)}:{_slug(product_name)}"
 
 def ensure_feature(key: str, label: str, default_active: bool = True) -> None:
-    """يزرع السطر في features إن لم يوجد (idempotent)، ويحدّث label إن تغيّر."""
-    try:
-        r = _features_tbl().select("key").eq("key", key).limit(1).execute()
-        if not getattr(r, "data", None):
-            _features_tbl().insert({"key": key, "label": label, "active": bool(default_active)}).execute()
-        else:
-            _features_tbl().update({"label": label}).eq("key", key).execute()
-    except Exception as e:
-        logging.exception("[products] ensure_feature failed: %s", e)
+    """يزرع السطر في features إن لم يوجد (idempotent)، ويحدّث label إن تغيّر — عبر لقطة الأعلام (بلا طلبات للموجود)."""
+    _ff_ensure_feature(key, label, default_active=default_active)
 
 def is_option_enabled(category: str, product_name: str, default: bool = True) -> bool:
     """يرجع حالة التفعيل لزر الكمية المحدّد."""
@@ -475,6 +464,7 @@ def _build_products_keyboard(category: str, page: int = 0):
     slice_items = options[start:end]
 
     kb = types.InlineKeyboardMarkup(row_width=2)
+    option_flags = is_enabled_many([key_product_option(category, p.name) for p in slice_items], True)
 
     for p in slice_items:
         # فعال على مستوى المنتج العام + فعال على مستوى هذا الخيار؟
@@ -483,7 +473,7 @@ def _build_products_keyboard(category: str, page: int = 0):
         except Exception:
             active_global = True
 
-        active_option = is_option_enabled(category, p.name, True)
+        active_option = option_flags.get(key_product_option(category, p.name), True)
         active = active_global and active_option
 
         if active:
@@ -535,6 +525,7 @@ def _build_products_keyboard_subset(category: str, options: list[Product], page:
     slice_items = options[start:end]
 
     kb = types.InlineKeyboardMarkup(row_width=2)
+    option_flags = is_enabled_many([key_product_option(category, p.name) for p in slice_items], True)
 
     for p in slice_items:
         try:
@@ -542,7 +533,7 @@ def _build_products_keyboard_subset(category: str, options: list[Product], page:
         except Exception:
             active_global = True
 
-        active_option = is_option_enabled(category, p.name, True)
+        active_option = option_flags.get(key_product_option(category, p.name), True)
         active = active_global and active_option
 
         if active:
@@ -4,6 +4,8 @@ from telebot import types
 from handlers import keyboards
 from config import BOT_NAME, FORCE_SUB_CHANNEL_USERNAME
 from services.wallet_service import register_user_if_not_exist
+from services.broadcast_service import unmark_blocked
+from services import membership_cache
 
 START_BTN_TEXT = "✨ ستارت"
 START_BTN_TEXT_SUB = "✅ تم الاشتراك"
@@ -12,8 +14,6 @@ SUB_BTN_TEXT = "🔔 اشترك الآن في القناة"
 CB_START = "cb_start_main"
 CB_CHECK_SUB = "cb_check_sub"
 
-_sub_status_cache = {}
-_sub_status_ttl = 3
 _user_start_limit = {}
 _rate_limit_seconds = 5
 
@@ -58,22 +58,9 @@ def _welcome_inline_kb():
     kb.add(types.InlineKeyboardButton(START_BTN_TEXT, callback_data=CB_START))
     return kb
 
-def is_user_subscribed(bot, user_id):
-    now = time.time()
-    cached = _sub_status_cache.get(user_id)
-    if cached:
-        status, last_check = cached
-        if now - last_check < _sub_status_ttl:
-            return status
-    try:
-        result = bot.get_chat_member(FORCE_SUB_CHANNEL_USERNAME, user_id)
-        status = result.status in ["member", "creator", "administrator"]
-        _sub_status_cache[user_id] = (status, now)
-        return status
-    except Exception as e:
-        logging.error(f"[start.py] Error get_chat_member: {e}", exc_info=True)
-        _sub_status_cache[user_id] = (False, now)
-        return False
+def is_user_subscribed(bot, user_id, recheck_negative: bool = False):
+    # من الذاكرة للمستخدم العائد (services/membership_cache)؛ زر «تم الاشتراك» يعيد فحص السالب فقط
+    return membership_cache.is_member(bot, FORCE_SUB_CHANNEL_USERNAME, user_id, recheck_negative=recheck_negative)
 
 def register(bot, user_history):
 
@@ -90,6 +77,9 @@ def register(bot, user_history):
             return
         _user_start_limit[user_id] = now
 
+        # من كان قد حظر البوت ثم عاد يدخل البث الجماعي مجددًا
+        unmark_blocked(user_id)
+
         _reset_user_flows(user_id)
         
         # --- التقاط رابط الإحالة /start ref-<referrer_id>-<token> ---
@@ -145,11 +135,10 @@ def register(bot, user_history):
     @bot.callback_query_handler(func=lambda c: c.data == CB_CHECK_SUB)
     def cb_check_subscription(call):
         user_id = call.from_user.id
-        _sub_status_cache.pop(user_id, None)  # force recheck now
         _reset_user_flows(user_id)
 
         if FORCE_SUB_CHANNEL_USERNAME:
-            if not is_user_subscribed(bot, user_id):
+            if not is_user_subscribed(bot, user_id, recheck_negative=True):
                 try:
                     bot.answer_callback_query(call.id, "لم يتم العثور على اشتراك. اشترك ثم أعد المحاولة.", show_alert=True)
                 except Exception as e:
@@ -22,6 +22,7 @@ from services.wallet_service import (
     user_has_admin_approval,
     get_available_balance,       # ✅ المتاح = balance - held
 )
+from services.purchase_history import page_purchases
 try:
     from services.queue_service import add_pending_request
 except Exception:
@@ -142,18 +143,35 @@ def show_wallet(bot, message, history=None):
         reply_markup=keyboards.wallet_menu()
     )
 
+PURCHASES_PAGE_SIZE = 50
+
+def _purchases_page(user_id: int, cursor=None):
+    """صفحة من purchase_history (طلب واحد مفهرس)؛ ولو الجدول غير متاح نرجع للاستعلام الموزّع القديم."""
+    try:
+        return page_purchases(user_id, limit=PURCHASES_PAGE_SIZE, cursor=cursor)
+    except Exception as e:
+        logging.warning(f"[wallet] purchase_history unavailable, falling back: {e}")
+        if cursor:
+            return [], None
+        return get_all_purchases_structured(user_id, limit=PURCHASES_PAGE_SIZE), None
+
 # ✅ عرض المشتريات (منسّق + بلا تكرار) — مع أعمدة: الزر | السعر | التاريخ | المبلغ | النوع
-def show_purchases(bot, message, history=None):
-    user_id = message.from_user.id
-    name = _name_from_msg(message)
-    register_user_if_not_exist(user_id, name)
+def show_purchases(bot, message, history=None, cursor=None, user_id=None):
+    # user_id يُمرَّر من ضغطة «الأقدم» لأن message هناك رسالة البوت نفسه
+    user_id = user_id or message.from_user.id
+    name = _name_from_msg(message) if user_id == message.from_user.id else "صديقنا"
+    if cursor is None:
+        register_user_if_not_exist(user_id, name)
 
-    items = get_all_purchases_structured(user_id, limit=50)
+    items, next_cursor = _purchases_page(user_id, cursor)
 
-    if history is not None:
+    if history is not None and cursor is None:
         history.setdefault(user_id, []).append("wallet")
 
     if not items:
+        if cursor:
+            bot.send_message(message.chat.id, "📦 ما فيش مشتريات أقدم.", reply_markup=keyboards.wallet_menu())
+            return
         bot.send_message(
             message.chat.id,
             f"📦 يا {name}، لسه ما فيش مشتريات.\nاختار منتج وخلّينا نزبطك 😎",
@@ -172,9 +190,13 @@ def show_purchases(bot, message, history=None):
         rows.append([title, _fmt_syp(price), ts, _fmt_syp(price), typ])
         total += price
 
-    table = _mk_table(headers, rows[:50])
-    footer = f"\n<b>الإجمالي (آخر {min(len(rows),50)}):</b> {_fmt_syp(total)}"
-    bot.send_message(message.chat.id, f"🛍️ مشترياتك\n{table}{footer}", parse_mode="HTML", reply_markup=keyboards.wallet_menu())
+    table = _mk_table(headers, rows[:PURCHASES_PAGE_SIZE])
+    footer = f"\n<b>الإجمالي (آخر {min(len(rows),PURCHASES_PAGE_SIZE)}):</b> {_fmt_syp(total)}"
+    markup = keyboards.wallet_menu()
+    if next_cursor:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("⬇️ الأقدم", callback_data=f"phm:{next_cursor}"))
+    bot.send_message(message.chat.id, f"🛍️ مشترياتك\n{table}{footer}", parse_mode="HTML", reply_markup=markup)
 
 # ✅ سجل التحويلات (شحن محفظة + تحويل صادر فقط) — مع أعمدة: الزر | السعر | التاريخ | المبلغ | النوع
 def show_transfers(bot, message, history=None):
@@ -267,6 +289,18 @@ def register(bot, history=None):
             pass
         show_purchases(bot, msg, history)
 
+    @bot.callback_query_handler(func=lambda call: (call.data or "").startswith("phm:"))
+    def handle_purchases_more(call):
+        try:
+            bot.answer_callback_query(call.id)
+        except Exception:
+            pass
+        try:
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+        show_purchases(bot, call.message, history, cursor=call.data[4:], user_id=call.from_user.id)
+
     @bot.message_handler(func=lambda msg: msg.text == "📑 سجل التحويلات")
     def handle_transfers(msg):
         # ✅ إنهاء أي رحلة/مسار سابق عالق
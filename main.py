@@ -5,17 +5,29 @@ import telebot
 from config import API_TOKEN, ADMINS
 from telebot import types
 import threading
-import http.server
-import socketserver
-from handlers import referrals  # <-- جديد
+import time
 from services.scheduled_tasks import post_ads_task
-from services.error_log_setup import install_global_error_logging
-from services.state_adapter import UserStateDictLike
+from services.error_log_setup import install_global_error_logging, LogContextMiddleware
+from services.state_adapter import UserStateDictLike, StateSessionMiddleware
 from services.commands_setup import setup_bot_commands
 
 # NEW: عُمّال الإشعارات والصيانة
 from services.outbox_worker import start_outbox_worker
 from services.maintenance_worker import start_housekeeping
+from services.feature_flags import start_flags_refresher
+from services.broadcast_service import start_broadcast_worker
+from services.rollup_service import start_rollup_worker
+from services.discount_service import start_discount_index
+from services.ban_service import BanMiddleware, start_ban_index, wait_ban_index
+from services.startup import StartupProfile, HandlerGate, run_parallel, STARTUP_GATE_TIMEOUT
+from services.metrics import MetricsHandler, MetricsServer, install_telegram_metrics, instrument_handlers
+try:
+    from services.queue_service import start_queue_dispatcher
+except Exception:
+    def start_queue_dispatcher(*args, **kwargs):
+        return None
+
+_profile = StartupProfile()
 
 # ✅ تعديل بسيط ليتوافق مع ويندوز: تشغيل الخادم الوهمي يصبح اختياريًا
 ENABLE_DUMMY_SERVER = os.environ.get("ENABLE_DUMMY_SERVER", "0") == "1"
@@ -23,10 +35,9 @@ ENABLE_DUMMY_SERVER = os.environ.get("ENABLE_DUMMY_SERVER", "0") == "1"
 PORT = 8081
 
 def run_dummy_server():
-    handler = http.server.SimpleHTTPRequestHandler
-    # ✅ السماح بإعادة استخدام المنفذ لتفادي OSError: [Errno 98]
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.TCPServer(("", PORT), handler) as httpd:
+    handler = MetricsHandler  # + /metrics (Prometheus) و /healthz
+    # ✅ MetricsServer: خيط لكل طلب + السماح بإعادة استخدام المنفذ لتفادي OSError: [Errno 98]
+    with MetricsServer(("", PORT), handler) as httpd:
         print(f"🔌 Dummy server listening on port {PORT}")
         httpd.serve_forever()
 
@@ -53,267 +64,317 @@ def _unhandled_exception_hook(exc_type, exc_value, exc_tb):
 sys.excepthook = _unhandled_exception_hook
 
 # ---------------------------------------------------------
-# التحقق من صحة التوكن وجلب هوية البوت قبل التشغيل
+# كائن بوت واحد: التحقق من التوكن (get_me) وحذف أي Webhook سابق (لتجنب 409) معًا
 # ---------------------------------------------------------
-def check_api_token(token):
-    try:
-        test_bot = telebot.TeleBot(token)
-        me = test_bot.get_me()
-        print(f"✅ التوكن سليم. هوية البوت: @{me.username} (ID: {me.id})")
-        return True
-    except Exception as e:
-        logging.critical(f"❌ التوكن غير صالح أو لا يمكن الاتصال بـ Telegram API: {e}")
-        sys.exit(1)
+install_telegram_metrics()  # زمن طلبات Bot API وعدد 429 (قبل أول طلب)
+bot = telebot.TeleBot(API_TOKEN, parse_mode="HTML", use_class_middlewares=True)
 
-if not check_api_token(API_TOKEN):
-    sys.exit(1)
+_net = run_parallel({
+    "get_me": bot.get_me,
+    "delete_webhook": lambda: bot.delete_webhook(drop_pending_updates=True),
+}, _profile)
 
-# ---------------------------------------------------------
-# إنشاء كائن البوت وحذف أي Webhook سابق لتجنب خطأ 409
-# ---------------------------------------------------------
-bot = telebot.TeleBot(API_TOKEN, parse_mode="HTML")
-try:
-    bot.delete_webhook(drop_pending_updates=True)
-except Exception as e:
-    logging.warning(f"⚠️ لم يتم حذف Webhook بنجاح: {e}")
+if isinstance(_net["get_me"], Exception):
+    logging.critical(f"❌ التوكن غير صالح أو لا يمكن الاتصال بـ Telegram API: {_net['get_me']}")
+    sys.exit(1)
+print(f"✅ التوكن سليم. هوية البوت: @{_net['get_me'].username} (ID: {_net['get_me'].id})")
+if isinstance(_net["delete_webhook"], Exception):
+    logging.warning(f"⚠️ لم يتم حذف Webhook بنجاح: {_net['delete_webhook']}")
 
 # ---------------------------------------------------------
 # تسجيل حالة المستخدم (تخزين في Supabase عبر الـ adapter)
 # ---------------------------------------------------------
 user_state = UserStateDictLike()
+# سياق السجلات (request_id/user_id) لكل تحديث
+bot.setup_middleware(LogContextMiddleware())
+# البوابة: التحديثات المبكرة تنتظر اكتمال تسجيل الهاندلرز وأول تحميل لفهرس الحظر
+_gate = HandlerGate()
+bot.setup_middleware(_gate)
+# الحظر (بعد البوابة: الفهرس محمّل): تحديثات المحظورين تسقط قبل أي هاندلر أو تحميل حالة
+bot.setup_middleware(BanMiddleware(bot, exempt=ADMINS))
+# جلسة حالة واحدة لكل تحديث: تحميل مرة واحدة + حفظ واحد بعد الهاندلر
+bot.setup_middleware(StateSessionMiddleware())
 history: dict[int, list] = {}
 
 # ---------------------------------------------------------
-# استيراد جميع الهاندلرز بعد تهيئة البوت
+# تسجيل الهاندلرز (في الخلفية خلف HandlerGate — ترتيب التسجيل كما هو تمامًا)
 # ---------------------------------------------------------
-from handlers import (start,
-    wallet,
-    support,
-    admin,
-    ads,
-    recharge,
-    cash_transfer,
-    companies_transfer,
-    products,
-    media_services,
-    wholesale,
-    university_fees,
-    internet_providers,
-    bill_and_units,
-    links as links_handler,   
-)
-from handlers.keyboards import (
-    main_menu,
-    products_menu,
-    game_categories,
-    recharge_menu,
-    companies_transfer_menu,
-    cash_transfer_menu,
-    syrian_balance_menu,
-    wallet_menu,
-    support_menu,
-    links_menu,
-    media_services_menu,
-    transfers_menu,
-)
-# هاندلر الإلغاء المركزي
-from handlers import cancel as cancel_handler
+def register_handlers():
+    # ---------------------------------------------------------
+    # استيراد جميع الهاندلرز بعد تهيئة البوت
+    # ---------------------------------------------------------
+    _imports_started = time.perf_counter()
+    from handlers import referrals
+    from handlers import (start,
+        wallet,
+        support,
+        admin,
+        ads,
+        recharge,
+        cash_transfer,
+        companies_transfer,
+        products,
+        media_services,
+        wholesale,
+        university_fees,
+        internet_providers,
+        bill_and_units,
+        links as links_handler,   
+    )
+    from handlers.keyboards import (
+        main_menu,
+        products_menu,
+        game_categories,
+        recharge_menu,
+        companies_transfer_menu,
+        cash_transfer_menu,
+        syrian_balance_menu,
+        wallet_menu,
+        support_menu,
+        links_menu,
+        media_services_menu,
+        transfers_menu,
+    )
+    # هاندلر الإلغاء المركزي
+    from handlers import cancel as cancel_handler
+    _profile.mark("handler_imports", _imports_started)
+
+    # ---------------------------------------------------------
+    # تسجيل جميع الهاندلرز (تمرير user_state أو history حسب الحاجة)
+    # ---------------------------------------------------------
+    start.register(bot, history)
+    referrals.register(bot, history)
+    wallet.register(bot, history)
+    support.register(bot, history)
+    admin.register(bot, history)
+    ads.register(bot, history)
+    recharge.register(bot, history)
+    cash_transfer.register(bot, history)
+    companies_transfer.register_companies_transfer(bot, history)
+    bill_and_units.register_bill_and_units(bot, history)
+    links_handler.register(bot, history)
+    # ✅ تسجيل المنتجات مرة واحدة وتمرير admin_ids هنا
+    products.register(bot, history, admin_ids=[6935846121])
+
+    media_services.register(bot, history)
+    wholesale.register(bot, history)
+    university_fees.register_university_fees(bot, history)
+    internet_providers.register(bot)
+
+    # ✅ تسجيل هاندلر /cancel بعد تعريف bot و history
+    cancel_handler.register(bot, history)
+
+    # ---------------------------------------------------------
+    # زر الرجوع الذكي (بدون تعديل)
+    # ---------------------------------------------------------
+    @bot.message_handler(func=lambda msg: msg.text == "⬅️ رجوع")
+    def handle_back(msg):
+        user_id = msg.from_user.id
+        state = user_state.get(user_id, {}).get("step", "main_menu")
+
+        if state == "products_menu":
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى المنتجات.", reply_markup=products_menu())
+            user_state[user_id]['step'] = "products_menu"
+        elif state == "main_menu":
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى القائمة الرئيسية.", reply_markup=main_menu())
+        elif state == "game_menu":
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة المنتجات.", reply_markup=products_menu())
+            user_state[user_id]['step'] = "products_menu"
+        elif state == "cash_menu":
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة التحويلات.", reply_markup=transfers_menu())
+            user_state[user_id]['step'] = "transfers_menu"
+        elif state == "syrian_transfer":
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة المنتجات.", reply_markup=products_menu())
+            user_state[user_id]['step'] = "products_menu"
+        else:
+            bot.send_message(msg.chat.id, "⬅️ عدت إلى البداية.", reply_markup=main_menu())
+            user_state[user_id]['step'] = "main_menu"
+
+    # ---------------------------------------------------------
+    # ربط أزرار المنتجات بالخدمات الخاصة بها
+    # ---------------------------------------------------------
+    @bot.message_handler(func=lambda msg: msg.text == "تحويلات كاش و حوالات")
+    def handle_transfers(msg):
+        bot.send_message(
+            msg.chat.id,
+            "من خلال هذه الخدمة تستطيع تحويل رصيد محفظتك إليك أو لأي شخص آخر عن طريق شركات الحوالات (كالهرم)، أو كرصيد كاش (سيرياتيل/MTN)."
+        )
+        bot.send_message(msg.chat.id, "اختر نوع التحويل:", reply_markup=transfers_menu())
+        user_state[msg.from_user.id]['step'] = "transfers_menu"
+
+    @bot.message_handler(func=lambda msg: msg.text == "💵 تحويل الى رصيد كاش")
+    def handle_cash_transfer(msg):
+        from handlers.cash_transfer import start_cash_transfer
+        start_cash_transfer(bot, msg, history)
+        user_state[msg.from_user.id]['step'] = "cash_menu"
+
+    @bot.message_handler(func=lambda msg: msg.text == "حوالة مالية عبر شركات")
+    def handle_companies_transfer(msg):
+        from handlers.companies_transfer import register_companies_transfer
+        register_companies_transfer(bot, history)
+
+    @bot.message_handler(func=lambda msg: msg.text == "🌐 دفع مزودات الإنترنت ADSL")
+    def handle_internet(msg):
+        from handlers.internet_providers import start_internet_provider_menu
+        start_internet_provider_menu(bot, msg)
+
+    @bot.message_handler(func=lambda msg: msg.text == "🎓 دفع رسوم جامعية")
+    def handle_university_fees(msg):
+        from handlers.university_fees import start_university_fee
+        start_university_fee(bot, msg)
+
+    @bot.message_handler(func=lambda msg: msg.text in [
+        "🖼️ تصميم لوغو احترافي",
+        "📱 إدارة ونشر يومي",
+        "📢 إطلاق حملة إعلانية",
+        "🧾 باقة متكاملة شهرية",
+        "✏️ طلب مخصص"
+    ])
+    def handle_media(msg):
+        from handlers.media_services import show_media_services
+        show_media_services(bot, msg, user_state)
+
+    # أزرار الشركات الجديدة (حسب النصوص الموجودة)
+    @bot.message_handler(func=lambda msg: msg.text == "شركة الهرم")
+    def handle_al_haram(msg):
+        bot.send_message(
+            msg.chat.id,
+            "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة الهرم**.\n"
+            "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n\n"
+            "تابع العملية أو ألغِ الطلب.",
+            reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
+                "✔️ تأكيد حوالة الهرم", "❌ إلغاء"
+            )
+        )
+        user_state[msg.from_user.id]['step'] = "alharam_start"
+
+    @bot.message_handler(func=lambda msg: msg.text == "شركة الفؤاد")
+    def handle_alfouad(msg):
+        bot.send_message(
+            msg.chat.id,
+            "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة الفؤاد**.\n"
+            "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n\n"
+            "تابع العملية أو ألغِ الطلب.",
+            reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
+                "✔️ تأكيد حوالة الفؤاد", "❌ إلغاء"
+            )
+        )
+        user_state[msg.from_user.id]['step'] = "alfouad_start"
+
+    @bot.message_handler(func=lambda msg: msg.text == "شركة شخاشير")
+    def handle_shakhashir(msg):
+        bot.send_message(
+            msg.chat.id,
+            "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة شخاشير**.\n"
+            "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n"
+            "\n"
+            "تابع العملية أو ألغِ الطلب.",
+            reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
+                "✔️ تأكيد حوالة شخاشير", "❌ إلغاء"
+            )
+        )
+        user_state[msg.from_user.id]['step'] = "shakhashir_start"
+
+
+    # ---------------------------------------------------------
+    # ✅ ربط معالجات لعبة الجوائز بعد إنشاء البوت وتسجيل الهاندلرز
+    # ---------------------------------------------------------
+    # ---------------------------------------------------------
+    # معالج إلغاء عام للنص "❌ إلغاء" (أمر /cancel مسجل في handlers/cancel)
+    # ---------------------------------------------------------
+    @bot.message_handler(func=lambda msg: msg.text in ["❌ إلغاء"])
+    def global_cancel_text(msg):
+        try:
+            from services.state_service import clear_state
+            clear_state(msg.from_user.id)
+        except Exception:
+            pass
+        try:
+            from handlers import keyboards
+            bot.send_message(msg.chat.id, "تم إلغاء كل العمليات والعودة للبداية.", reply_markup=keyboards.main_menu())
+        except Exception:
+            bot.send_message(msg.chat.id, "تم إلغاء كل العمليات.")
+
 
 # ---------------------------------------------------------
-# تسجيل جميع الهاندلرز (تمرير user_state أو history حسب الحاجة)
+# العمّال الخلفيون وأوامر القائمة (لا شيء منها يلزم قبل بدء الاستقبال)
 # ---------------------------------------------------------
-start.register(bot, history)
-referrals.register(bot, history)
-wallet.register(bot, history)
-support.register(bot, history)
-admin.register(bot, history)
-ads.register(bot, history)
-recharge.register(bot, history)
-cash_transfer.register(bot, history)
-companies_transfer.register_companies_transfer(bot, history)
-bill_and_units.register_bill_and_units(bot, history)
-links_handler.register(bot, history)
-# ✅ تسجيل المنتجات مرة واحدة وتمرير admin_ids هنا
-products.register(bot, history, admin_ids=[6935846121])
-
-media_services.register(bot, history)
-wholesale.register(bot, history)
-university_fees.register_university_fees(bot, history)
-internet_providers.register(bot)
-
-# ✅ تسجيل هاندلر /cancel بعد تعريف bot و history
-cancel_handler.register(bot, history)
-
 CHANNEL_USERNAME = "@shop100sho"
 def notify_channel_on_start(bot):
     # تم تعطيل رسالة القناة مؤقتًا
     pass
 
-notify_channel_on_start(bot)
-# تفعيل سجل الأخطاء + قائمة الأوامر الثابتة
-install_global_error_logging()
-setup_bot_commands(bot, list(ADMINS))
-
-# بعد اكتمال التسجيل وتشغيل البوت، شغّل مهمة الإعلانات المجدولة
-post_ads_task(bot)
+def start_background_services():
+    notify_channel_on_start(bot)
 
-# NEW: تشغيل عامل الإشعارات من outbox وعامل الصيانة (بديل pg_cron داخل التطبيق)
-start_outbox_worker(bot)   # يمرّ على notifications_outbox ويُرسل الرسائل
-start_housekeeping(bot)    # تنظيف 14 ساعة + تنبيهات/حذف المحافظ بعد 33 يوم خمول
+    # بعد اكتمال التسجيل وتشغيل البوت، شغّل مهمة الإعلانات المجدولة
+    post_ads_task(bot)
 
-# ---------------------------------------------------------
-# زر الرجوع الذكي (بدون تعديل)
-# ---------------------------------------------------------
-@bot.message_handler(func=lambda msg: msg.text == "⬅️ رجوع")
-def handle_back(msg):
-    user_id = msg.from_user.id
-    state = user_state.get(user_id, {}).get("step", "main_menu")
-
-    if state == "products_menu":
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى المنتجات.", reply_markup=products_menu())
-        user_state[user_id]['step'] = "products_menu"
-    elif state == "main_menu":
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى القائمة الرئيسية.", reply_markup=main_menu())
-    elif state == "game_menu":
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة المنتجات.", reply_markup=products_menu())
-        user_state[user_id]['step'] = "products_menu"
-    elif state == "cash_menu":
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة التحويلات.", reply_markup=transfers_menu())
-        user_state[user_id]['step'] = "transfers_menu"
-    elif state == "syrian_transfer":
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى قائمة المنتجات.", reply_markup=products_menu())
-        user_state[user_id]['step'] = "products_menu"
-    else:
-        bot.send_message(msg.chat.id, "⬅️ عدت إلى البداية.", reply_markup=main_menu())
-        user_state[user_id]['step'] = "main_menu"
+    # NEW: تشغيل عامل الإشعارات من outbox وعامل الصيانة (بديل pg_cron داخل التطبيق)
+    start_outbox_worker(bot)   # يمرّ على notifications_outbox ويُرسل الرسائل
+    start_housekeeping(bot)    # تنظيف 14 ساعة + تنبيهات/حذف المحافظ بعد 33 يوم خمول
+    start_flags_refresher()    # لقطة أعلام المزايا + تحديث خلفي (القوائم لا تنتظر القاعدة)
+    start_discount_index()     # فهرس الخصومات في الذاكرة (الشراء لا ينتظر القاعدة)
+    start_broadcast_worker(bot)  # حملات البث الجماعي (تُستأنف بعد إعادة التشغيل)
+    start_rollup_worker()      # تجميعات يومية للتقارير (قبل تنظيف الـ14 ساعة)
 
-# ---------------------------------------------------------
-# ربط أزرار المنتجات بالخدمات الخاصة بها
-# ---------------------------------------------------------
-@bot.message_handler(func=lambda msg: msg.text == "تحويلات كاش و حوالات")
-def handle_transfers(msg):
-    bot.send_message(
-        msg.chat.id,
-        "من خلال هذه الخدمة تستطيع تحويل رصيد محفظتك إليك أو لأي شخص آخر عن طريق شركات الحوالات (كالهرم)، أو كرصيد كاش (سيرياتيل/MTN)."
-    )
-    bot.send_message(msg.chat.id, "اختر نوع التحويل:", reply_markup=transfers_menu())
-    user_state[msg.from_user.id]['step'] = "transfers_menu"
-
-@bot.message_handler(func=lambda msg: msg.text == "💵 تحويل الى رصيد كاش")
-def handle_cash_transfer(msg):
-    from handlers.cash_transfer import start_cash_transfer
-    start_cash_transfer(bot, msg, history)
-    user_state[msg.from_user.id]['step'] = "cash_menu"
-
-@bot.message_handler(func=lambda msg: msg.text == "حوالة مالية عبر شركات")
-def handle_companies_transfer(msg):
-    from handlers.companies_transfer import register_companies_transfer
-    register_companies_transfer(bot, history)
-
-@bot.message_handler(func=lambda msg: msg.text == "🌐 دفع مزودات الإنترنت ADSL")
-def handle_internet(msg):
-    from handlers.internet_providers import start_internet_provider_menu
-    start_internet_provider_menu(bot, msg)
-
-@bot.message_handler(func=lambda msg: msg.text == "🎓 دفع رسوم جامعية")
-def handle_university_fees(msg):
-    from handlers.university_fees import start_university_fee
-    start_university_fee(bot, msg)
-
-@bot.message_handler(func=lambda msg: msg.text in [
-    "🖼️ تصميم لوغو احترافي",
-    "📱 إدارة ونشر يومي",
-    "📢 إطلاق حملة إعلانية",
-    "🧾 باقة متكاملة شهرية",
-    "✏️ طلب مخصص"
-])
-def handle_media(msg):
-    from handlers.media_services import show_media_services
-    show_media_services(bot, msg, user_state)
-
-# أزرار الشركات الجديدة (حسب النصوص الموجودة)
-@bot.message_handler(func=lambda msg: msg.text == "شركة الهرم")
-def handle_al_haram(msg):
-    bot.send_message(
-        msg.chat.id,
-        "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة الهرم**.\n"
-        "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n\n"
-        "تابع العملية أو ألغِ الطلب.",
-        reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
-            "✔️ تأكيد حوالة الهرم", "❌ إلغاء"
-        )
-    )
-    user_state[msg.from_user.id]['step'] = "alharam_start"
-
-@bot.message_handler(func=lambda msg: msg.text == "شركة الفؤاد")
-def handle_alfouad(msg):
-    bot.send_message(
-        msg.chat.id,
-        "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة الفؤاد**.\n"
-        "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n\n"
-        "تابع العملية أو ألغِ الطلب.",
-        reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
-            "✔️ تأكيد حوالة الفؤاد", "❌ إلغاء"
-        )
-    )
-    user_state[msg.from_user.id]['step'] = "alfouad_start"
-
-@bot.message_handler(func=lambda msg: msg.text == "شركة شخاشير")
-def handle_shakhashir(msg):
-    bot.send_message(
-        msg.chat.id,
-        "💸 هذه الخدمة تخولك إلى استلام حوالتك المالية عبر **شركة شخاشير**.\n"
-        "يتم إضافة مبلغ 1500 ل.س على كل 50000 ل.س.\n"
-        "\n"
-        "تابع العملية أو ألغِ الطلب.",
-        reply_markup=telebot.types.ReplyKeyboardMarkup(resize_keyboard=True).add(
-            "✔️ تأكيد حوالة شخاشير", "❌ إلغاء"
-        )
-    )
-    user_state[msg.from_user.id]['step'] = "shakhashir_start"
+    # تشغيل نظام الطابور (QUEUE)
+    start_queue_dispatcher(bot)  # موزّع دائم: يستيقظ مع كل طلب جديد ويعرض حتى QUEUE_CONCURRENCY طلبًا معًا
 
-# ---------------------------------------------------------
-# تشغيل نظام الطابور (QUEUE)
-# ---------------------------------------------------------
-try:
-    from services.queue_service import process_queue
-except Exception:
-    def process_queue(*args, **kwargs):
-        return None
 
-threading.Thread(target=process_queue, args=(bot,), daemon=True).start()
-
-# ---------------------------------------------------------
-# ✅ ربط معالجات لعبة الجوائز بعد إنشاء البوت وتسجيل الهاندلرز
 # ---------------------------------------------------------
+# مسار الإقلاع: الاستقبال يبدأ فورًا، والباقي بالتوازي في الخلفية
 # ---------------------------------------------------------
-# معالج إلغاء عام للنص "❌ إلغاء" (أمر /cancel مسجل في handlers/cancel)
-# ---------------------------------------------------------
-@bot.message_handler(func=lambda msg: msg.text in ["❌ إلغاء"])
-def global_cancel_text(msg):
-    try:
-        from services.state_service import clear_state
-        clear_state(msg.from_user.id)
-    except Exception:
-        pass
+def _register_and_open_gate():
     try:
-        from handlers import keyboards
-        bot.send_message(msg.chat.id, "تم إلغاء كل العمليات والعودة للبداية.", reply_markup=keyboards.main_menu())
+        register_handlers()
     except Exception:
-        bot.send_message(msg.chat.id, "تم إلغاء كل العمليات.")
+        logging.exception("❌ فشل تسجيل بعض الهاندلرز")
+    finally:
+        try:
+            instrument_handlers(bot)  # زمن كل هاندلر في /metrics
+        except Exception:
+            logging.exception("⚠️ تعذر تغليف الهاندلرز بالمقاييس")
+        # لا يمر تحديث قبل أن يعرف BanMiddleware المحظورين (يتحمّل بالتوازي في ban_index)
+        if not wait_ban_index(STARTUP_GATE_TIMEOUT):
+            logging.warning("⚠️ فهرس الحظر لم يكتمل قبل فتح البوابة")
+        _gate.open()
+
+def _boot_background():
+    run_parallel({
+        "handlers": _register_and_open_gate,
+        "ban_index": start_ban_index,  # فهرس الحظر في الذاكرة (البوابة تنتظر أول تحميل)
+        "services": start_background_services,
+        "commands": lambda: setup_bot_commands(bot, list(ADMINS)),
+    }, _profile)
+    _profile.report()
+
+# تفعيل سجل الأخطاء (ملف محلي، بلا شبكة) قبل أي شيء آخر في الخلفية
+install_global_error_logging()
+threading.Thread(target=_boot_background, name="startup", daemon=True).start()
 
 # ---------------------------------------------------------
 # تشغيل البوت مع نظام إعادة المحاولة والتنبيه في حال الخطأ
 # ---------------------------------------------------------
-import time
-
 def restart_bot():
     logging.warning("🔄 إعادة تشغيل البوت بعد 10 ثوانٍ…")
     time.sleep(10)
+    # execv لا يشغّل atexit: ادفع حالات المستخدمين المعلّقة قبل الاستبدال
+    try:
+        from services.state_service import flush_state
+        flush_state()
+    except Exception as e:
+        logging.warning(f"⚠️ تعذّر دفع الحالات المعلّقة: {e}")
+    try:
+        from services.activity_logger import flush_actions
+        flush_actions()
+    except Exception:
+        pass
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
 def start_polling():
     print("🤖 البوت يعمل الآن…")
+    _profile.mark("until_polling", _profile.t0)
     while True:
         try:
             bot.infinity_polling(
@@ -1,15 +1,62 @@
 # services/activity_logger.py
-import json, os, datetime
+# سجل إجراءات الأدمن (JSON سطرًا لكل إجراء). log_action يضيف للذاكرة ويعود فورًا؛
+# خيط خلفي يكتب الدفعة كل ADMIN_LOG_FLUSH_SECONDS ثانية مع fsync (وعند الخروج).
+import atexit, json, logging, os, datetime, threading
 
 LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs", "admin_actions.log")
+ADMIN_LOG_FLUSH_SECONDS = float(os.getenv("ADMIN_LOG_FLUSH_SECONDS", "2") or 2)
+
+_buf: list = []
+_buf_lock = threading.Lock()
+_write_lock = threading.Lock()
+_wake = threading.Event()
+_started = False
+
+def flush_actions() -> int:
+    """يكتب المعلّق إلى الملف مع fsync. يرجع عدد السجلات المكتوبة."""
+    global _buf
+    with _write_lock:
+        with _buf_lock:
+            batch, _buf = _buf, []
+        if not batch:
+            return 0
+        try:
+            os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+            with open(LOG_PATH, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in batch))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logging.warning("[admin_actions] flush failed: %s", e)
+            with _buf_lock:
+                _buf = batch + _buf
+            return 0
+        return len(batch)
+
+def _flusher_loop():
+    while True:
+        _wake.wait(ADMIN_LOG_FLUSH_SECONDS)
+        _wake.clear()
+        flush_actions()
+
+def _ensure_flusher():
+    global _started
+    if _started:
+        return
+    with _buf_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_flusher_loop, name="admin-actions-flusher", daemon=True).start()
+    atexit.register(flush_actions)
 
 def log_action(admin_id: int, action: str, reason: str = ""):
-    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
     rec = {
         "ts": datetime.datetime.utcnow().isoformat(),
         "admin_id": int(admin_id),
         "action": action,
         "reason": reason or "",
     }
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    _ensure_flusher()
+    with _buf_lock:
+        _buf.append(rec)
@@ -5,6 +5,8 @@ from typing import Dict, Any, List
 import logging
 from postgrest.exceptions import APIError
 from database.db import get_table, DEFAULT_TABLE
+from database import schema
+from services import rollup_service as rollups
 from config import ADMINS, ADMIN_MAIN_ID
 
 LEDGER_TABLE = "admin_ledger"
@@ -13,6 +15,9 @@ TRANSACTION_TABLE = "transactions"
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def _fmt(amount: int) -> str:
+    return f"{int(amount or 0):,} ل.س"
+
 # ────────────────────────────────────────────────────────────
 # سجلات دائمة لإقرار الإداريين (إيداع/صرف)
 # ────────────────────────────────────────────────────────────
@@ -60,31 +65,42 @@ def log_admin_spend(admin_id: int, user_id: int, amount: int, note: str = "") ->
 # ────────────────────────────────────────────────────────────
 # تقارير الإداريين
 # ────────────────────────────────────────────────────────────
-def summarize_assistants(days: int = 7) -> str:
+def _ledger_totals(days: int) -> Dict[int, Dict[str, int]]:
+    """{admin_id: {"deposit": n, "spend": n}} لآخر days يومًا — من التجميعات اليومية إن توفرت."""
+    per_admin: Dict[int, Dict[str,int]] = {}
+    agg = rollups.totals(("admin_deposit", "admin_spend"), start=rollups.since_day(days), by_dim=True)
+    if agg is not None:
+        for (metric, dim), (value, _count) in agg.items():
+            try:
+                aid = int(dim)
+            except Exception:
+                continue
+            per_admin.setdefault(aid, {"deposit":0,"spend":0})[metric[len("admin_"):]] += value
+        return per_admin
+
     since = datetime.now(timezone.utc) - timedelta(days=days)
-    assistants = [a for a in ADMINS if a != ADMIN_MAIN_ID]
-    if not assistants:
-        return "لا يوجد أدمن مساعد لإظهار تقريره."
-    # اجمع لكل أدمن
     rows = (
         get_table(LEDGER_TABLE)
         .select("admin_id, action, amount, created_at")
         .gte("created_at", since.isoformat())
         .execute()
     )
-    data = rows.data or []
-    totals: Dict[int, Dict[str,int]] = {aid: {"deposit":0,"spend":0} for aid in assistants}
-    for r in data:
+    for r in rows.data or []:
         try:
             aid = int(r.get("admin_id") or 0)
         except Exception:
             continue
-        if aid not in totals:
-            continue
         act = (r.get("action") or "").strip()
-        amt = int(r.get("amount") or 0)
         if act in ("deposit","spend"):
-            totals[aid][act] += amt
+            per_admin.setdefault(aid, {"deposit":0,"spend":0})[act] += int(r.get("amount") or 0)
+    return per_admin
+
+def summarize_assistants(days: int = 7) -> str:
+    assistants = [a for a in ADMINS if a != ADMIN_MAIN_ID]
+    if not assistants:
+        return "لا يوجد أدمن مساعد لإظهار تقريره."
+    # اجمع لكل أدمن
+    totals = _ledger_totals(days)
     # صياغة
     lines = [f"<b>📈 تقرير الأدمن المساعد — آخر {days} يومًا</b>"]
     for aid in assistants:
@@ -95,29 +111,9 @@ def summarize_assistants(days: int = 7) -> str:
     return "\n".join(lines)
 
 def summarize_all_admins(days: int = 7) -> str:
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    rows = (
-        get_table(LEDGER_TABLE)
-        .select("admin_id, action, amount, created_at")
-        .gte("created_at", since.isoformat())
-        .execute()
-    )
-    data = rows.data or []
-    per_admin: Dict[int, Dict[str,int]] = {}
-    grand_dep = 0
-    grand_sp = 0
-    for r in data:
-        try:
-            aid = int(r.get("admin_id") or 0)
-        except Exception:
-            continue
-        act = (r.get("action") or "").strip()
-        amt = int(r.get("amount") or 0)
-        d = per_admin.setdefault(aid, {"deposit":0,"spend":0})
-        if act == "deposit":
-            d["deposit"] += amt; grand_dep += amt
-        elif act == "spend":
-            d["spend"] += amt; grand_sp += amt
+    per_admin = _ledger_totals(days)
+    grand_dep = sum(t["deposit"] for t in per_admin.values())
+    grand_sp = sum(t["spend"] for t in per_admin.values())
     lines = [f"<b>📈 تقرير الإداريين (الكل) — آخر {days} يومًا</b>"]
     for aid, t in sorted(per_admin.items(), key=lambda kv:(kv[1]['deposit']+kv[1]['spend']), reverse=True):
         lines.append(f"• <code>{aid}</code> — شحن: {_fmt(t['deposit'])} | صرف: {_fmt(t['spend'])}")
@@ -146,6 +142,12 @@ def _load_user_map(user_ids) -> Dict[int, str]:
         "id,username",
         "id",
     ]
+    # لو كتالوج المخطط متاح نعرف التوليفة الصحيحة مباشرة بدل التجريب
+    cols = schema.columns(DEFAULT_TABLE)
+    key = schema.resolve_column(DEFAULT_TABLE, key_options) if cols else None
+    if key:
+        key_options = [key]
+        select_options = [",".join([key] + [c for c in ("username", "name") if c in cols])]
 
     for key in key_options:
         for sel in select_options:
@@ -186,15 +188,27 @@ def top5_clients_week() -> List[Dict[str, Any]]:
     أفضل 5 عملاء خلال 7 أيام: لكل مستخدم مجموع الشحن (amount>0) والصرف (amount<0) من جدول transactions.
     لا نفترض وجود أعمدة اسم محددة؛ نستعمل username أو name إن توفّرا وإلا نعرض معرفًا افتراضيًا.
     """
-    since = datetime.now(timezone.utc) - timedelta(days=7)
-    tx = (
-        get_table(TRANSACTION_TABLE)
-        .select("user_id, amount, timestamp")
-        .gte("timestamp", since.isoformat())
-        .execute()
-    )
-    data = tx.data or []
     agg: Dict[int, Dict[str,int]] = {}
+    # من التجميعات اليومية: user_in/user_out لكل مستخدم (لا تضيع بعد تنظيف transactions)
+    per_user = rollups.totals(("user_in", "user_out"), start=rollups.since_day(7), by_dim=True)
+    if per_user is not None:
+        for (metric, dim), (value, _count) in per_user.items():
+            try:
+                uid = int(dim)
+            except Exception:
+                continue
+            a = agg.setdefault(uid, {"deposits":0,"spend":0})
+            a["deposits" if metric == "user_in" else "spend"] += value
+        data = []
+    else:
+        since = datetime.now(timezone.utc) - timedelta(days=7)
+        tx = (
+            get_table(TRANSACTION_TABLE)
+            .select("user_id, amount, timestamp")
+            .gte("timestamp", since.isoformat())
+            .execute()
+        )
+        data = tx.data or []
     for r in data:
         try:
             uid = int(r.get("user_id") or 0)
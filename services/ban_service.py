@@ -1,36 +1,184 @@
 # -*- coding: utf-8 -*-
 # services/ban_service.py — حظر/فكّ الحظر + فحص الحالة
+#
+# فهرس الحظر في الذاكرة: {user_id: (banned_until أو None, reason)} يُحمّل عند الإقلاع
+# (start_ban_index) ويُحدَّث مباشرة من ban_user/unban_user؛ Timer يُسقط الحظر المؤقت عند
+# banned_until، وإعادة تحميل دورية كل BAN_INDEX_REFRESH ثانية لتعديلات من خارج هذه النسخة.
+# BanMiddleware يفحص الفهرس قبل أي هاندلر أو تحميل حالة ويُسقط تحديثات المحظورين
+# (بعد بوابة الإقلاع، والبوابة تنتظر التحميل الأول عبر wait_ban_index).
+# خطوات next_step لا تمر بالـ Middleware في telebot: عند ظهور محظور جديد (ban_user أو
+# تحميل دوري) تُمسح خطواته المعلّقة فلا يُكمل رحلة بدأها قبل الحظر.
 from __future__ import annotations
+import logging
+import os
+import threading
+import time
 from datetime import datetime, timezone
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 from database.db import get_table
 
 TABLE = "banned_users"
 
+BAN_INDEX_REFRESH = float(os.getenv("BAN_INDEX_REFRESH", "300") or 300)
+BAN_NOTICE_INTERVAL = float(os.getenv("BAN_NOTICE_INTERVAL", "3600") or 3600)
+
+_index: Dict[int, Tuple[Optional[datetime], Optional[str], Optional[str]]] = {}  # uid -> (until, until_iso, reason)
+_index_loaded = False
+_index_lock = threading.Lock()
+_fetch_seq = 0
+_published_seq = 0
+_expiry_timer: Optional[threading.Timer] = None
+_refresher_started = False
+_first_load = threading.Event()   # اكتملت أول محاولة تحميل (نجحت أو فشلت)
+_bot = None                       # يضبطه BanMiddleware: لمسح خطوات next_step للمحظورين
+
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
-def is_banned(user_id: int) -> Tuple[bool, Optional[str], Optional[str]]:
-    """يرجع (محظور؟, banned_until_iso or None, reason)"""
+def _parse_until(until) -> Optional[datetime]:
+    if not until:
+        return None
     try:
-        res = get_table(TABLE).select("reason, banned_until").eq("user_id", int(user_id)).limit(1).execute()
-        row = (getattr(res, "data", None) or [None])[0]
-        if not row:
-            return (False, None, None)
-        until = row.get("banned_until")
-        if until:
-            try:
-                # Supabase يرجع توقيت ISO — نقارنه الآن
-                dt = datetime.fromisoformat(until.replace("Z","+00:00"))
-                if dt <= _now_utc():
-                    # انتهى الحظر — اعتبره غير محظور (يمكن تنظيف السجل لاحقًا)
-                    return (False, None, None)
-            except Exception:
-                pass
-        return (True, until, row.get("reason"))
+        dt = datetime.fromisoformat(str(until).replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
     except Exception:
-        # في حال فشل الاستعلام، لا نمنع المستخدم (سلوك متسامح)
+        return None
+
+# ────────────────────────────────────────────────────────────
+# الفهرس
+# ────────────────────────────────────────────────────────────
+def _fetch_all() -> Dict[int, Tuple[Optional[datetime], Optional[str], Optional[str]]]:
+    out: Dict[int, Tuple[Optional[datetime], Optional[str], Optional[str]]] = {}
+    page, offset = 1000, 0
+    while True:
+        res = (
+            get_table(TABLE)
+            .select("user_id, reason, banned_until")
+            .order("user_id")
+            .range(offset, offset + page - 1)
+            .execute()
+        )
+        rows = getattr(res, "data", None) or []
+        for r in rows:
+            until = r.get("banned_until")
+            out[int(r["user_id"])] = (_parse_until(until), until, r.get("reason"))
+        if len(rows) < page:
+            return out
+        offset += page
+
+def _schedule_expiry() -> None:
+    """يُستدعى تحت _index_lock: يوقظ الفهرس عند أقرب banned_until."""
+    global _expiry_timer
+    if _expiry_timer is not None:
+        _expiry_timer.cancel()
+        _expiry_timer = None
+    soonest = min((u for u, _iso, _r in _index.values() if u is not None), default=None)
+    if soonest is None:
+        return
+    delay = max(0.05, (soonest - _now_utc()).total_seconds() + 0.05)
+    _expiry_timer = threading.Timer(delay, _expire_due)
+    _expiry_timer.daemon = True
+    _expiry_timer.start()
+
+def _expire_due() -> None:
+    global _index
+    now = _now_utc()
+    with _index_lock:
+        nxt = {uid: v for uid, v in _index.items() if v[0] is None or v[0] > now}
+        if len(nxt) != len(_index):
+            _index = nxt
+        _schedule_expiry()
+
+def reload_ban_index() -> bool:
+    """تحميل banned_users كاملًا. False عند الفشل (يبقى الفهرس السابق)."""
+    global _index, _index_loaded, _fetch_seq, _published_seq
+    with _index_lock:
+        _fetch_seq += 1
+        seq = _fetch_seq
+    try:
+        fresh = _fetch_all()
+    except Exception as e:
+        logging.warning("[ban] index reload failed: %s", e)
+        _first_load.set()  # لا نحبس البوابة؛ التحميل الدوري يعيد المحاولة
+        return False
+    now = _now_utc()
+    with _index_lock:
+        if seq < _published_seq:
+            _first_load.set()
+            return False
+        _published_seq = seq
+        prev = _index
+        _index = {uid: v for uid, v in fresh.items() if v[0] is None or v[0] > now}
+        _index_loaded = True
+        _schedule_expiry()
+        newly = [uid for uid in _index if uid not in prev]
+    _first_load.set()
+    for uid in newly:
+        _clear_steps(uid)
+    return True
+
+def wait_ban_index(timeout: float) -> bool:
+    """ينتظر أول تحميل للفهرس (بوابة الإقلاع). False عند انتهاء المهلة."""
+    return _first_load.wait(timeout)
+
+def _clear_steps(user_id: int) -> None:
+    """يمسح خطوات register_next_step_handler المعلّقة للمستخدم (محادثته الخاصة = user_id)."""
+    if _bot is None:
+        return
+    try:
+        _bot.clear_step_handler_by_chat_id(int(user_id))
+    except Exception as e:
+        logging.warning("[ban] clearing next-step handlers for %s failed: %s", user_id, e)
+
+def _publish(user_id: int, entry) -> None:
+    """تعديل محلي فوري (copy-on-write)؛ entry=None = فكّ الحظر."""
+    global _index, _published_seq
+    with _index_lock:
+        nxt = dict(_index)
+        if entry is None:
+            nxt.pop(int(user_id), None)
+        else:
+            nxt[int(user_id)] = entry
+        _index = nxt
+        # أي تحميل بدأ قبل هذا التعديل لا يُنشر فوقه
+        _published_seq = _fetch_seq + 1
+        _schedule_expiry()
+
+def _refresh_tick() -> None:
+    try:
+        reload_ban_index()
+    finally:
+        t = threading.Timer(BAN_INDEX_REFRESH, _refresh_tick)
+        t.daemon = True
+        t.start()
+
+def start_ban_index() -> None:
+    """تحميل أولي + تحديث خلفي دوري (آمن للاستدعاء أكثر من مرة)."""
+    global _refresher_started
+    with _index_lock:
+        if _refresher_started:
+            return
+        _refresher_started = True
+    reload_ban_index()
+    t = threading.Timer(BAN_INDEX_REFRESH, _refresh_tick)
+    t.daemon = True
+    t.start()
+
+# ────────────────────────────────────────────────────────────
+# الواجهة
+# ────────────────────────────────────────────────────────────
+def is_banned(user_id: int) -> Tuple[bool, Optional[str], Optional[str]]:
+    """يرجع (محظور؟, banned_until_iso or None, reason) — من الفهرس بدون قاعدة."""
+    entry = _index.get(int(user_id))
+    if entry is None:
+        # قبل اكتمال التحميل الأول: لا نمنع المستخدم (سلوك متسامح)
+        return (False, None, None)
+    until, until_iso, reason = entry
+    if until is not None and until <= _now_utc():
+        # انتهى الحظر — الـ Timer يزيله من الفهرس
         return (False, None, None)
+    return (True, until_iso, reason)
 
 def ban_user(user_id: int, by_admin: int, reason: str, banned_until_iso: Optional[str] = None):
     payload = {
@@ -41,8 +189,72 @@ def ban_user(user_id: int, by_admin: int, reason: str, banned_until_iso: Optiona
         "created_at": _now_utc().isoformat(),
     }
     # upsert على user_id
-    return get_table(TABLE).upsert(payload, on_conflict="user_id").execute()
+    res = get_table(TABLE).upsert(payload, on_conflict="user_id").execute()
+    _publish(user_id, (_parse_until(banned_until_iso), banned_until_iso, reason or ""))
+    _clear_steps(user_id)
+    return res
 
 def unban_user(user_id: int, by_admin: int):
     # إزالة السجل بالكامل
-    return get_table(TABLE).delete().eq("user_id", int(user_id)).execute()
+    res = get_table(TABLE).delete().eq("user_id", int(user_id)).execute()
+    _publish(user_id, None)
+    return res
+
+# ────────────────────────────────────────────────────────────
+# Middleware: يُسجَّل قبل StateSessionMiddleware
+# ────────────────────────────────────────────────────────────
+_last_notice: Dict[int, float] = {}
+
+def _update_user_id(update) -> Optional[int]:
+    u = getattr(update, "from_user", None) or getattr(update, "user", None)
+    uid = getattr(u, "id", None)
+    return int(uid) if uid is not None else None
+
+class BanMiddleware(BaseMiddleware):
+    """يُسقط تحديثات المحظورين قبل أي هاندلر أو تحميل حالة (مع تنبيه واحد كل BAN_NOTICE_INTERVAL)."""
+
+    def __init__(self, bot=None, exempt=()):
+        super().__init__()
+        self.update_types = [
+            "message", "edited_message", "callback_query", "inline_query",
+            "chosen_inline_result", "shipping_query", "pre_checkout_query",
+            "poll_answer", "my_chat_member", "chat_join_request",
+        ]
+        self.bot = bot
+        self.exempt = {int(x) for x in exempt}
+        if bot is not None:
+            global _bot
+            _bot = bot
+
+    def pre_process(self, update, data):
+        if not _index:
+            return None
+        uid = _update_user_id(update)
+        if uid is None or uid in self.exempt:
+            return None
+        banned, until_iso, _reason = is_banned(uid)
+        if not banned:
+            return None
+        self._notice(update, uid, until_iso)
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+    def _notice(self, update, uid: int, until_iso: Optional[str]) -> None:
+        if self.bot is None:
+            return
+        now = time.monotonic()
+        if now - _last_notice.get(uid, -BAN_NOTICE_INTERVAL) < BAN_NOTICE_INTERVAL:
+            return
+        _last_notice[uid] = now
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        if chat is None or getattr(chat, "type", "private") != "private":
+            return
+        text = "🚫 حسابك محظور من استخدام البوت."
+        if until_iso:
+            text += f"\nحتى: {until_iso}"
+        try:
+            self.bot.send_message(chat.id, text)
+        except Exception:
+            pass
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# services/broadcast_service.py — حملات بث جماعي في الخلفية (قابلة للإيقاف/الاستئناف/الإلغاء)
+"""
+بديل حلقات الإرسال داخل هاندلرات الأدمن:
+  * create_campaign(...) تحفظ الحملة + صف لكل مستلم (broadcast_recipients) ثم ترجع فورًا.
+  * عامل خلفي واحد يرسل المستلمين المعلّقين على دفعات وبالتوازي عبر
+    services/telegram_sender (أقصى معدّل يسمح به تيليغرام + retry_after).
+  * نتيجة كل مستلم تُسجّل (sent/blocked/deactivated/failed)، ومن حظر البوت يُضاف
+    إلى bot_blocked_users ويُستثنى من الحملات القادمة.
+  * رسالة تقدّم للأدمن تُحدَّث دوريًا مع أزرار إيقاف/استئناف/إلغاء.
+  * بعد إعادة تشغيل البوت تُستأنف الحملات الجارية من حيث توقفت (المعلّق فقط).
+"""
+from __future__ import annotations
+import html
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from telebot import types
+
+from database.db import get_table
+from services.telegram_sender import call_limited, retry_after_of, is_permanent_error
+
+CAMPAIGNS_TABLE = "broadcast_campaigns"
+RECIPIENTS_TABLE = "broadcast_recipients"
+BLOCKED_TABLE = "bot_blocked_users"
+
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100") or 100)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8") or 8)
+BROADCAST_PROGRESS_EVERY = float(os.getenv("BROADCAST_PROGRESS_EVERY", "5") or 5)
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", "120") or 120)
+
+NAME_PLACEHOLDER = "{name}"
+
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_wake = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+_pool: Optional[ThreadPoolExecutor] = None
+_bot = None
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _now_iso() -> str:
+    return _now().isoformat()
+
+
+# ================= المحظورون =================
+
+def blocked_user_ids() -> set:
+    out, offset, page = set(), 0, 1000
+    try:
+        while True:
+            r = get_table(BLOCKED_TABLE).select("user_id").range(offset, offset + page - 1).execute()
+            rows = r.data or []
+            out.update(int(x["user_id"]) for x in rows if x.get("user_id") is not None)
+            if len(rows) < page:
+                return out
+            offset += page
+    except Exception as e:
+        logging.warning("[broadcast] load blocked users failed: %s", e)
+        return out
+
+def mark_blocked(user_ids: Iterable[int], reason: str) -> None:
+    rows = [{"user_id": int(u), "reason": reason, "blocked_at": _now_iso()} for u in user_ids]
+    if not rows:
+        return
+    try:
+        get_table(BLOCKED_TABLE).upsert(rows, on_conflict="user_id").execute()
+    except Exception as e:
+        logging.warning("[broadcast] mark_blocked failed: %s", e)
+
+def unmark_blocked(user_id: int) -> None:
+    """المستخدم عاد للتفاعل (/start) → لم يعد حاظرًا للبوت."""
+    try:
+        get_table(BLOCKED_TABLE).delete().eq("user_id", int(user_id)).execute()
+    except Exception:
+        pass
+
+
+# ================= إنشاء/تحكم =================
+
+def create_campaign(bot, admin_chat_id: int, kind: str, payload: Dict[str, Any],
+                    recipients: Iterable[Tuple[int, Optional[str]]], created_by: Optional[int] = None) -> Optional[int]:
+    """
+    kind: 'message' (payload: text, parse_mode) أو 'poll' (payload: question, options).
+    النص قد يحتوي {name} ويُستبدل باسم المستلم (HTML-escaped).
+    يرجع رقم الحملة (الإرسال يبدأ في الخلفية). يرفع الاستثناء لو تعذّر إنشاؤها كاملة.
+    """
+    blocked = blocked_user_ids()
+    seen, recips = set(), []
+    for uid, nm in recipients:
+        uid = int(uid)
+        if uid in blocked or uid in seen:
+            continue
+        seen.add(uid)
+        recips.append((uid, nm))
+
+    r = get_table(CAMPAIGNS_TABLE).insert({
+        "created_by": created_by,
+        "kind": kind,
+        "payload": payload,
+        "status": "running",
+        "total": len(recips),
+        "progress_chat_id": admin_chat_id,
+    }).execute()
+    cid = int(r.data[0]["id"])
+    try:
+        for i in range(0, len(recips), 1000):
+            chunk = recips[i:i + 1000]
+            get_table(RECIPIENTS_TABLE).insert(
+                [{"campaign_id": cid, "user_id": u, "name": n} for u, n in chunk]
+            ).execute()
+    except Exception:
+        # حملة نصف مملوءة (total خاطئ) لا تُترك للعامل: تُحذف (المستلمون on delete cascade)
+        try:
+            get_table(CAMPAIGNS_TABLE).delete().eq("id", cid).execute()
+        except Exception as e:
+            logging.warning("[broadcast] cleanup of campaign #%s failed, cancelling it: %s", cid, e)
+            try:
+                get_table(CAMPAIGNS_TABLE).update({"status": "cancelled", "finished_at": _now_iso()}).eq("id", cid).execute()
+            except Exception:
+                pass
+        raise
+
+    try:
+        msg = bot.send_message(admin_chat_id, _progress_text(_load_campaign(cid)), parse_mode="HTML",
+                               reply_markup=_controls_kb(cid, "running"))
+        get_table(CAMPAIGNS_TABLE).update({"progress_message_id": msg.message_id}).eq("id", cid).execute()
+    except Exception as e:
+        logging.warning("[broadcast] progress message failed: %s", e)
+
+    start_broadcast_worker(bot)
+    _wake.set()
+    return cid
+
+def set_status(campaign_id: int, status: str) -> bool:
+    """pause/resume/cancel من الأدمن. الحملات المنتهية لا تتغير."""
+    try:
+        r = (
+            get_table(CAMPAIGNS_TABLE)
+            .update({"status": status, "updated_at": _now_iso(),
+                     **({"finished_at": _now_iso()} if status == "cancelled" else {})})
+            .eq("id", int(campaign_id))
+            .in_("status", ["running", "paused"])
+            .execute()
+        )
+        ok = bool(r.data)
+    except Exception as e:
+        logging.warning("[broadcast] set_status(%s, %s) failed: %s", campaign_id, status, e)
+        return False
+    if ok:
+        _wake.set()
+        _refresh_progress(int(campaign_id))
+    return ok
+
+
+# ================= عرض التقدّم =================
+
+_STATUS_AR = {"running": "⏳ جارٍ", "paused": "⏸️ موقوف مؤقتًا", "cancelled": "🛑 أُلغي", "done": "✅ اكتمل"}
+
+def _load_campaign(cid: int) -> Dict[str, Any]:
+    r = get_table(CAMPAIGNS_TABLE).select("*").eq("id", cid).limit(1).execute()
+    return (r.data or [{}])[0]
+
+def _progress_text(c: Dict[str, Any]) -> str:
+    total = int(c.get("total") or 0)
+    done = sum(int(c.get(k) or 0) for k in ("sent", "blocked", "deactivated", "failed"))
+    pct = int(done * 100 / total) if total else 100
+    return (
+        f"📣 <b>حملة بث #{c.get('id')}</b> — {_STATUS_AR.get(c.get('status'), c.get('status'))}\n"
+        f"التقدم: <b>{done}/{total}</b> ({pct}%)\n"
+        f"✅ وصلت: {int(c.get('sent') or 0)}\n"
+        f"🚫 حظروا البوت: {int(c.get('blocked') or 0)}\n"
+        f"👻 حسابات معطلة: {int(c.get('deactivated') or 0)}\n"
+        f"⚠️ فشل: {int(c.get('failed') or 0)}"
+    )
+
+def _controls_kb(cid: int, status: str) -> Optional[types.InlineKeyboardMarkup]:
+    if status not in ("running", "paused"):
+        return None
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if status == "running":
+        kb.add(types.InlineKeyboardButton("⏸️ إيقاف مؤقت", callback_data=f"bcast:pause:{cid}"))
+    else:
+        kb.add(types.InlineKeyboardButton("▶️ استئناف", callback_data=f"bcast:resume:{cid}"))
+    kb.add(types.InlineKeyboardButton("🛑 إلغاء", callback_data=f"bcast:cancel:{cid}"))
+    return kb
+
+def _refresh_progress(cid: int, c: Optional[Dict[str, Any]] = None) -> None:
+    if _bot is None:
+        return
+    try:
+        c = c or _load_campaign(cid)
+        if not c.get("progress_chat_id") or not c.get("progress_message_id"):
+            return
+        _bot.edit_message_text(
+            _progress_text(c),
+            chat_id=c["progress_chat_id"],
+            message_id=c["progress_message_id"],
+            parse_mode="HTML",
+            reply_markup=_controls_kb(cid, c.get("status")),
+        )
+    except Exception as e:
+        if "message is not modified" not in str(e):
+            logging.debug("[broadcast] progress edit failed: %s", e)
+
+
+# ================= الإرسال =================
+
+def _classify(exc: Exception) -> str:
+    desc = str(getattr(exc, "description", "") or exc).lower()
+    if "deactivated" in desc:
+        return "deactivated"
+    if "blocked" in desc or getattr(exc, "error_code", None) == 403:
+        return "blocked"
+    return "failed"
+
+def _send_to(kind: str, payload: Dict[str, Any], uid: int, name: Optional[str]) -> Tuple[str, Optional[str], Optional[float]]:
+    """يرجع (status, error, retry_after)؛ retry_after != None يعني أعد المحاولة لاحقًا (يبقى pending)."""
+    try:
+        if kind == "poll":
+            call_limited(_bot.send_poll, uid, question=payload["question"], options=payload["options"],
+                         is_anonymous=True, allows_multiple_answers=False)
+        else:
+            text = payload.get("text") or ""
+            if NAME_PLACEHOLDER in text:
+                text = text.replace(NAME_PLACEHOLDER, html.escape(name or "") or "صديقنا")
+            call_limited(_bot.send_message, uid, text, parse_mode=payload.get("parse_mode") or "HTML")
+        return "sent", None, None
+    except Exception as e:
+        ra = retry_after_of(e)
+        if ra is not None:
+            return "pending", str(e)[:300], ra
+        if is_permanent_error(e):
+            return _classify(e), str(e)[:300], None
+        return "failed", str(e)[:300], None
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=max(1, BROADCAST_CONCURRENCY), thread_name_prefix="broadcast")
+    return _pool
+
+def _acquire(cid: int) -> bool:
+    """مهلة حجز للحملة حتى لا تعمل عليها نسختان من البوت معًا."""
+    now = _now()
+    r = (
+        get_table(CAMPAIGNS_TABLE)
+        .update({"lease_owner": _WORKER_ID,
+                 "lease_until": (now + timedelta(seconds=BROADCAST_LEASE_SECONDS)).isoformat()})
+        .eq("id", cid)
+        .eq("status", "running")
+        .or_(f'lease_until.is.null,lease_until.lt."{now.isoformat()}",lease_owner.eq."{_WORKER_ID}"')
+        .execute()
+    )
+    return bool(r.data)
+
+def _run_batch(c: Dict[str, Any]) -> Tuple[int, Optional[float]]:
+    """يرسل دفعة معلّقين؛ يرجع (عدد المعالَجين، أطول retry_after إن وُجد)."""
+    cid = int(c["id"])
+    r = (
+        get_table(RECIPIENTS_TABLE)
+        .select("user_id,name")
+        .eq("campaign_id", cid)
+        .eq("status", "pending")
+        .order("user_id", desc=False)
+        .limit(BROADCAST_BATCH)
+        .execute()
+    )
+    rows = r.data or []
+    if not rows:
+        return 0, None
+
+    kind, payload = c.get("kind") or "message", c.get("payload") or {}
+    results = list(_get_pool().map(lambda row: (int(row["user_id"]),) + _send_to(kind, payload, int(row["user_id"]), row.get("name")), rows))
+
+    by_status: Dict[str, List[int]] = {}
+    retry_after = None
+    for uid, status, _err, ra in results:
+        if status == "pending":
+            retry_after = max(retry_after or 0.0, ra or 0.0)
+            continue
+        by_status.setdefault(status, []).append(uid)
+
+    now_iso = _now_iso()
+    for status, uids in by_status.items():
+        get_table(RECIPIENTS_TABLE).update({"status": status, "attempted_at": now_iso}) \
+            .eq("campaign_id", cid).in_("user_id", uids).execute()
+    if by_status.get("blocked"):
+        mark_blocked(by_status["blocked"], "blocked")
+    if by_status.get("deactivated"):
+        mark_blocked(by_status["deactivated"], "deactivated")
+
+    counts = {k: int(c.get(k) or 0) + len(by_status.get(k, [])) for k in ("sent", "blocked", "deactivated", "failed")}
+    get_table(CAMPAIGNS_TABLE).update({**counts, "updated_at": now_iso}).eq("id", cid).execute()
+    c.update(counts)
+    return sum(len(v) for v in by_status.values()), retry_after
+
+def _finish(c: Dict[str, Any]) -> None:
+    cid = int(c["id"])
+    get_table(CAMPAIGNS_TABLE).update({"status": "done", "finished_at": _now_iso(), "lease_owner": None, "lease_until": None}) \
+        .eq("id", cid).eq("status", "running").execute()
+    c["status"] = "done"
+    _refresh_progress(cid, c)
+
+def _process_campaign(cid: int) -> None:
+    if not _acquire(cid):
+        return
+    last_progress = 0.0
+    lease_renewed = time.monotonic()
+    while True:
+        c = _load_campaign(cid)
+        if c.get("status") != "running":
+            _refresh_progress(cid, c)
+            return
+        n, retry_after = _run_batch(c)
+        if n == 0 and retry_after is None:
+            _finish(c)
+            return
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_EVERY:
+            _refresh_progress(cid, c)
+            last_progress = time.monotonic()
+        if time.monotonic() - lease_renewed >= BROADCAST_LEASE_SECONDS / 3:
+            if not _acquire(cid):
+                return
+            lease_renewed = time.monotonic()
+        if retry_after:
+            time.sleep(min(retry_after, 60))
+
+def _worker_loop() -> None:
+    while True:
+        _wake.wait(timeout=30)
+        _wake.clear()
+        try:
+            r = get_table(CAMPAIGNS_TABLE).select("id").eq("status", "running").order("id", desc=False).execute()
+            for row in (r.data or []):
+                try:
+                    _process_campaign(int(row["id"]))
+                except Exception as e:
+                    logging.exception("[broadcast] campaign %s error: %s", row.get("id"), e)
+        except Exception as e:
+            logging.warning("[broadcast] worker tick error: %s", e)
+
+def start_broadcast_worker(bot) -> None:
+    """يشغّل عامل البث مرة واحدة ويستأنف أي حملة جارية من قبل إعادة التشغيل."""
+    global _started, _bot
+    with _start_lock:
+        _bot = bot
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_worker_loop, name="broadcast-worker", daemon=True).start()
+    _wake.set()
+
+
+# ================= هاندلر أزرار التحكم =================
+
+def register_controls(bot, is_admin) -> None:
+    @bot.callback_query_handler(func=lambda c: (c.data or "").startswith("bcast:") and is_admin(c.from_user.id))
+    def _bcast_control(c):
+        try:
+            _, action, cid = c.data.split(":", 2)
+            status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}[action]
+        except Exception:
+            return
+        ok = set_status(int(cid), status)
+        try:
+            bot.answer_callback_query(c.id, "✅ تم." if ok else "⚠️ الحملة منتهية.")
+        except Exception:
+            pass
@@ -1,13 +1,13 @@
 # services/cleanup_service.py
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import threading
-import time
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any, Optional
 import os
-from database.db import get_table, DEFAULT_TABLE
+from database.db import get_table, client, DEFAULT_TABLE
+from database import schema
 
 # الجداول التي تُحذف تلقائيًا بعد 14 ساعة (مع استثناء USERS_TABLE كليًا)
 USERS_TABLE = (os.getenv('SUPABASE_TABLE_NAME') or DEFAULT_TABLE or 'houssin363')
@@ -25,6 +25,7 @@ EPHEMERAL_TABLES: List[str] = [
     "internet_providers_purchases",
     "university_fees_purchases",
     "wholesale_purchases",
+    "purchase_history",
 
     # سجلات التحويل/المعاملات
     "transactions",
@@ -43,23 +44,7 @@ ACTIVITY_TABLES = {
     "purchases": "created_at",
 }
 
-# ====== منطق إعادة المحاولة (backoff خفيف) للتعامل مع أخطاء الشبكة/HTTP2 ======
-_RETRIES = 3
-_BACKOFF = 0.8  # ثوانٍ
-
-def _with_retry(op, *args, **kwargs):
-    for i in range(_RETRIES):
-        try:
-            return op(*args, **kwargs)
-        except Exception as e:
-            # أخطاء المخطط (كالعمود غير الموجود) ليست مؤقتة: لا نعيد المحاولة عليها
-            msg = str(e)
-            if "42703" in msg or "does not exist" in msg.lower():
-                raise
-            if i == _RETRIES - 1:
-                raise
-            logging.warning("cleanup_service retry %s/%s: %s", i + 1, _RETRIES, e)
-            time.sleep(_BACKOFF * (i + 1))
+# إعادة المحاولة عند أعطال الشبكة تتم مركزيًا في database/transport؛ أخطاء المخطط (42703) لا تُعاد.
 
 def _utc_now() -> datetime:
     return datetime.now(timezone.utc)
@@ -77,6 +62,10 @@ def _cutoff(hours: Optional[int] = None, days: Optional[int] = None) -> datetime
 
 # ====== فحص وجود العمود قبل التنفيذ لتجنب أخطاء 42703 ======
 def _column_exists(table_name: str, col: str) -> bool:
+    # من كتالوج المخطط في الذاكرة (بدون أي طلب)؛ الاستعلام الاختباري فقط لو الكتالوج غير متاح
+    known = schema.column_exists(table_name, col)
+    if known is not None:
+        return known
     try:
         # حدّ علوي صفر: استعلام خفيف فقط لاختبار وجود العمود
         get_table(table_name).select(col).limit(0).execute()
@@ -87,8 +76,8 @@ def _column_exists(table_name: str, col: str) -> bool:
             # عمود غير موجود: نُعلم المنادي كي يتخطّاه بدون أي إعادة محاولات
             return False
         # خطأ آخر مؤقت (شبكة/تحميل): لا نعرقل المنادي؛ نعتبره موجودًا ونترك
-        # عملية DELETE تتولّى إعادة المحاولة عبر _with_retry.
-        print(f"[cleanup] column probe {table_name}.{col} error (ignored): {e}")
+        # عملية DELETE تتولّى إعادة المحاولة عبر طبقة النقل.
+        logging.warning(f"[cleanup] column probe {table_name}.{col} error (ignored): {e}")
         return True
 
 def _safe_delete_by(table_name: str, col: str, cutoff_iso: str) -> tuple[bool, int]:
@@ -103,7 +92,7 @@ def _safe_delete_by(table_name: str, col: str, cutoff_iso: str) -> tuple[bool, i
     if not _column_exists(table_name, col):
         return False, 0
     try:
-        resp = _with_retry(get_table(table_name).delete().lte(col, cutoff_iso).execute)
+        resp = get_table(table_name).delete().lte(col, cutoff_iso).execute()
         data = getattr(resp, "data", None)
         count = len(data) if isinstance(data, list) else 0
         return True, count
@@ -111,9 +100,9 @@ def _safe_delete_by(table_name: str, col: str, cutoff_iso: str) -> tuple[bool, i
         msg = str(e)
         # أخطاء المخطط: نُشير للمنادي ليتحوّل إلى عمودٍ احتياطي دون تحذيرات متكررة
         if "42703" in msg or "does not exist" in msg.lower():
-            print(f"[cleanup] skip non-existent column {table_name}.{col}")
+            logging.info(f"[cleanup] skip non-existent column {table_name}.{col}")
             return False, 0
-        print(f"[cleanup] delete error on {table_name}.{col}: {e}")
+        logging.warning(f"[cleanup] delete error on {table_name}.{col}: {e}")
         return False, 0
 
 def _delete_with_fallbacks(table_name: str, cutoff_iso: str, now_iso: str) -> int:
@@ -130,6 +119,10 @@ def _delete_with_fallbacks(table_name: str, cutoff_iso: str, now_iso: str) -> in
         ("timestamp", cutoff_iso),
         ("updated_at", cutoff_iso),
     ]
+    cols = schema.columns(table_name)
+    if cols is not None:
+        # الكتالوج متاح: نعرف مسبقًا أي عمود سيُستخدم (ولا شيء لو الجدول غير موجود)
+        order = [(col, when) for col, when in order if col in cols][:1]
     for col, when in order:
         executed, count = _safe_delete_by(table_name, col, when)
         if executed:
@@ -146,39 +139,83 @@ def purge_ephemeral_after(hours: int = 14) -> Dict[str, int]:
         res[tbl] = max(count, 0)
     return res
 
+# ====== خمول المحافظ: دالة SQL واحدة (database/sql/0013_wallet_inactivity.sql) ======
+WALLET_DELETE_DAYS = 33
+INACTIVITY_BUCKETS = ("6d", "3d", "0d", "delete")
+_INACTIVITY_RPC = True
+
+def _is_missing_rpc(e: Exception) -> bool:
+    msg = str(e)
+    return "PGRST202" in msg or "42883" in msg or "Could not find the function" in msg
+
+def _inactivity_rows(delete_days: int, min_idle_days: int) -> Optional[List[Dict[str, Any]]]:
+    """صفوف wallet_inactivity، أو None لو الدالة غير منشأة (→ المسار القديم)."""
+    global _INACTIVITY_RPC
+    if not _INACTIVITY_RPC:
+        return None
+    try:
+        r = client().rpc("wallet_inactivity", {
+            "p_users_table": USERS_TABLE,
+            "p_delete_days": int(delete_days),
+            "p_min_idle_days": int(min_idle_days),
+        }).execute()
+        return r.data or []
+    except Exception as e:
+        if not _is_missing_rpc(e):
+            raise
+        _INACTIVITY_RPC = False
+        logging.warning("[cleanup] wallet_inactivity not installed; using per-user probes")
+        return None
+
+def inactivity_buckets(delete_days: int = WALLET_DELETE_DAYS) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    كل المحافظ الخاملة مصنّفة في شرائح التحذير بمرور واحد:
+      {"6d": [...], "3d": [...], "0d": [...], "delete": [...]}  (كل عنصر فيه user_id, last_activity, idle_days)
+    """
+    out: Dict[str, List[Dict[str, Any]]] = {b: [] for b in INACTIVITY_BUCKETS}
+    rows = _inactivity_rows(delete_days, delete_days - 6)
+    if rows is None:
+        # المسار القديم: مسح لكل حد (أبطأ بكثير)
+        seen = set()
+        for bucket, days in (("delete", delete_days), ("0d", delete_days - 1), ("3d", delete_days - 3), ("6d", delete_days - 6)):
+            for r in _legacy_preview_inactive(days):
+                uid = r.get("user_id")
+                if uid is not None and uid not in seen:
+                    seen.add(uid)
+                    out[bucket].append(r)
+        return out
+    for r in rows:
+        b = r.get("bucket")
+        if b in out:
+            out[b].append(r)
+    return out
+
 def _has_activity_since(user_id: int, since_iso: str) -> bool:
     for tbl, col in ACTIVITY_TABLES.items():
         # إذا كان عمود النشاط غير موجود في الجدول، نتخطّاه
         if not _column_exists(tbl, col):
             continue
         try:
-            r = _with_retry(
-                get_table(tbl).select("id").eq("user_id", user_id).gte(col, since_iso).limit(1).execute
-            )
+            r = get_table(tbl).select("id").eq("user_id", user_id).gte(col, since_iso).limit(1).execute()
             if getattr(r, "data", None):
                 return True
         except Exception as e:
-            print(f"[cleanup] activity probe error {tbl}.{col} for {user_id}: {e}")
+            logging.warning(f"[cleanup] activity probe error {tbl}.{col} for {user_id}: {e}")
             continue
     return False
 
-def preview_inactive_users(days: int = 33, limit: int = 100_000) -> List[Dict[str, Any]]:
-    """إظهار المحافظ الخاملة المرشحة للحذف بعد X يوم (لا يحذف فعليًا)."""
+def _legacy_preview_inactive(days: int, limit: int = 100_000) -> List[Dict[str, Any]]:
     cutoff_iso = _iso(_cutoff(days=days))
     rows: List[Dict[str, Any]] = []
     try:
-        resp = _with_retry(
-            get_table(USERS_TABLE).select("user_id, updated_at, created_at").lte("updated_at", cutoff_iso).limit(limit).execute
-        )
+        resp = get_table(USERS_TABLE).select("user_id, updated_at, created_at").lte("updated_at", cutoff_iso).limit(limit).execute()
         rows = getattr(resp, "data", None) or []
     except Exception:
         try:
-            resp = _with_retry(
-                get_table(USERS_TABLE).select("user_id, created_at").lte("created_at", cutoff_iso).limit(limit).execute
-            )
+            resp = get_table(USERS_TABLE).select("user_id, created_at").lte("created_at", cutoff_iso).limit(limit).execute()
             rows = getattr(resp, "data", None) or []
         except Exception as e:
-            print(f"[cleanup] select USERS_TABLE failed: {e}")
+            logging.warning(f"[cleanup] select USERS_TABLE failed: {e}")
             return []
     out: List[Dict[str, Any]] = []
     for r in rows:
@@ -189,9 +226,18 @@ def preview_inactive_users(days: int = 33, limit: int = 100_000) -> List[Dict[st
             out.append(r)
     return out
 
-def delete_inactive_users(days: int = 33, batch_size: int = 500) -> List[int]:
-    """حذف فعلي لمحافظ USERS_TABLE الخاملة 33 يومًا بعد التحذيرات."""
-    candidates = preview_inactive_users(days=days)
+def preview_inactive_users(days: int = 33, limit: int = 100_000) -> List[Dict[str, Any]]:
+    """إظهار المحافظ الخاملة المرشحة للحذف بعد X يوم (لا يحذف فعليًا)."""
+    rows = _inactivity_rows(max(days, WALLET_DELETE_DAYS), days)
+    if rows is None:
+        return _legacy_preview_inactive(days, limit)
+    return rows[:limit]
+
+def delete_inactive_users(days: int = 33, batch_size: int = 500,
+                          candidates: Optional[List[Dict[str, Any]]] = None) -> List[int]:
+    """حذف فعلي لمحافظ USERS_TABLE الخاملة 33 يومًا بعد التحذيرات (candidates: شريحة delete محسوبة مسبقًا)."""
+    if candidates is None:
+        candidates = preview_inactive_users(days=days)
     ids = [int(r["user_id"]) for r in candidates if r.get("user_id") is not None]
     if not ids:
         return []
@@ -199,26 +245,26 @@ def delete_inactive_users(days: int = 33, batch_size: int = 500) -> List[int]:
     for i in range(0, len(ids), batch_size):
         chunk = ids[i:i+batch_size]
         try:
-            _with_retry(get_table(USERS_TABLE).delete().in_("user_id", chunk).execute)
+            get_table(USERS_TABLE).delete().in_("user_id", chunk).execute()
             deleted.extend(chunk)
         except Exception as e:
-            print(f"[cleanup] delete USERS_TABLE chunk failed: {e}")
+            logging.warning(f"[cleanup] delete USERS_TABLE chunk failed: {e}")
             continue
     return deleted
 
 def _housekeeping_tick(bot=None):
     try:
         purged = purge_ephemeral_after(hours=14)
-        print(f"[cleanup] purged (14h): {purged}")
+        logging.info(f"[cleanup] purged (14h): {purged}")
     except Exception as e:
-        print(f"[cleanup] purge_ephemeral_after error: {e}")
+        logging.warning(f"[cleanup] purge_ephemeral_after error: {e}")
 
     try:
         deleted = delete_inactive_users(days=33)
         if deleted:
-            print(f"[cleanup] deleted USERS_TABLE users: {len(deleted)}")
+            logging.info(f"[cleanup] deleted USERS_TABLE users: {len(deleted)}")
     except Exception as e:
-        print(f"[cleanup] delete_inactive_users error: {e}")
+        logging.warning(f"[cleanup] delete_inactive_users error: {e}")
 
 def schedule_housekeeping(bot=None, every_seconds: int = 3600):
     """يشغّل التنظيف كل ساعة بخيط منفصل."""
@@ -1,4 +1,5 @@
 # services/commands_setup.py
+from concurrent.futures import ThreadPoolExecutor
 from telebot import types
 
 def setup_bot_commands(bot, admins: list[int]):
@@ -6,8 +7,8 @@ def setup_bot_commands(bot, admins: list[int]):
     bot.set_my_commands([
         types.BotCommand('start', 'لبدء رحلتك في البوت'),
     ])
-    # أوامر خاصة لكل أدمن على حدة (تظهر في قائمة Menu لديه)
-    for aid in admins:
+    # أوامر خاصة لكل أدمن على حدة (تظهر في قائمة Menu لديه) — بالتوازي بدل طلب بعد طلب
+    def _set_admin(aid):
         try:
             bot.set_my_commands([
                 types.BotCommand('start', 'لبدء رحلتك في البوت'),
@@ -16,3 +17,6 @@ def setup_bot_commands(bot, admins: list[int]):
         except Exception:
             # تجاهل أي خطأ في ضبط أوامر خاصّة لعدم تعطيل البوت
             pass
+    if admins:
+        with ThreadPoolExecutor(max_workers=min(8, len(admins))) as ex:
+            list(ex.map(_set_admin, admins))
@@ -3,8 +3,11 @@ from __future__ import annotations
 from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta, timezone
 import logging
+import os
+import threading
 
 from database.db import get_table
+from services import rollup_service as rollups
 
 # محاولة استخدام ساعة المشروع، وإلا فـ fallback
 try:
@@ -94,6 +97,7 @@ def create_discount(scope: str,
         row["meta"] = meta
 
     res = get_table(DISCOUNTS_TABLE).insert(row).execute()
+    invalidate_discounts()
     return res.data[0] if hasattr(res, "data") and res.data else None
 
 
@@ -103,6 +107,7 @@ def end_discount_now(did: str) -> bool:
         get_table(DISCOUNTS_TABLE).update(
             {"active": False, "ends_at": _now().isoformat()}
         ).eq("id", did).execute()
+        invalidate_discounts()
         return True
     except Exception as e:
         logging.exception("[discounts] end now failed: %s", e)
@@ -112,6 +117,7 @@ def end_discount_now(did: str) -> bool:
 def delete_discount(did: str) -> bool:
     try:
         get_table(DISCOUNTS_TABLE).delete().eq("id", did).execute()
+        invalidate_discounts()
         return True
     except Exception as e:
         logging.exception("[discounts] delete failed: %s", e)
@@ -121,6 +127,7 @@ def delete_discount(did: str) -> bool:
 def set_discount_active(did: str, active: bool) -> bool:
     try:
         get_table(DISCOUNTS_TABLE).update({"active": bool(active)}).eq("id", did).execute()
+        invalidate_discounts()
         return True
     except Exception as e:
         logging.exception("[discounts] toggle failed: %s", e)
@@ -138,58 +145,153 @@ def _time_window_filter(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
             ok.append(r)
     return ok
 
+# ==============================
+# فهرس الخصومات في الذاكرة
+# ==============================
+# الخصومات الفعّالة تُحمَّل مرة وتُقسم: قائمة عامة + قاموس {user_id: [خصومات خاصة]}،
+# فمسار الشراء (عرض السعر/التأكيد) لا يلمس القاعدة. التحديث:
+#   * أي تعديل عبر دوال هذا الملف (إنشاء/إنهاء/تفعيل/حذف) يعيد التحميل فورًا؛
+#   * Timer يوقظ الفهرس عند أقرب starts_at/ends_at ليُسقط المنتهي (بدون قاعدة)؛
+#   * تحميل دوري كل DISCOUNT_INDEX_REFRESH ثانية لتعديلات نسخة أخرى أو من القاعدة مباشرة.
+DISCOUNT_INDEX_REFRESH = float(os.getenv("DISCOUNT_INDEX_REFRESH", "120") or 120)
+
+_idx_rows: List[Dict[str, Any]] = []          # كل الخصومات active=true غير المنتهية (مع المستقبلية)
+_idx_global: List[Dict[str, Any]] = []
+_idx_users: Dict[int, List[Dict[str, Any]]] = {}
+_idx_loaded = False
+_idx_lock = threading.Lock()
+_fetch_seq = 0        # رقم كل تحميل عند بدايته
+_published_seq = 0    # رقم آخر تحميل نُشر (التحميل الأقدم لا يغطي على الأحدث)
+_expiry_timer: Optional[threading.Timer] = None
+_refresher_started = False
+
+
+def _fetch_active() -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    page, offset = 1000, 0
+    while True:
+        res = (
+            get_table(DISCOUNTS_TABLE)
+            .select("*")
+            .eq("active", True)
+            .order("created_at", desc=False)
+            .range(offset, offset + page - 1)
+            .execute()
+        )
+        rows = getattr(res, "data", []) or []
+        out.extend(rows)
+        if len(rows) < page:
+            return out
+        offset += page
+
+def _rebuild_index(rows: List[Dict[str, Any]]) -> None:
+    """يبني الفهرس من rows للحظة الحالية ويجدول الإيقاظ التالي. يُستدعى تحت _idx_lock."""
+    global _idx_rows, _idx_global, _idx_users, _idx_loaded, _expiry_timer
+    now = _now()
+    keep: List[Dict[str, Any]] = []
+    glob: List[Dict[str, Any]] = []
+    users: Dict[int, List[Dict[str, Any]]] = {}
+    wake: Optional[datetime] = None
+    for r in rows:
+        st = _parse_dt(r.get("starts_at")) or now
+        en = _parse_dt(r.get("ends_at"))
+        if en is not None and en <= now:
+            continue
+        keep.append(r)
+        if en is not None and (wake is None or en < wake):
+            wake = en
+        if st > now:
+            if wake is None or st < wake:
+                wake = st
+            continue
+        sc = (r.get("scope") or "global").lower()
+        if sc == "global":
+            glob.append(r)
+        elif sc == "user":
+            try:
+                users.setdefault(int(r.get("user_id") or 0), []).append(r)
+            except Exception:
+                continue
+    # استبدال كامل للمراجع: القرّاء بلا أقفال يرون النسخة القديمة أو الجديدة كاملة
+    _idx_rows, _idx_global, _idx_users, _idx_loaded = keep, glob, users, True
+
+    if _expiry_timer is not None:
+        _expiry_timer.cancel()
+        _expiry_timer = None
+    if wake is not None:
+        delay = max(0.05, (wake - now).total_seconds() + 0.05)
+        _expiry_timer = threading.Timer(delay, _on_boundary)
+        _expiry_timer.daemon = True
+        _expiry_timer.start()
+
+def _on_boundary() -> None:
+    # بداية/نهاية خصم: إعادة بناء من الصفوف المحمّلة (لا حاجة للقاعدة)
+    with _idx_lock:
+        _rebuild_index(_idx_rows)
+
+def reload_discount_index() -> bool:
+    """تحميل الخصومات الفعّالة من القاعدة ونشرها. False عند الفشل (يبقى الفهرس السابق)."""
+    global _fetch_seq, _published_seq
+    with _idx_lock:
+        _fetch_seq += 1
+        seq = _fetch_seq
+    try:
+        rows = _fetch_active()
+    except Exception as e:
+        logging.warning("[discounts] index reload failed: %s", e)
+        return False
+    with _idx_lock:
+        if seq < _published_seq:
+            return False
+        _published_seq = seq
+        _rebuild_index(rows)
+    return True
+
+def invalidate_discounts() -> None:
+    """بعد أي تعديل على جدول الخصومات: إعادة تحميل فورية للفهرس."""
+    reload_discount_index()
+
+def _refresh_tick() -> None:
+    try:
+        reload_discount_index()
+    finally:
+        t = threading.Timer(DISCOUNT_INDEX_REFRESH, _refresh_tick)
+        t.daemon = True
+        t.start()
+
+def start_discount_index() -> None:
+    """تحميل أولي متزامن + تحديث خلفي دوري (آمن للاستدعاء أكثر من مرة)."""
+    global _refresher_started
+    with _idx_lock:
+        if _refresher_started:
+            return
+        _refresher_started = True
+    reload_discount_index()
+    t = threading.Timer(DISCOUNT_INDEX_REFRESH, _refresh_tick)
+    t.daemon = True
+    t.start()
+
 def _list_active_for_user(user_id: int):
     """
-    ترجّع كل الخصومات الفعّالة زمنيًا لهذا المستخدم (global + user) بدون تجميع.
+    ترجّع كل الخصومات الفعّالة زمنيًا لهذا المستخدم (global + user) بدون تجميع — من الفهرس.
     """
+    if not _refresher_started:
+        start_discount_index()
+    elif not _idx_loaded:
+        reload_discount_index()  # فشل التحميل الأول: نحاول مع كل طلب حتى ينجح
     try:
-        res = get_table(DISCOUNTS_TABLE).select("*").eq("active", True).execute()
-        rows = getattr(res, "data", []) or []
+        uid = int(user_id)
     except Exception:
-        rows = []
-
-    # فلترة زمنية: starts_at <= الآن و (ends_at is null أو > الآن)
-    rows = _time_window_filter(rows)
-
-    out = []
-    for r in rows:
-        sc = (r.get("scope") or "global").lower()
-        if sc == "global":
-            out.append(r)
-        elif sc == "user" and int(r.get("user_id") or 0) == int(user_id):
-            out.append(r)
-    return out
+        uid = 0
+    return _idx_global + _idx_users.get(uid, [])
 
 def get_active_for_user(user_id: int) -> Optional[Dict[str, Any]]:
     """
     يرجع أعلى خصم فعّال وغير منتهٍ للمستخدم (خاص أو عام).
     - لا يراكِم خصمين؛ نختار الأعلى فقط.
     """
-    try:
-        res = (
-            get_table(DISCOUNTS_TABLE)
-            .select("*")
-            .eq("active", True)
-            .execute()
-        )
-        rows: List[Dict[str, Any]] = getattr(res, "data", []) or []
-    except Exception as e:
-        logging.exception("[discounts] get_active_for_user failed: %s", e)
-        return None
-
-    rows = _time_window_filter(rows)
-
     best: Optional[Dict[str, Any]] = None
-    for r in rows:
-        sc = (r.get("scope") or "global").lower()
-        if sc == "global":
-            ok = True
-        elif sc == "user":
-            ok = int(r.get("user_id") or 0) == int(user_id)
-        else:
-            ok = False
-        if not ok:
-            continue
+    for r in _list_active_for_user(user_id):
         if (best is None) or (int(r.get("percent") or 0) > int(best.get("percent") or 0)):
             best = r
     return best
@@ -260,8 +362,14 @@ def record_discount_use(discount_id: str, user_id: int, amount_before: int, amou
 
 def discount_stats(days: int = 30) -> List[str]:
     """
-    يرجع نصوصًا تلخيصية بسيطة للاستخدام.
+    يرجع نصوصًا تلخيصية بسيطة للاستخدام (آخر days يومًا من التجميعات اليومية إن توفرت).
     """
+    agg = rollups.totals(("discount",), start=rollups.since_day(days))
+    if agg is not None:
+        saved, uses = agg.get("discount", (0, 0))
+        if not uses:
+            return ["لا يوجد استخدامات."]
+        return [f"عدد الاستخدامات: {uses}", f"إجمالي التخفيض: {saved:,} ل.س"]
     try:
         res = get_table(USES_TABLE).select(
             "discount_id, user_id, amount_before, amount_after, created_at"
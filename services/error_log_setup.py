@@ -1,11 +1,123 @@
 # services/error_log_setup.py
+"""
+مسار السجلات:
+  * الجذر (root) يحمل QueueHandler واحدًا فقط: خيوط الهاندلرز/العمّال تضع السجل في طابور
+    وتعود فورًا؛ QueueListener في خيط منفصل يكتب إلى الملف (RotatingFileHandler) والشاشة.
+  * الملف بصيغة JSON سطرًا لكل حدث (LOG_JSON=0 للنص القديم) مع request_id و user_id
+    من سياق التحديث الحالي (LogContextMiddleware يضبطهما لكل تحديث تيليغرام).
+"""
+import atexit
+import contextvars
+import copy
+import json
 import logging, sys, threading, os
-from logging.handlers import RotatingFileHandler
+import queue
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+from telebot.handler_backends import BaseMiddleware
+
+LOG_JSON = os.getenv("LOG_JSON", "1") != "0"
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s - %(message)s"
 
 _installed = False
+_listener = None
+
+_request_id: contextvars.ContextVar = contextvars.ContextVar("log_request_id", default=None)
+_user_id: contextvars.ContextVar = contextvars.ContextVar("log_user_id", default=None)
+
+
+# ────────────────────────────────────────────────────────────
+# سياق التحديث (request_id / user_id)
+# ────────────────────────────────────────────────────────────
+def bind_context(user_id=None, request_id=None):
+    """يضبط سياق السجل للخيط الحالي؛ يرجع رموزًا لـ reset_context."""
+    return (_request_id.set(request_id or uuid.uuid4().hex[:12]), _user_id.set(user_id))
+
+def reset_context(tokens) -> None:
+    try:
+        _request_id.reset(tokens[0])
+        _user_id.reset(tokens[1])
+    except Exception:
+        _request_id.set(None)
+        _user_id.set(None)
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id.get()
+        if not hasattr(record, "user_id"):
+            record.user_id = _user_id.get()
+        return True
+
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        evt = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        rid = getattr(record, "request_id", None)
+        uid = getattr(record, "user_id", None)
+        if rid:
+            evt["request_id"] = rid
+        if uid is not None:
+            evt["user_id"] = uid
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            evt["exc"] = record.exc_text
+        return json.dumps(evt, ensure_ascii=False)
+
+
+class _ContextQueueHandler(QueueHandler):
+    """يدمج الرسالة ونص الاستثناء في خيط المنادي (السياق والمعاملات كما هي لحظة السجل)."""
+    _fmt = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.message = record.msg
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self._fmt.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """أول Middleware: كل سجل أثناء معالجة التحديث يحمل request_id و user_id."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = [
+            "message", "edited_message", "callback_query", "inline_query",
+            "chosen_inline_result", "shipping_query", "pre_checkout_query",
+            "poll_answer", "my_chat_member", "chat_member", "chat_join_request",
+        ]
+        self._tokens = threading.local()
+
+    def pre_process(self, update, data):
+        u = getattr(update, "from_user", None) or getattr(update, "user", None)
+        self._tokens.value = bind_context(user_id=getattr(u, "id", None))
+
+    def post_process(self, update, data, exception):
+        tokens = getattr(self._tokens, "value", None)
+        if tokens is not None:
+            reset_context(tokens)
+            self._tokens.value = None
+
+
+# ────────────────────────────────────────────────────────────
+# التثبيت
+# ────────────────────────────────────────────────────────────
 def install_global_error_logging(log_dir: str = "logs", log_file: str = "bot.log", level: int = logging.INFO):
-    global _installed
+    global _installed, _listener
     if _installed:
         return
     os.makedirs(log_dir, exist_ok=True)
@@ -13,17 +125,28 @@ def install_global_error_logging(log_dir: str = "logs", log_file: str = "bot.log
     root = logging.getLogger()
     root.setLevel(level)
 
-    if not any(isinstance(h, RotatingFileHandler) for h in root.handlers):
+    # المعالجات الفعلية (الموجودة من basicConfig + الملف) تنتقل خلف الطابور
+    targets = [h for h in root.handlers if not isinstance(h, QueueHandler)]
+    if not any(isinstance(h, RotatingFileHandler) for h in targets):
         fh = RotatingFileHandler(path, maxBytes=5*1024*1024, backupCount=3, encoding="utf-8")
         fh.setLevel(level)
-        fh.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s - %(message)s"))
-        root.addHandler(fh)
+        fh.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(TEXT_FORMAT))
+        targets.append(fh)
 
-    if not any(isinstance(h, logging.StreamHandler) for h in root.handlers):
+    if not any(type(h) is logging.StreamHandler for h in targets):
         sh = logging.StreamHandler()
         sh.setLevel(level)
-        sh.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s - %(message)s"))
-        root.addHandler(sh)
+        sh.setFormatter(logging.Formatter(TEXT_FORMAT))
+        targets.append(sh)
+
+    qh = _ContextQueueHandler(queue.SimpleQueue())
+    qh.addFilter(_ContextFilter())
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(qh)
+    _listener = QueueListener(qh.queue, *targets, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
 
     try:
         logging.getLogger("telebot").setLevel(logging.INFO)
@@ -1,9 +1,11 @@
 # services/feature_flags.py
 from __future__ import annotations
 import logging
+import os
 import re
+import threading
 import time
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from database.db import get_table
 
 FEATURES_TABLE = "features"
@@ -284,16 +286,21 @@ def ensure_feature(key: str, label: str, default_active: bool = True) -> bool:
     """
     يضمن وجود مفتاح مخصّص (منتج مفرد/باقة وحدات..). يرجّع True لو تم الإنشاء.
     """
+    cur = _current().get(key)
+    if cur is not None and cur[1] == label:
+        # موجود بنفس الاسم في اللقطة: لا حاجة لأي طلب (يُستدعى عند رسم كل لوحة)
+        return False
     try:
-        r = _tbl().select("key").eq("key", key).limit(1).execute()
-        if not getattr(r, "data", None):
+        r = _tbl().select("key,active").eq("key", key).limit(1).execute()
+        data = getattr(r, "data", None)
+        if not data:
             _tbl().insert({"key": key, "label": label, "active": bool(default_active)}).execute()
-            _cache_clear()
+            _publish({key: (bool(default_active), label)})
             return True
         else:
             # حدّث الاسم إن تغيّر
             _tbl().update({"label": label}).eq("key", key).execute()
-            _cache_clear()
+            _publish({key: (bool(data[0].get("active", True)), label)})
             return False
     except Exception as e:
         logging.exception("[features] ensure_feature failed (%s): %s", key, e)
@@ -319,13 +326,14 @@ def ensure_seed() -> int:
     """
     created = 0
     try:
-        # 1) زرع البذرة القياسية (الموحدة)
+        # 1) زرع البذرة القياسية (الموحدة) — مقارنة مع الجدول كاملًا بدل طلب لكل مفتاح
+        existing = _fetch_all()
         for k, label in FEATURES_SEED.items():
-            r = _tbl().select("key").eq("key", k).limit(1).execute()
-            if not getattr(r, "data", None):
+            cur = existing.get(k)
+            if cur is None:
                 _tbl().insert({"key": k, "label": label, "active": True}).execute()
                 created += 1
-            else:
+            elif cur[1] != label:
                 _tbl().update({"label": label}).eq("key", k).execute()
 
         # 2) نقل المفاتيح القديمة إلى الحديثة وحذف المكرر فقط
@@ -334,37 +342,98 @@ def ensure_seed() -> int:
             logging.info("[features] migrated legacy duplicates: %s", migrated)
 
         # 3) العناصر التفصيلية
+        reload_snapshot()
         created += _seed_known_details()
-
-        _cache_clear()
     except Exception as e:
         logging.exception("[features] ensure_seed failed: %s", e)
     return created
 
 # ==============================
-# كاش خفيف لقراءات الحالة
+# لقطة (snapshot) كاملة لجدول features
 # ==============================
-__CACHE_TTL = 3.0  # ثوانٍ
-__cache_map: Dict[str, bool] = {}
-__cache_ts: float = 0.0
-
-def _cache_ok() -> bool:
-    return (time.time() - __cache_ts) <= __CACHE_TTL
-
-def _cache_get(key: str, default: bool) -> bool:
-    if _cache_ok() and key in __cache_map:
-        return __cache_map[key]
-    return default
+# الجدول كله يُحمَّل كقاموس واحد {key: (active, label)} برقم إصدار، ويُستبدل
+# كاملًا عند كل تحديث (القرّاء يقرؤون المرجع الحالي بدون أقفال ولا قاعدة).
+# التحديث: خيط Timer خلفي كل FEATURE_FLAGS_REFRESH ثانية، وأي تعديل من الأدمن
+# يُنشر فورًا في اللقطة بدون انتظار الدورة التالية.
+FLAGS_REFRESH_SECONDS = float(os.getenv("FEATURE_FLAGS_REFRESH", "20") or 20)
+
+_snap: Dict[str, Tuple[bool, str]] = {}
+_snap_version: int = 0
+_snap_loaded_at: float = 0.0
+_snap_lock = threading.Lock()
+_refresher_started = False
+
+def _fetch_all() -> Dict[str, Tuple[bool, str]]:
+    out: Dict[str, Tuple[bool, str]] = {}
+    page, offset = 1000, 0
+    while True:
+        r = _tbl().select("key,label,active").order("key", desc=False).range(offset, offset + page - 1).execute()
+        rows = getattr(r, "data", None) or []
+        for row in rows:
+            out[row["key"]] = (bool(row.get("active", True)), str(row.get("label") or ""))
+        if len(rows) < page:
+            return out
+        offset += page
+
+def reload_snapshot() -> bool:
+    """يحمّل الجدول كاملًا وينشره كلقطة جديدة. يرجّع False عند الفشل (تبقى اللقطة السابقة)."""
+    global _snap, _snap_version, _snap_loaded_at
+    v0 = _snap_version
+    try:
+        fresh = _fetch_all()
+    except Exception as e:
+        logging.warning("[features] snapshot reload failed: %s", e)
+        return False
+    with _snap_lock:
+        if _snap_version != v0 and _snap_loaded_at:
+            # نُشر تعديل أثناء التحميل: نتجاهل هذه النتيجة ونأخذ الأحدث في الدورة التالية
+            return False
+        _snap = fresh
+        _snap_version += 1
+        _snap_loaded_at = time.time()
+    return True
 
-def _cache_put(key: str, value: bool):
-    global __cache_ts
-    if not _cache_ok():
-        __cache_map.clear()
-    __cache_map[key] = bool(value)
-    __cache_ts = time.time()
+def _publish(changes: Dict[str, Tuple[bool, str]]) -> None:
+    """نشر فوري لتعديلات محلية (copy-on-write) برفع رقم الإصدار."""
+    global _snap, _snap_version
+    with _snap_lock:
+        nxt = dict(_snap)
+        nxt.update(changes)
+        _snap = nxt
+        _snap_version += 1
+
+def _current() -> Dict[str, Tuple[bool, str]]:
+    if not _snap_loaded_at:
+        # أول استخدام فقط (لو لم يُشغَّل المحدِّث عند الإقلاع)
+        start_flags_refresher()
+    return _snap
+
+def snapshot_version() -> int:
+    return _snap_version
+
+def _refresh_tick():
+    try:
+        reload_snapshot()
+    finally:
+        t = threading.Timer(FLAGS_REFRESH_SECONDS, _refresh_tick)
+        t.daemon = True
+        t.start()
+
+def start_flags_refresher() -> None:
+    """تحميل أولي متزامن + تحديث خلفي دوري (آمن للاستدعاء أكثر من مرة)."""
+    global _refresher_started
+    with _snap_lock:
+        if _refresher_started:
+            return
+        _refresher_started = True
+    reload_snapshot()
+    t = threading.Timer(FLAGS_REFRESH_SECONDS, _refresh_tick)
+    t.daemon = True
+    t.start()
 
 def _cache_clear():
-    __cache_map.clear()
+    # توافق: أي تعديل خارجي غير معروف التفاصيل → إعادة تحميل كاملة في الخلفية
+    threading.Thread(target=reload_snapshot, daemon=True).start()
 
 # ==============================
 # استعلامات الحالة
@@ -377,31 +446,61 @@ def list_features() -> List[Dict[str, Any]]:
         logging.exception("[features] list_features failed: %s", e)
         return []
 
+def _published_rows(rows: List[Dict[str, Any]], active: bool) -> Dict[str, Tuple[bool, str]]:
+    """صفوف أعادها UPDATE فعلًا → مدخلات اللقطة (مفتاح غير موجود في الجدول لا يُنشر)."""
+    snap = _snap
+    out: Dict[str, Tuple[bool, str]] = {}
+    for r in rows:
+        k = r.get("key")
+        if not k:
+            continue
+        label = r.get("label") or (snap[k][1] if k in snap else k)
+        out[k] = (bool(r.get("active", active)), label)
+    return out
+
 def set_feature_active(key: str, active: bool) -> bool:
     try:
-        _tbl().update({"active": bool(active)}).eq("key", key).execute()
-        _cache_clear()
+        res = _tbl().update({"active": bool(active)}).eq("key", key).execute()
+        rows = getattr(res, "data", None) or []
+        if not rows:
+            logging.warning("[features] set_feature_active: no feature row for key %r", key)
+            return False
+        _publish(_published_rows(rows, active))
         return True
     except Exception as e:
         logging.exception("[features] set_feature_active failed: %s", e)
         return False
 
-def is_feature_enabled(key: str, default: bool = True) -> bool:
-    # جرّب الكاش أولاً
-    v = _cache_get(key, None)
-    if isinstance(v, bool):
-        return v
+def set_features_active(keys: List[str], active: bool) -> bool:
+    """تبديل جماعي (مثل «تفعيل/إيقاف الكل» لمجموعة) بطلب واحد ونشر واحد."""
+    keys = [k for k in keys if k]
+    if not keys:
+        return True
     try:
-        r = _tbl().select("active").eq("key", key).limit(1).execute()
-        data = getattr(r, "data", None)
-        if not data:
-            _cache_put(key, default)
-            return default
-        val = bool(data[0].get("active", default))
-        _cache_put(key, val)
-        return val
-    except Exception:
-        return default
+        res = _tbl().update({"active": bool(active)}).in_("key", keys).execute()
+        rows = getattr(res, "data", None) or []
+        missing = set(keys) - {r.get("key") for r in rows}
+        if missing:
+            logging.warning("[features] set_features_active: no feature rows for keys %s", sorted(missing))
+        if rows:
+            _publish(_published_rows(rows, active))
+        return bool(rows)
+    except Exception as e:
+        logging.exception("[features] set_features_active failed: %s", e)
+        return False
+
+def is_feature_enabled(key: str, default: bool = True) -> bool:
+    cur = _current().get(key)
+    return cur[0] if cur is not None else default
+
+def is_enabled_many(keys: List[str], default: bool = True) -> Dict[str, bool]:
+    """تقييم عدة مفاتيح من نفس اللقطة (مثلاً كل أزرار لوحة واحدة)."""
+    snap = _current()
+    out: Dict[str, bool] = {}
+    for k in keys:
+        cur = snap.get(k)
+        out[k] = cur[0] if cur is not None else default
+    return out
 
 # Aliases للتوافق مع أي كود يستدعي أسماء مختلفة
 def is_feature_active(key: str, default: bool = True) -> bool:
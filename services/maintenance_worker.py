@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 # services/maintenance_worker.py
 from __future__ import annotations
+import logging
 import threading
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Any, List
-from database.db import get_table
-from services.cleanup_service import purge_ephemeral_after, preview_inactive_users, delete_inactive_users
+from services.cleanup_service import purge_ephemeral_after, inactivity_buckets, delete_inactive_users
 from services.ads_service import purge_expired_ads  # ✅ جديد
-
-OUTBOX_TABLE = "notifications_outbox"
+from services.outbox_worker import enqueue_many
+from services.metrics import tick_timer
 
 def _now() -> datetime:
     return datetime.now(timezone.utc)
@@ -16,37 +16,6 @@ def _now() -> datetime:
 def _now_iso() -> str:
     return _now().isoformat()
 
-def _insert_outbox_if_absent(user_id: int, message: str, kind: str, when_iso: str):
-    """
-    يمنع التكرار لنفس (user_id, kind) إذا كانت رسالة بنفس النوع غير مرسلة بعد.
-    """
-    try:
-        exists = (
-            get_table(OUTBOX_TABLE)
-            .select("id")
-            .eq("user_id", user_id)
-            .eq("kind", kind)
-            .is_("sent_at", None)
-            .limit(1)
-            .execute()
-        )
-        if exists.data:
-            return
-    except Exception:
-        # لو الجدول لا يوجد، نتجاهل التنبيه بصمت
-        return
-    try:
-        get_table(OUTBOX_TABLE).insert({
-            "user_id": user_id,
-            "message": message,
-            "kind": kind,
-            "scheduled_at": when_iso,
-            "created_at": _now_iso(),
-            "parse_mode": "HTML",
-        }).execute()
-    except Exception as e:
-        print(f"[maintenance] insert outbox failed: {e}")
-
 def _warn_text(days_left: int) -> str:
     if days_left == 6:
         return (
@@ -70,52 +39,50 @@ def _warn_text(days_left: int) -> str:
         "سارع بتنفيذ أي عملية لتجديد المهلة (حتى عملية واحدة تكفي)."
     )
 
-def _process_wallet_warnings():
+_WARN_BUCKETS = (("0d", 0, "wallet_delete_0d"), ("3d", 3, "wallet_delete_3d"), ("6d", 6, "wallet_delete_6d"))
+
+def _process_wallet_warnings() -> List[Dict[str, Any]]:
     """
-    ينشئ تنبيهات 6 و3 واليوم الأخير للمحافظ الخاملة.
+    ينشئ تنبيهات 6 و3 واليوم الأخير للمحافظ الخاملة، ويرجع شريحة الحذف
+    (كلها من استعلام خمول واحد بدل ثلاث مسحات كاملة).
     """
-    # مرشحو اليوم الأخير (33 يوم خمول)
-    final_candidates = preview_inactive_users(days=33)
-    for r in final_candidates:
-        uid = int(r["user_id"])
-        _insert_outbox_if_absent(uid, _warn_text(0), "wallet_delete_0d", _now_iso())
-
-    # مرشحو 3 أيام (30 يوم خمول)
-    pre3 = preview_inactive_users(days=30)
-    for r in pre3:
-        uid = int(r["user_id"])
-        _insert_outbox_if_absent(uid, _warn_text(3), "wallet_delete_3d", _now_iso())
-
-    # مرشحو 6 أيام (27 يوم خمول)
-    pre6 = preview_inactive_users(days=27)
-    for r in pre6:
-        uid = int(r["user_id"])
-        _insert_outbox_if_absent(uid, _warn_text(6), "wallet_delete_6d", _now_iso())
+    buckets = inactivity_buckets()
+    now_iso = _now_iso()
+    entries = [
+        (int(r["user_id"]), kind, _warn_text(days_left), now_iso)
+        for bucket, days_left, kind in _WARN_BUCKETS
+        for r in (buckets.get(bucket) or [])
+    ]
+    if entries:
+        n = enqueue_many(entries)
+        logging.info(f"[maintenance] wallet warnings queued: {n}/{len(entries)}")
+    return buckets.get("delete") or []
 
 def _housekeeping_once(bot=None):
     try:
         # 1) تنظيف سجلات مؤقتة بعد 14 ساعة
         purged = purge_ephemeral_after(hours=14)
-        print(f"[maintenance] purged_14h: {purged}")
+        logging.info(f"[maintenance] purged_14h: {purged}")
         # ✅ 1.1) حذف إعلانات القناة المنتهية بعد 14 ساعة
         try:
             removed_ads = purge_expired_ads(hours_after=14)
             if removed_ads:
-                print(f"[maintenance] purged expired channel ads: {removed_ads}")
+                logging.info(f"[maintenance] purged expired channel ads: {removed_ads}")
         except Exception as e:
-            print(f"[maintenance] purge_expired_ads error: {e}")
+            logging.warning(f"[maintenance] purge_expired_ads error: {e}")
     except Exception as e:
-        print(f"[maintenance] purge_ephemeral_after error: {e}")
+        logging.warning(f"[maintenance] purge_ephemeral_after error: {e}")
 
+    to_delete = None
     try:
         # 2) إرسال تحذيرات 6/3/0 أيام
-        _process_wallet_warnings()
+        to_delete = _process_wallet_warnings()
     except Exception as e:
-        print(f"[maintenance] warn generation error: {e}")
+        logging.warning(f"[maintenance] warn generation error: {e}")
 
     try:
         # 3) حذف المحافظ الخاملة 33 يومًا (بغض النظر عن الرصيد/المحجوز)
-        deleted = delete_inactive_users(days=33)
+        deleted = delete_inactive_users(days=33, candidates=to_delete)
         if deleted:
             # أرسل إشعار "تم الحذف" (اختياري)
             msg = (
@@ -123,11 +90,11 @@ def _housekeeping_once(bot=None):
                 "بسبب عدم النشاط لمدة 33 يومًا بعد إرسال التحذيرات.\n"
                 "لا يمكن مراجعتنا بهذا الخصوص وفق سياسة الخدمة."
             )
-            for uid in deleted:
-                _insert_outbox_if_absent(int(uid), msg, "wallet_deleted", _now_iso())
-            print(f"[maintenance] deleted wallets: {len(deleted)}")
+            now_iso = _now_iso()
+            enqueue_many([(int(uid), "wallet_deleted", msg, now_iso) for uid in deleted])
+            logging.info(f"[maintenance] deleted wallets: {len(deleted)}")
     except Exception as e:
-        print(f"[maintenance] delete_inactive_users error: {e}")
+        logging.warning(f"[maintenance] delete_inactive_users error: {e}")
 
 def start_housekeeping(bot=None, every_seconds: int = 3600):
     """
@@ -137,7 +104,8 @@ def start_housekeeping(bot=None, every_seconds: int = 3600):
      - حذف المحافظ 33 يوم خمول
     """
     def loop():
-        _housekeeping_once(bot)
+        with tick_timer("housekeeping"):
+            _housekeeping_once(bot)
         threading.Timer(every_seconds, loop).start()
     # التشغيل الأول بعد دقيقة من الإقلاع
     threading.Timer(60, loop).start()
@@ -0,0 +1,134 @@
+# services/membership_cache.py
+"""
+كاش اشتراك المستخدمين في قناة الاشتراك الإجباري (get_chat_member):
+  * نتيجة موجبة تبقى MEMBERSHIP_TTL ثانية، والسالبة/الخطأ MEMBERSHIP_NEGATIVE_TTL فقط
+    (من اشترك للتو يُرى بسرعة).
+  * طلبات متزامنة لنفس (القناة، المستخدم) تنتظر نداءً واحدًا لتيليغرام.
+  * check_many: فحص دفعة — المخزَّن من الذاكرة والباقي بالتوازي. max_age يقيّد عمر القيمة
+    المقبولة (max_age=0 للتحقق الفعلي: إعادة فحص الإحالات لا تقبل «عضو» من قبل 15 دقيقة).
+  * bump_epoch: إبطال شامل عند تغيّر force_sub_epoch (system_service.force_sub_recheck عبر subscribe)
+    — أي قيمة من حقبة سابقة تُهمل.
+النداءات تمر عبر telegram_sender.call_limited (الحد العام فقط؛ ليست رسائل لمحادثة).
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from services.telegram_sender import call_limited
+from services import system_service
+
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", "900") or 900)
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "20") or 20)
+MEMBERSHIP_BULK_WORKERS = int(os.getenv("MEMBERSHIP_BULK_WORKERS", "6") or 6)
+_MAX_ENTRIES = 50000
+
+_OK_STATUSES = ("member", "administrator", "creator")
+
+# (chat, user_id) -> (is_member, checked_at, epoch)
+_cache: Dict[Tuple[str, int], Tuple[bool, float, int]] = {}
+# (chat, user_id) -> [Event, result]
+_inflight: Dict[Tuple[str, int], list] = {}
+_lock = threading.Lock()
+_epoch = 0
+
+
+def bump_epoch(epoch: Optional[int] = None) -> int:
+    """يبطل كل النتائج المخزنة (إعادة فحص الاشتراك للجميع)."""
+    global _epoch
+    with _lock:
+        _epoch = max(_epoch + 1, int(epoch or 0))
+        _cache.clear()
+        return _epoch
+
+
+system_service.subscribe(lambda _k, _old, new: bump_epoch(new), keys=("force_sub_epoch",))
+
+
+def forget(chat, user_id: int) -> None:
+    with _lock:
+        _cache.pop((str(chat), int(user_id)), None)
+
+
+def cached(chat, user_id: int, recheck_negative: bool = False, max_age: Optional[float] = None) -> Optional[bool]:
+    """القيمة من الذاكرة إن كانت صالحة (وأحدث من max_age ثانية إن حُدد)، وإلا None."""
+    hit = _cache.get((str(chat), int(user_id)))
+    if not hit:
+        return None
+    ok, at, ep = hit
+    if ep != _epoch:
+        return None
+    if max_age is not None and time.monotonic() - at >= max_age:
+        return None
+    if ok:
+        return True if time.monotonic() - at < MEMBERSHIP_TTL else None
+    if recheck_negative:
+        return None
+    return False if time.monotonic() - at < MEMBERSHIP_NEGATIVE_TTL else None
+
+
+def _fetch(bot, chat, user_id: int) -> bool:
+    try:
+        m = call_limited(bot.get_chat_member, None, chat, int(user_id))
+        return getattr(m, "status", None) in _OK_STATUSES
+    except Exception as e:
+        logging.warning("[membership] get_chat_member failed for %s: %s", user_id, e)
+        return False
+
+
+def is_member(bot, chat, user_id: int, recheck_negative: bool = False, max_age: Optional[float] = None) -> bool:
+    """
+    هل المستخدم مشترك في chat؟ recheck_negative=True لزر «تحققت/تم الاشتراك»:
+    النتيجة السالبة المخزنة لا تُستعمل (الموجبة تبقى من الذاكرة).
+    max_age: أقصى عمر مقبول للقيمة المخزنة (موجبة أو سالبة)؛ 0 = فحص فعلي دائمًا.
+    """
+    hit = cached(chat, user_id, recheck_negative, max_age)
+    if hit is not None:
+        return hit
+
+    key = (str(chat), int(user_id))
+    with _lock:
+        slot = _inflight.get(key)
+        owner = slot is None
+        if owner:
+            slot = [threading.Event(), False]
+            _inflight[key] = slot
+            epoch = _epoch
+    if not owner:
+        slot[0].wait(30)
+        return bool(slot[1])
+
+    result = False
+    try:
+        result = _fetch(bot, chat, user_id)
+    finally:
+        with _lock:
+            if epoch == _epoch:
+                if len(_cache) >= _MAX_ENTRIES:
+                    _cache.clear()
+                _cache[key] = (result, time.monotonic(), epoch)
+            _inflight.pop(key, None)
+        slot[1] = result
+        slot[0].set()
+    return result
+
+
+def check_many(bot, chat, user_ids: Iterable[int], max_age: Optional[float] = None) -> Dict[int, bool]:
+    """{user_id: is_member} لدفعة مستخدمين: الصالح (وأحدث من max_age) من الذاكرة والباقي بالتوازي."""
+    out: Dict[int, bool] = {}
+    missing = []
+    for uid in {int(u) for u in user_ids}:
+        hit = cached(chat, uid, max_age=max_age)
+        if hit is None:
+            missing.append(uid)
+        else:
+            out[uid] = hit
+    if len(missing) == 1:
+        out[missing[0]] = is_member(bot, chat, missing[0], max_age=max_age)
+    elif missing:
+        with ThreadPoolExecutor(max_workers=min(MEMBERSHIP_BULK_WORKERS, len(missing))) as ex:
+            for uid, ok in zip(missing, ex.map(lambda u: is_member(bot, chat, u, max_age=max_age), missing)):
+                out[uid] = ok
+    return out
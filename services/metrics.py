@@ -0,0 +1,327 @@
+# services/metrics.py
+"""
+مقاييس Prometheus (صيغة النص 0.0.4) بدون اعتماديات إضافية، تُقدَّم من الخادم الوهمي
+نفسه على /metrics مع /healthz:
+  * bot_handler_duration_seconds{handler}       : زمن كل هاندلر (instrument_handlers بعد التسجيل)
+  * supabase_request_duration_seconds{target,op}: من database/transport (لكل جدول/RPC)
+  * telegram_request_duration_seconds{method} + telegram_429_total{method}: تغليف apihelper._make_request
+  * queue_depth / queue_oldest_age_seconds{queue}: pending_requests و notifications_outbox
+    (خيط خلفي يستعلم كل METRICS_DB_TTL ثانية؛ الكشط يقرأ الذاكرة فقط)
+  * state_cache_hits_total / state_cache_misses_total: كاش services/state_service
+  * worker_tick_duration_seconds{worker}        : دورات ads/outbox/housekeeping
+"""
+import functools
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+METRICS_DB_TTL = float(os.getenv("METRICS_DB_TTL", "15") or 15)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_started_at = time.time()
+_lock = threading.Lock()
+# name -> {labels_tuple: [bucket_counts..., +Inf], sum, count}
+_hists: Dict[str, Dict[Tuple[Tuple[str, str], ...], list]] = {}
+_counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+_help: Dict[str, Tuple[str, str]] = {}
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def observe(name: str, seconds: float, labels: Optional[Dict[str, str]] = None, help_text: str = "") -> None:
+    key = _labels(labels)
+    with _lock:
+        series = _hists.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            _help.setdefault(name, ("histogram", help_text))
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+
+def inc(name: str, labels: Optional[Dict[str, str]] = None, n: float = 1, help_text: str = "") -> None:
+    key = _labels(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + n
+        _help.setdefault(name, ("counter", help_text))
+
+
+def observe_tick(worker: str, seconds: float) -> None:
+    observe("worker_tick_duration_seconds", seconds, {"worker": worker}, "Duration of one background worker tick")
+
+
+@contextmanager
+def tick_timer(worker: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_tick(worker, time.perf_counter() - t0)
+
+
+# ────────────────────────────────────────────────────────────
+# تغليف الهاندلرز وطلبات تيليغرام
+# ────────────────────────────────────────────────────────────
+def _timed_handler(fn: Callable) -> Callable:
+    if getattr(fn, "_metrics_wrapped", False):
+        return fn
+    name = f"{getattr(fn, '__module__', '?')}.{getattr(fn, '__qualname__', getattr(fn, '__name__', '?'))}"
+
+    @functools.wraps(fn)  # __wrapped__ يُبقي توقيع الدالة كما يراه telebot (inspect.signature)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            observe("bot_handler_duration_seconds", time.perf_counter() - t0, {"handler": name},
+                    "Telegram update handler latency")
+    wrapper._metrics_wrapped = True
+    return wrapper
+
+
+def instrument_handlers(bot) -> int:
+    """يغلّف كل الهاندلرز المسجلة حاليًا (يُستدعى بعد اكتمال التسجيل). يرجع عددها."""
+    n = 0
+    for attr, lst in vars(bot).items():
+        if not attr.endswith("_handlers") or not isinstance(lst, list):
+            continue
+        for h in lst:
+            if isinstance(h, dict) and callable(h.get("function")):
+                h["function"] = _timed_handler(h["function"])
+                n += 1
+    return n
+
+
+_tg_installed = False
+
+
+def install_telegram_metrics() -> None:
+    """يغلّف telebot.apihelper._make_request: زمن كل طريقة API وعدد ردود 429."""
+    global _tg_installed
+    if _tg_installed:
+        return
+    from telebot import apihelper
+    original = apihelper._make_request
+
+    @functools.wraps(original)
+    def _make_request(token, method_name, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return original(token, method_name, *args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            if getattr(e, "error_code", None) == 429:
+                inc("telegram_429_total", {"method": method_name}, help_text="Telegram 429 Too Many Requests responses")
+            raise
+        finally:
+            observe("telegram_request_duration_seconds", time.perf_counter() - t0, {"method": method_name},
+                    "Telegram Bot API call latency")
+
+    apihelper._make_request = _make_request
+    _tg_installed = True
+
+
+# ────────────────────────────────────────────────────────────
+# مقاييس تُحسب عند الكشط
+# ────────────────────────────────────────────────────────────
+_queue_lines_cache: List[str] = []
+_probe_started = False
+_probe_lock = threading.Lock()
+
+
+def _age_seconds(ts: Optional[str]) -> float:
+    if not ts:
+        return 0.0
+    try:
+        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return max(0.0, (datetime.now(timezone.utc) - dt).total_seconds())
+    except Exception:
+        return 0.0
+
+
+def _probe_queues() -> List[str]:
+    from database.db import get_table
+    lines = [
+        "# HELP queue_depth Rows waiting in the queue table",
+        "# TYPE queue_depth gauge",
+        "# HELP queue_oldest_age_seconds Age of the oldest waiting row",
+        "# TYPE queue_oldest_age_seconds gauge",
+    ]
+    queues = {
+        "pending_requests": lambda q: q,
+        "notifications_outbox": lambda q: q.is_("sent_at", "null").is_("dead_at", "null"),
+    }
+    for qname, flt in queues.items():
+        try:
+            res = flt(get_table(qname).select("created_at", count="exact")).order("created_at").limit(1).execute()
+            rows = res.data or []
+            lines.append(f'queue_depth{{queue="{qname}"}} {int(res.count or 0)}')
+            lines.append(f'queue_oldest_age_seconds{{queue="{qname}"}} {_age_seconds(rows[0].get("created_at") if rows else None):.3f}')
+        except Exception as e:
+            logging.warning("[metrics] queue probe %s failed: %s", qname, e)
+    return lines
+
+
+def _probe_loop() -> None:
+    global _queue_lines_cache
+    while True:
+        try:
+            _queue_lines_cache = _probe_queues()
+        except Exception as e:
+            logging.warning("[metrics] queue probe failed: %s", e)
+        time.sleep(METRICS_DB_TTL)
+
+
+def _queue_lines() -> List[str]:
+    """آخر قيم الطابورين من الذاكرة؛ الاستعلام في خيط خلفي (قاعدة بطيئة لا تحبس الكشط ولا /healthz)."""
+    global _probe_started
+    if not _probe_started:
+        with _probe_lock:
+            if not _probe_started:
+                _probe_started = True
+                threading.Thread(target=_probe_loop, name="metrics-queue-probe", daemon=True).start()
+    return _queue_lines_cache
+
+
+def _fmt_labels(key: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def _hist_lines(name: str, series, buckets=BUCKETS) -> List[str]:
+    out = []
+    for key, (counts, total_sum, count) in series:
+        acc = 0
+        for b, c in zip(buckets, counts):
+            acc += c
+            out.append(f"{name}_bucket{_fmt_labels(key, (('le', repr(float(b))),))} {acc}")
+        out.append(f"{name}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {count}")
+        out.append(f"{name}_sum{_fmt_labels(key)} {total_sum:.6f}")
+        out.append(f"{name}_count{_fmt_labels(key)} {count}")
+    return out
+
+
+def render() -> str:
+    lines: List[str] = []
+    with _lock:
+        hists = {n: [(k, (list(v[0]), v[1], v[2])) for k, v in s.items()] for n, s in _hists.items()}
+        counters = {n: dict(s) for n, s in _counters.items()}
+        helps = dict(_help)
+
+    for name, series in sorted(hists.items()):
+        lines.append(f"# HELP {name} {helps.get(name, ('', ''))[1]}")
+        lines.append(f"# TYPE {name} histogram")
+        lines.extend(_hist_lines(name, series))
+    for name, series in sorted(counters.items()):
+        lines.append(f"# HELP {name} {helps.get(name, ('', ''))[1]}")
+        lines.append(f"# TYPE {name} counter")
+        for key, v in series.items():
+            lines.append(f"{name}{_fmt_labels(key)} {v:g}")
+
+    # Supabase (database/transport)
+    try:
+        from database.transport import latency_snapshot, breaker_state
+        snap = latency_snapshot()
+        lines.append("# HELP supabase_request_duration_seconds Supabase REST/RPC latency per table and operation")
+        lines.append("# TYPE supabase_request_duration_seconds histogram")
+        errors = []
+        for (target, op), h in sorted(snap.items()):
+            key = (("op", op), ("target", target))
+            lines.extend(_hist_lines("supabase_request_duration_seconds",
+                                     [(key, (h["counts"], h["sum"], h["count"]))],
+                                     buckets=h["buckets"]))
+            errors.append(f"supabase_request_errors_total{_fmt_labels(key)} {h['errors']}")
+        lines.append("# HELP supabase_request_errors_total Failed Supabase requests (5xx or transport errors)")
+        lines.append("# TYPE supabase_request_errors_total counter")
+        lines.extend(errors)
+        lines.append("# HELP supabase_breaker_open Whether the Supabase circuit breaker is open")
+        lines.append("# TYPE supabase_breaker_open gauge")
+        lines.append(f"supabase_breaker_open {1 if breaker_state() == 'open' else 0}")
+    except Exception as e:
+        logging.warning("[metrics] transport snapshot failed: %s", e)
+
+    # كاش الحالة
+    try:
+        from services.state_service import cache_stats
+        st = cache_stats()
+        lines.append("# HELP state_cache_hits_total User state reads served from memory")
+        lines.append("# TYPE state_cache_hits_total counter")
+        lines.append(f"state_cache_hits_total {st['hits']}")
+        lines.append("# HELP state_cache_misses_total User state reads that went to the database")
+        lines.append("# TYPE state_cache_misses_total counter")
+        lines.append(f"state_cache_misses_total {st['misses']}")
+        lines.append("# HELP state_cache_entries User state entries held in memory")
+        lines.append("# TYPE state_cache_entries gauge")
+        lines.append(f"state_cache_entries {st['entries']}")
+    except Exception as e:
+        logging.warning("[metrics] state cache stats failed: %s", e)
+
+    lines.extend(_queue_lines())
+    lines.append("# HELP process_uptime_seconds Seconds since the bot process started")
+    lines.append("# TYPE process_uptime_seconds gauge")
+    lines.append(f"process_uptime_seconds {time.time() - _started_at:.0f}")
+    return "\n".join(lines) + "\n"
+
+
+def health() -> Dict[str, object]:
+    try:
+        from database.transport import breaker_state
+        supabase = breaker_state()
+    except Exception:
+        supabase = "unknown"
+    return {"status": "ok", "uptime": int(time.time() - _started_at), "supabase": supabase}
+
+
+# ────────────────────────────────────────────────────────────
+# الخادم الوهمي
+# ────────────────────────────────────────────────────────────
+class MetricsServer(socketserver.ThreadingTCPServer):
+    """خيط لكل اتصال: كشط بطيء لا يحبس نبضات /healthz من المستضيف."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MetricsHandler(http.server.SimpleHTTPRequestHandler):
+    """الخادم الوهمي نفسه + /metrics و /healthz."""
+
+    def _send(self, code: int, body: str, ctype: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            try:
+                return self._send(200, render(), "text/plain; version=0.0.4; charset=utf-8")
+            except Exception as e:
+                logging.exception("[metrics] render failed: %s", e)
+                return self._send(500, "metrics error\n", "text/plain; charset=utf-8")
+        if path == "/healthz":
+            return self._send(200, json.dumps(health()), "application/json")
+        return super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
@@ -1,13 +1,49 @@
 # -*- coding: utf-8 -*-
 # services/outbox_worker.py
+"""
+عامل تسليم notifications_outbox:
+  1) حجز دفعة مستحقة عبر RPC outbox_claim (FOR UPDATE SKIP LOCKED + مهلة حجز)،
+     فيمكن تشغيل أكثر من نسخة من البوت على نفس الجدول بأمان.
+  2) إرسال متوازٍ (OUTBOX_CONCURRENCY خيط) عبر services/telegram_sender الذي يحترم
+     حدود تيليغرام العامة ولكل محادثة و retry_after.
+  3) تسجيل نتائج الدفعة كلها بطلب واحد (RPC outbox_complete): sent_at للناجح،
+     تراجع أُسّي عبر next_attempt_at للفاشل، ورسائل ميتة (dead_at) بعد OUTBOX_MAX_TRIES.
+     فقط للصفوف التي ما زالت محجوزة لهذا العامل (ترحيل 0017)؛ لو تعذّر التسجيل بعد عدة
+     محاولات يُسجَّل sent_at للناجح مباشرة حتى لا يُعاد إرساله بعد انتهاء الحجز.
+لو الدوال غير منشأة بعد (database/sql/0008_outbox_engine.sql) نرجع للمسار القديم.
+
+المنتِجون يضيفون الرسائل عبر enqueue_many/enqueue (RPC outbox_enqueue، ترحيل 0014).
+"""
 from __future__ import annotations
+import logging
+import os
+import socket
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
-from database.db import get_table
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from database.db import get_table, client
+from services.telegram_sender import (
+    send_message, send_photo, retry_after_of, is_permanent_error, RateLimited,
+)
+from services.metrics import tick_timer
 
 OUTBOX_TABLE = "notifications_outbox"
 
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200") or 200)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8") or 8)
+OUTBOX_MAX_TRIES = int(os.getenv("OUTBOX_MAX_TRIES", "6") or 6)
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30") or 30)
+OUTBOX_BACKOFF_CAP = float(os.getenv("OUTBOX_BACKOFF_CAP", "3600") or 3600)
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300") or 300)
+OUTBOX_COMPLETE_ATTEMPTS = int(os.getenv("OUTBOX_COMPLETE_ATTEMPTS", "4") or 4)
+
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_RPC_SUPPORTED = True
+_COMPLETE_OWNER = True   # outbox_complete بمعامل p_worker (ترحيل 0017)
+_pool: Optional[ThreadPoolExecutor] = None
+
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -18,47 +54,226 @@ def _send_one(bot, row: Dict[str, Any]) -> bool:
     parse_mode: Optional[str] = (row.get("parse_mode") or "HTML") or None
 
     if photo_id:
-        bot.send_photo(user_id, photo_id, caption=text or "", parse_mode=parse_mode)
+        send_photo(bot, user_id, photo_id, caption=text or "", parse_mode=parse_mode)
     else:
-        bot.send_message(user_id, text or " ", parse_mode=parse_mode)
+        send_message(bot, user_id, text or " ", parse_mode=parse_mode)
     return True
 
-def _tick(bot):
-    now = _now_iso()
+def _deliver(bot, row: Dict[str, Any]) -> Dict[str, Any]:
+    """يرسل صفًا ويرجع نتيجته بصيغة outbox_complete."""
+    res: Dict[str, Any] = {"id": str(row["id"]), "ok": False}
+    try:
+        res["ok"] = bool(_send_one(bot, row))
+    except Exception as e:
+        res["error"] = str(e)[:500]
+        ra = retry_after_of(e)
+        if ra is not None:
+            res["retry_after"] = ra
+        elif is_permanent_error(e):
+            res["permanent"] = True
+    return res
+
+def _claim(limit: int) -> List[Dict[str, Any]]:
+    r = client().rpc("outbox_claim", {
+        "p_worker": _WORKER_ID,
+        "p_limit": int(limit),
+        "p_lease_seconds": OUTBOX_LEASE_SECONDS,
+    }).execute()
+    return r.data or []
+
+def _complete_rpc(results: List[Dict[str, Any]]) -> None:
+    global _COMPLETE_OWNER
+    params = {
+        "p_results": results,
+        "p_max_tries": OUTBOX_MAX_TRIES,
+        "p_backoff_base": OUTBOX_BACKOFF_BASE,
+        "p_backoff_cap": OUTBOX_BACKOFF_CAP,
+    }
+    if _COMPLETE_OWNER:
+        try:
+            client().rpc("outbox_complete", {**params, "p_worker": _WORKER_ID}).execute()
+            return
+        except Exception as e:
+            if not _is_missing_rpc(e):
+                raise
+            # قبل ترحيل 0017: التوقيع القديم بلا فحص العامل
+            _COMPLETE_OWNER = False
+            logging.warning("[outbox_worker] outbox_complete(p_worker) not installed; completing without owner check")
+    client().rpc("outbox_complete", params).execute()
+
+def _mark_sent_fallback(results: List[Dict[str, Any]]) -> None:
+    """outbox_complete فشل نهائيًا: نسجّل الناجح فقط (حتى لا يُرسل مجددًا بعد انتهاء الحجز)."""
+    ok_ids = [r["id"] for r in results if r.get("ok")]
+    if not ok_ids:
+        return
+    (
+        get_table(OUTBOX_TABLE)
+        .update({"sent_at": _now_iso(), "claimed_by": None, "claimed_until": None, "last_error": None})
+        .in_("id", ok_ids)
+        .is_("sent_at", None)
+        .execute()
+    )
+
+def _complete(results: List[Dict[str, Any]]) -> None:
+    """
+    تسجيل نتائج الدفعة بعد الإرسال (الرسائل خرجت فعلًا): إعادة بتراجع أُسّي، ثم تحديث sent_at
+    للناجح مباشرة. الفاشل يبقى محجوزًا حتى انتهاء المهلة ثم يُعاد كالمعتاد.
+    """
+    if not results:
+        return
+    delay = 1.0
+    for attempt in range(1, OUTBOX_COMPLETE_ATTEMPTS + 1):
+        try:
+            _complete_rpc(results)
+            return
+        except Exception as e:
+            if _is_missing_rpc(e):
+                raise
+            logging.warning(f"[outbox_worker] outbox_complete failed (attempt {attempt}): {e}")
+            if attempt < OUTBOX_COMPLETE_ATTEMPTS:
+                time.sleep(delay)
+                delay *= 2
+    try:
+        _mark_sent_fallback(results)
+    except Exception as e:
+        logging.error(f"[outbox_worker] could not record {sum(1 for r in results if r.get('ok'))} sent rows: {e}")
+
+# ================= المنتِج: إدراج جماعي =================
+
+OUTBOX_ENQUEUE_CHUNK = int(os.getenv("OUTBOX_ENQUEUE_CHUNK", "1000") or 1000)
+_ENQUEUE_RPC_SUPPORTED = True
+
+def _enqueue_one_legacy(e: Dict[str, Any]) -> int:
+    # قبل ترحيل 0014: فحص ثم إدراج لكل صف
     try:
-        # اجلب رسائل غير مرسلة Scheduled <= now
-        res = (
+        exists = (
             get_table(OUTBOX_TABLE)
-            .select("*")
+            .select("id")
+            .eq("user_id", e["user_id"])
+            .eq("kind", e["kind"])
             .is_("sent_at", None)
-            .lte("scheduled_at", now)
-            .order("scheduled_at", desc=False)
-            .limit(30)
+            .limit(1)
             .execute()
         )
-        rows: List[Dict[str, Any]] = res.data or []
-        for r in rows:
-            ok = False
+        if exists.data:
+            return 0
+        get_table(OUTBOX_TABLE).insert({**e, "created_at": _now_iso()}).execute()
+        return 1
+    except Exception as ex:
+        logging.warning(f"[outbox] insert failed for {e.get('user_id')}/{e.get('kind')}: {ex}")
+        return 0
+
+def enqueue_many(entries: Iterable[Tuple[int, str, str, Optional[str]]], parse_mode: str = "HTML") -> int:
+    """
+    يدرج رسائل outbox بالجملة: entries = [(user_id, kind, message, scheduled_at_iso|None), ...]
+    رسالة معلّقة واحدة فقط لكل (user_id, kind) — المكرر يُتجاهل على الخادم (ON CONFLICT DO NOTHING).
+    يرجع عدد الصفوف المُدرجة فعلًا.
+    """
+    global _ENQUEUE_RPC_SUPPORTED
+    rows = [
+        {"user_id": int(uid), "kind": kind, "message": message,
+         "scheduled_at": scheduled_at or _now_iso(), "parse_mode": parse_mode}
+        for uid, kind, message, scheduled_at in entries
+    ]
+    inserted = 0
+    for i in range(0, len(rows), OUTBOX_ENQUEUE_CHUNK):
+        chunk = rows[i:i + OUTBOX_ENQUEUE_CHUNK]
+        if _ENQUEUE_RPC_SUPPORTED:
             try:
-                ok = _send_one(bot, r)
-            except Exception as e:
-                # زد عدد المحاولات وواصل
-                tries = int(r.get("tries") or 0) + 1
-                get_table(OUTBOX_TABLE).update({"tries": tries}).eq("id", r["id"]).execute()
+                r = client().rpc("outbox_enqueue", {"p_rows": chunk}).execute()
+                inserted += int(r.data or 0)
                 continue
-            if ok:
-                get_table(OUTBOX_TABLE).update({"sent_at": _now_iso()}).eq("id", r["id"]).execute()
+            except Exception as e:
+                if not _is_missing_rpc(e):
+                    logging.warning(f"[outbox] enqueue chunk failed: {e}")
+                    continue
+                _ENQUEUE_RPC_SUPPORTED = False
+                logging.warning("[outbox] outbox_enqueue not installed; inserting row by row")
+        inserted += sum(_enqueue_one_legacy(e) for e in chunk)
+    return inserted
+
+def enqueue(user_id: int, kind: str, message: str, scheduled_at: Optional[str] = None, parse_mode: str = "HTML") -> bool:
+    return enqueue_many([(user_id, kind, message, scheduled_at)], parse_mode=parse_mode) > 0
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=max(1, OUTBOX_CONCURRENCY), thread_name_prefix="outbox")
+    return _pool
+
+def _tick_rpc(bot) -> int:
+    rows = _claim(OUTBOX_BATCH)
+    if not rows:
+        return 0
+    results = list(_get_pool().map(lambda r: _deliver(bot, r), rows))
+    _complete(results)
+    sent = sum(1 for r in results if r.get("ok"))
+    dead_or_retry = len(results) - sent
+    if dead_or_retry:
+        logging.warning(f"[outbox_worker] batch: sent={sent} failed={dead_or_retry}")
+    return len(rows)
+
+def _tick_legacy(bot) -> int:
+    # المسار القديم (قبل ترحيل 0008): تسلسلي، تحديث لكل صف
+    now = _now_iso()
+    res = (
+        get_table(OUTBOX_TABLE)
+        .select("*")
+        .is_("sent_at", None)
+        .lte("scheduled_at", now)
+        .order("scheduled_at", desc=False)
+        .limit(30)
+        .execute()
+    )
+    rows: List[Dict[str, Any]] = res.data or []
+    for r in rows:
+        try:
+            _send_one(bot, r)
+        except RateLimited:
+            break
+        except Exception:
+            tries = int(r.get("tries") or 0) + 1
+            get_table(OUTBOX_TABLE).update({"tries": tries}).eq("id", r["id"]).execute()
+            continue
+        get_table(OUTBOX_TABLE).update({"sent_at": _now_iso()}).eq("id", r["id"]).execute()
+    return len(rows)
+
+def _is_missing_rpc(e: Exception) -> bool:
+    msg = str(e)
+    return "PGRST202" in msg or "42883" in msg or "Could not find the function" in msg
+
+def _tick(bot) -> int:
+    """دورة واحدة؛ ترجع عدد الصفوف المعالجة."""
+    global _RPC_SUPPORTED
+    try:
+        if _RPC_SUPPORTED:
+            try:
+                return _tick_rpc(bot)
+            except Exception as e:
+                if not _is_missing_rpc(e):
+                    raise
+                _RPC_SUPPORTED = False
+                logging.warning("[outbox_worker] outbox_claim/outbox_complete not installed; using legacy path")
+        return _tick_legacy(bot)
     except Exception as e:
         # سجل فقط
-        print(f"[outbox_worker] tick error: {e}")
+        logging.warning(f"[outbox_worker] tick error: {e}")
+        return 0
 
-def start_outbox_worker(bot, every_seconds: int = 30):
+def start_outbox_worker(bot, every_seconds: int = 10):
     """
-    عامل إرسال رسائل outbox. يُشغَّل من main.py
+    عامل إرسال رسائل outbox. يُشغَّل من main.py
+    دفعة ممتلئة → الدورة التالية فورًا (تفريغ الطابور)، وإلا كل every_seconds.
     """
     def loop():
-        _tick(bot)
-        threading.Timer(every_seconds, loop).start()
+        with tick_timer("outbox"):
+            n = _tick(bot)
+        delay = 0.1 if n >= (OUTBOX_BATCH if _RPC_SUPPORTED else 30) else every_seconds
+        t = threading.Timer(delay, loop)
+        t.daemon = True
+        t.start()
     # تأخير بسيط لضمان اكتمال تهيئة البوت
-    threading.Timer(5, loop).start()
-
+    t = threading.Timer(5, loop)
+    t.daemon = True
+    t.start()
@@ -0,0 +1,187 @@
+# services/purchase_history.py
+"""
+نموذج قراءة موحّد لسجل مشتريات المستخدم (جدول purchase_history).
+
+- record_purchase(...) تُستدعى من دوال add_*_purchase في wallet_service بعد الإدراج
+  في الجدول المتخصص (كتابة مزدوجة)، بعنوان وسعر ومعرّف (رقم/آيدي) موحّد.
+- page_purchases(...) صفحة واحدة بطلب واحد على الفهرس (user_id, created_at desc, id desc)
+  مع مؤشر keyset للصفحة التالية.
+- backfill() تعبئة لمرة واحدة من الجداول القديمة:
+      python -m services.purchase_history backfill
+- طلبات الجملة مستثناة: استفسار بلا سعر ولا خصم من المحفظة يُتابع خارج البوت، فلا كاتب
+  لـ wholesale_purchases؛ صفوفه القديمة (إن وُجدت) تدخل عبر backfill فقط.
+"""
+import logging
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.db import get_table
+
+PURCHASE_HISTORY_TABLE = "purchase_history"
+
+# المصدر → (حقل العنوان، عمود المعرّف في الجدول الأصلي)
+SOURCES: Dict[str, Tuple[str, Optional[str]]] = {
+    "game_purchases": ("product_name", "player_id"),
+    "ads_purchases": ("ad_name", None),
+    "bill_and_units_purchases": ("bill_name", "number"),
+    "cash_transfer_purchases": ("transfer_name", "number"),
+    "companies_transfer_purchases": ("company_name", "beneficiary_number"),
+    "internet_providers_purchases": ("provider_name", "phone"),
+    "university_fees_purchases": ("university_name", "university_id"),
+    "wholesale_purchases": ("wholesale_name", None),
+    "purchases": ("product_name", "player_id"),
+}
+_ID_PROBE = ["player_id","phone","number","msisdn","account","account_number","student_id","student_number","target_id","target","line","game_id"]
+
+
+def _row_id(resp) -> Optional[str]:
+    data = getattr(resp, "data", None)
+    if isinstance(data, list) and data and isinstance(data[0], dict) and data[0].get("id") is not None:
+        return str(data[0]["id"])
+    return None
+
+
+def record_purchase(user_id: int, source: str, title: str, price: int,
+                    identifier: Optional[str] = None, created_at: Optional[str] = None,
+                    source_resp=None) -> None:
+    """كتابة مزدوجة في purchase_history (لا تُفشل عملية الشراء الأصلية أبدًا)."""
+    row = {
+        "user_id": int(user_id),
+        "source": source,
+        "source_id": _row_id(source_resp),
+        "title": (title or source),
+        "price": int(price or 0),
+        "identifier": (str(identifier) if identifier not in (None, "") else None),
+        "created_at": (created_at or datetime.utcnow().isoformat()),
+    }
+    try:
+        get_table(PURCHASE_HISTORY_TABLE).insert(row).execute()
+    except Exception as e:
+        logging.warning(f"[purchase_history] dual-write failed ({source}, user {user_id}): {e}")
+
+
+# ================= القراءة (keyset) =================
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    return f"{row.get('created_at')}|{row.get('id')}"
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    ts, _, rid = (cursor or "").rpartition("|")
+    return ts, int(rid)
+
+
+def page_purchases(user_id: int, limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    صفحة من مشتريات المستخدم الأحدث أولًا.
+    يرجع (items, next_cursor)؛ العناصر بنفس شكل get_all_purchases_structured.
+    """
+    q = (
+        get_table(PURCHASE_HISTORY_TABLE)
+        .select("id,title,price,identifier,created_at")
+        .eq("user_id", user_id)
+    )
+    if cursor:
+        ts, rid = decode_cursor(cursor)
+        q = q.or_(f'created_at.lt."{ts}",and(created_at.eq."{ts}",id.lt.{rid})')
+    resp = q.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    rows = resp.data or []
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [
+        {
+            "title": r.get("title"),
+            "price": int(r.get("price") or 0),
+            "created_at": r.get("created_at"),
+            "id_or_phone": r.get("identifier"),
+        }
+        for r in rows
+    ]
+    return items, (encode_cursor(rows[-1]) if has_more and rows else None)
+
+
+# ================= Backfill =================
+
+def _to_sec(s: Optional[str]) -> Optional[int]:
+    if not s:
+        return None
+    try:
+        return int(datetime.fromisoformat(s[:19].replace("T", " ")).replace(tzinfo=timezone.utc).timestamp())
+    except Exception:
+        return None
+
+
+def _scan(table: str, batch: int):
+    offset = 0
+    while True:
+        resp = (
+            get_table(table)
+            .select("*")
+            .order("created_at", desc=False)
+            .range(offset, offset + batch - 1)
+            .execute()
+        )
+        rows = resp.data or []
+        for r in rows:
+            yield r
+        if len(rows) < batch:
+            return
+        offset += batch
+
+
+def backfill(batch: int = 500) -> Dict[str, int]:
+    """
+    ينسخ الصفوف الموجودة إلى purchase_history (آمن للتكرار: upsert على source,source_id).
+    جدول purchases العام يُنسخ أخيرًا ويُتخطى منه ما له نظير في جدول متخصص
+    (نفس العنوان/السعر/المعرّف خلال 5 ثوانٍ) لأن الأدمن يكتب في الاثنين.
+    """
+    counts: Dict[str, int] = {}
+    seen: Dict[Tuple[int, str, int], List[int]] = {}
+    for source, (title_field, id_field) in SOURCES.items():
+        out = []
+        try:
+            for r in _scan(source, batch):
+                uid = r.get("user_id")
+                if uid is None or r.get("id") is None:
+                    continue
+                ident = r.get(id_field) if id_field else None
+                if ident in (None, "") and source == "wholesale_purchases":
+                    ident = next((r.get(k) for k in _ID_PROBE if r.get(k)), None)
+                title = r.get(title_field) or ("منتج" if source == "purchases" else source)
+                price = int(r.get("price") or 0)
+                sec = _to_sec(r.get("created_at"))
+                key = (int(uid), title, price)
+                if source == "purchases" and sec is not None:
+                    if any(abs(sec - s) <= 5 for s in seen.get(key, ())):
+                        continue
+                elif sec is not None:
+                    seen.setdefault(key, []).append(sec)
+                out.append({
+                    "user_id": int(uid),
+                    "source": source,
+                    "source_id": str(r["id"]),
+                    "title": title,
+                    "price": price,
+                    "identifier": (str(ident) if ident not in (None, "") else None),
+                    "created_at": r.get("created_at"),
+                })
+        except Exception as e:
+            logging.error(f"[purchase_history] backfill scan {source} failed: {e}")
+        for i in range(0, len(out), batch):
+            try:
+                get_table(PURCHASE_HISTORY_TABLE).upsert(
+                    out[i:i + batch], on_conflict="source,source_id", ignore_duplicates=True
+                ).execute()
+            except Exception as e:
+                logging.error(f"[purchase_history] backfill upsert {source} failed: {e}")
+        counts[source] = len(out)
+    return counts
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        logging.basicConfig(level=logging.INFO)
+        print(backfill())
+    else:
+        print("usage: python -m services.purchase_history backfill")
@@ -1,25 +1,84 @@
 # -*- coding: utf-8 -*-
 # services/queue_service.py
 
+"""
+طابور طلبات العملاء للأدمن (pending_requests) + موزّع دائم:
+  * add_pending_request يوقظ الموزّع فورًا (Event محلي)، ومع QUEUE_LISTEN_DSN
+    (وحزمة psycopg2) يستمع أيضًا لـ LISTEN pending_requests من النسخ الأخرى.
+  * حتى QUEUE_CONCURRENCY طلبًا معروضًا على الأدمن في نفس الوقت؛ كل طلب معروض
+    محجوز بمهلة (lease_until) عبر RPC queue_claim، وينتهي الحجز بحسم الطلب (حذفه)
+    أو يعود للطابور بعد QUEUE_LEASE_SECONDS ويُعاد عرضه.
+  * «📌 استلمت» = claimed_by + تمديد المهلة QUEUE_CLAIM_SECONDS (بدل payload.locked_by).
+  * مسارات أولوية من payload.type (QUEUE_LANES) لكل منها هدف SLA ووزن: المجدول يقدّم
+    ما قارب SLA ثم يوزّع الباقي بعدالة موزونة بين المسارات (طلب الشحن لا ينتظر خلف طلب جملة).
+الأعمدة والدوال في database/sql/0010_queue_dispatcher.sql.
+"""
+import os
 import time
+import socket
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
 import httpx
 import threading
 
-from database.db import get_table
+from database.db import get_table, client
 from config import ADMIN_MAIN_ID, ADMINS
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from postgrest.exceptions import APIError  # ← لالتقاط 23505 وقت السباق
+from services.telegram_sender import call_limited
+from services import rollup_service as rollups
 
-QUEUE_TABLE = "pending_requests"
+try:
+    import psycopg2  # اختياري: LISTEN/NOTIFY
+except Exception:
+    psycopg2 = None
 
-_queue_lock = threading.Lock()
-_queue_cooldown = False
+QUEUE_TABLE = "pending_requests"
 
-# منع التكرار ضمن نافذة قصيرة (حماية إضافية من تعدد الاستدعاءات)
-_recently_sent = {}        # {request_id: last_ts}
-_RECENT_TTL     = 40       # ثوانٍ
+QUEUE_CONCURRENCY = int(os.getenv("QUEUE_CONCURRENCY", "3") or 3)           # طلبات معروضة معًا
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "900") or 900)   # طلب لم يُستلم خلالها يُعاد عرضه
+QUEUE_CLAIM_SECONDS = int(os.getenv("QUEUE_CLAIM_SECONDS", "1800") or 1800) # مهلة الأدمن بعد «استلمت»
+QUEUE_POSTPONE_SECONDS = int(os.getenv("QUEUE_POSTPONE_SECONDS", "30") or 30)
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "10") or 10)     # احتياط لو فات إشعار
+QUEUE_LISTEN_DSN = os.getenv("QUEUE_LISTEN_DSN", "").strip()
+QUEUE_FANOUT_WORKERS = int(os.getenv("QUEUE_FANOUT_WORKERS", "8") or 8)     # إرسال متوازٍ لكل الأدمن
+QUEUE_CANDIDATES = int(os.getenv("QUEUE_CANDIDATES", "200") or 200)          # مرشحون يراهم المجدول كل دورة
+QUEUE_AGEING_FRACTION = float(os.getenv("QUEUE_AGEING_FRACTION", "0.8") or 0.8)
+
+# مسارات الأولوية: lane -> (أنواع payload.type، هدف SLA بالدقائق، الوزن في المجدول)
+# (تعبئة الصفوف القديمة في database/sql/0012_queue_lanes.sql تنسخ نفس الجدول)
+QUEUE_LANES: Dict[str, Tuple[Tuple[str, ...], int, float]] = {
+    "recharge":  (("recharge", "wallet_recharge", "deposit"), 5, 8),
+    "transfers": (("cash_transfer", "companies_transfer"), 10, 6),
+    "games":     (("order",), 10, 4),
+    "bills":     (("syr_unit", "syr_bill", "syr_kazia", "mtn_unit", "mtn_bill", "mtn_kazia",
+                   "internet", "university_fees"), 15, 4),
+    "ads":       (("ads",), 60, 1),
+    "media":     (("media",), 60, 1),
+    "wholesale": (("wholesale",), 120, 1),
+    "other":     ((), 30, 2),
+}
+DEFAULT_LANE = "other"
+LANE_LABELS = {
+    "recharge": "شحن محفظة", "transfers": "تحويلات", "games": "ألعاب/تطبيقات", "bills": "فواتير ووحدات",
+    "ads": "إعلانات", "media": "خدمات ميديا", "wholesale": "جملة", "other": "أخرى",
+}
+_TYPE_LANE = {t: lane for lane, (types, _, _) in QUEUE_LANES.items() for t in types}
+
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_RPC_SUPPORTED = True
+_SLA_COLUMNS = True
+_sched_lock = threading.Lock()
+_lane_vtime: Dict[str, float] = {}
+_vclock = 0.0
+_wake = threading.Event()
+_start_lock = threading.Lock()
+_started = False
+_bot = None
+_pool: Optional[ThreadPoolExecutor] = None
+_fanout_pool: Optional[ThreadPoolExecutor] = None
 
 def _admin_targets():
     # إرجاع قائمة الإداريين (ADMINS + ADMIN_MAIN_ID) بدون تكرار، مع الحفاظ على الترتيب.
@@ -70,15 +129,25 @@ def _add_pending_request_text(user_id: int, username: str, request_text: str, pa
     }
     if payload is not None:
         data["payload"] = payload
+    lane = lane_of(payload if isinstance(payload, dict) else None)
+    data["lane"] = lane
+    data["sla_due_at"] = sla_due_for(lane, datetime.now(timezone.utc)).isoformat()
 
     for attempt in range(1, 4):
         try:
             r = get_table(QUEUE_TABLE).insert(data).execute()
             rid = (r.data or [{}])[0].get("id")
+            notify_queue()
+            rollups.bump("queue_new", dim=lane)  # الطلبات تُحذف بعد المعالجة؛ العدّ اليومي هنا
             return {"status": "created", "request_id": rid}
         except APIError as e:
             # لو حدث سباق وأرجعت القاعدة 23505 نرجع duplicate بهدوء
             code = getattr(e, "code", None)
+            if code == "PGRST204" and "lane" in data:
+                # ترحيل 0012 غير مطبّق بعد: أدرج بدون أعمدة المسار
+                data.pop("lane", None)
+                data.pop("sla_due_at", None)
+                continue
             if code == "23505":
                 try:
                     ex = (
@@ -136,6 +205,7 @@ def delete_pending_request(request_id: int):
         get_table(QUEUE_TABLE).delete().eq("id", request_id).execute()
     except Exception:
         logging.exception(f"Error deleting pending request {request_id}")
+    notify_queue()  # تحررت خانة → الطلب التالي فورًا
 
 def get_next_request():
     try:
@@ -165,167 +235,544 @@ def _payload_get(request_id: int):
     except Exception:
         return {}
 
+
+# ================= تعديل payload ذرّيًا (RPC pending_payload_patch) =================
+
+_PATCH_RPC_SUPPORTED = True
+
+def _merge_patch(target, patch):
+    """نسخة بايثون من jsonb_merge_patch (RFC 7396) للمسار الاحتياطي."""
+    if not isinstance(patch, dict):
+        return patch
+    out = dict(target) if isinstance(target, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            out.pop(k, None)
+        else:
+            out[k] = _merge_patch(out.get(k), v)
+    return out
+
+def patch_payload(request_id: int, patch: dict, expected_version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    يدمج patch في payload على الخادم بطلب واحد (المفتاح بقيمة None يُحذف).
+    expected_version → compare-and-set: لو تغيّر الطلب منذ قراءته لا يُكتب شيء.
+    يرجع {"id", "payload", "payload_version"} أو None (تعارض/الطلب غير موجود).
+    """
+    global _PATCH_RPC_SUPPORTED
+    if _PATCH_RPC_SUPPORTED:
+        try:
+            r = client().rpc("pending_payload_patch", {
+                "p_id": int(request_id),
+                "p_patch": patch or {},
+                "p_expected_version": expected_version,
+            }).execute()
+            rows = r.data or []
+            return rows[0] if rows else None
+        except Exception as e:
+            if not _is_missing_rpc(e):
+                raise
+            _PATCH_RPC_SUPPORTED = False
+            logging.warning("[QUEUE] pending_payload_patch not installed; using read-modify-write")
+    # المسار القديم (قبل ترحيل 0011): قراءة ودمج وكتابة — غير محمي من السباق
+    old = _payload_get(request_id)
+    newp = _merge_patch(old, patch or {})
+    r = get_table(QUEUE_TABLE).update({"payload": newp}).eq("id", request_id).execute()
+    return {"id": request_id, "payload": newp, "payload_version": None} if r.data else None
+
+def mutate_payload(request_id: int, fn, retries: int = 5) -> Optional[Dict[str, Any]]:
+    """
+    لتعديلات تعتمد على القيمة الحالية (إضافة/حذف من admin_msgs...):
+    fn(payload) يرجّع patch؛ يُطبَّق بـ compare-and-set ويعاد عند التعارض.
+    يرجع payload الجديد أو None.
+    """
+    for _ in range(max(1, retries)):
+        try:
+            r = get_table(QUEUE_TABLE).select("payload, payload_version").eq("id", request_id).limit(1).execute()
+        except Exception:
+            # عمود payload_version غير موجود بعد → بدون CAS
+            r = get_table(QUEUE_TABLE).select("payload").eq("id", request_id).limit(1).execute()
+        if not r.data:
+            return None
+        cur = r.data[0].get("payload") or {}
+        patch = fn(dict(cur))
+        if not patch:
+            return cur
+        res = patch_payload(request_id, patch, r.data[0].get("payload_version"))
+        if res is not None:
+            return res.get("payload") or {}
+    logging.warning("[QUEUE] payload CAS gave up after %s conflicts for request %s", retries, request_id)
+    return None
+
 def _payload_update(request_id: int, patch: dict):
     try:
-        old = _payload_get(request_id)
-        newp = dict(old)
-        newp.update(patch or {})
-        get_table(QUEUE_TABLE).update({"payload": newp}).eq("id", request_id).execute()
+        patch_payload(request_id, patch)
     except Exception:
         logging.exception("payload update failed for request %s", request_id)
 
 def postpone_request(request_id: int):
-    # إرجاع الطلب لآخر الدور بتحديث created_at + إزالة القفل + مسح كاش التكرار.
+    # إرجاع الطلب لآخر دور مساره: موعد SLA جديد (created_at يبقى = عمر الطلب الحقيقي)
+    # + فك الحجز/الاستلام + تأخير إعادة العرض قليلًا.
     try:
-        now = datetime.utcnow().isoformat()
-        get_table(QUEUE_TABLE).update({"created_at": now}).eq("id", request_id).execute()
-        _payload_update(request_id, {"locked_by": None, "locked_by_username": None})
-        reset_recent_silently(request_id)  # مهم: السماح بإعادة الإرسال بعد التأجيل
+        now = datetime.now(timezone.utc)
+        patch = {
+            "available_at": (now + timedelta(seconds=QUEUE_POSTPONE_SECONDS)).isoformat(),
+            "lease_owner": None,
+            "lease_until": None,
+            "claimed_by": None,
+            "claimed_by_username": None,
+        }
+        try:
+            r = get_table(QUEUE_TABLE).select("lane, payload").eq("id", request_id).limit(1).execute()
+            patch["sla_due_at"] = sla_due_for(_req_lane((r.data or [{}])[0]), now).isoformat()
+        except APIError:
+            # بدون أعمدة المسار (قبل 0012): السلوك القديم
+            patch["created_at"] = now.replace(tzinfo=None).isoformat()
+        get_table(QUEUE_TABLE).update(patch).eq("id", request_id).execute()
     except Exception:
         logging.exception(f"Error postponing request {request_id}")
+    notify_queue()
 
 
-def _send_admin_with_photo(bot, photo_id: str, text: str, keyboard: InlineKeyboardMarkup):
-    # يرسل صورة/رسالة لكل الأدمن ويُعيد قائمة [(admin_id, message_id)] للرسائل ذات الأزرار.
-    sent = []
+# ================= الاستلام (📌 استلمت) =================
+
+def _now_utc() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _parse_ts(v) -> Optional[datetime]:
+    if not v:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(v).replace("Z", "+00:00"))
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    except Exception:
+        return None
+
+def active_claim(req: Dict[str, Any]) -> Optional[Tuple[int, Optional[str]]]:
+    """(admin_id, username) لمن استلم الطلب ومهلته سارية، وإلا None."""
+    holder = req.get("claimed_by")
+    until = _parse_ts(req.get("lease_until"))
+    if holder and until and until > _now_utc():
+        return int(holder), req.get("claimed_by_username")
+    return None
+
+def claim_request(request_id: int, admin_id: int, admin_username: Optional[str] = None) -> bool:
+    """
+    استلام ذرّي: ينجح فقط لو الطلب غير مستلم، أو مستلم من نفس الأدمن، أو انتهت مهلته.
+    يمدد lease_until إلى QUEUE_CLAIM_SECONDS حتى لا يُعاد عرض الطلب أثناء التنفيذ.
+    """
+    now = _now_utc()
+    r = (
+        get_table(QUEUE_TABLE)
+        .update({
+            "claimed_by": int(admin_id),
+            "claimed_by_username": admin_username,
+            "lease_until": (now + timedelta(seconds=QUEUE_CLAIM_SECONDS)).isoformat(),
+        })
+        .eq("id", request_id)
+        .or_(f'claimed_by.is.null,claimed_by.eq.{int(admin_id)},lease_until.lt."{now.isoformat()}"')
+        .execute()
+    )
+    return bool(r.data)
+
+# ================= الإرسال للأدمن (متوازٍ) =================
+
+def _get_fanout_pool() -> ThreadPoolExecutor:
+    global _fanout_pool
+    if _fanout_pool is None:
+        _fanout_pool = ThreadPoolExecutor(max_workers=max(1, QUEUE_FANOUT_WORKERS), thread_name_prefix="queue-fanout")
+    return _fanout_pool
+
+def _fan_out(send, admins: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+    """
+    ينفّذ send(admin_id) لكل أدمن بالتوازي ويرجّع [(admin_id, message_id)] بترتيب الاكتمال.
+    send يرجّع الرسالة ذات الأزرار (أو None).
+    """
+    admins = _admin_targets() if admins is None else admins
+    futs = {_get_fanout_pool().submit(send, aid): aid for aid in admins}
+    pairs = []
+    for f in as_completed(futs):
+        aid = futs[f]
+        try:
+            m = f.result()
+        except Exception:
+            logging.exception("[QUEUE] admin notify failed for %s", aid)
+            continue
+        mid = getattr(m, "message_id", None)
+        if mid:
+            pairs.append((aid, mid))
+    return pairs
+
+def _is_file_id(media) -> bool:
+    return isinstance(media, str) and not media.startswith(("http://", "https://", "attach://"))
+
+def _send_text(bot, admin_id: int, text: str, keyboard: InlineKeyboardMarkup):
+    return call_limited(bot.send_message, admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
+
+def _send_photo_to(bot, admin_id: int, photo, text: str, keyboard: InlineKeyboardMarkup):
     try:
         if text and len(text) <= _MAX_CAPTION:
-            for admin_id in _admin_targets():
-                m = bot.send_photo(admin_id, photo_id, caption=text, parse_mode="HTML", reply_markup=keyboard)
-                try:
-                    sent.append((admin_id, m.message_id))
-                except Exception:
-                    pass
-        else:
-            for admin_id in _admin_targets():
-                bot.send_photo(admin_id, photo_id, caption="🖼️ تفاصيل الطلب في الرسالة التالية ⬇️", parse_mode="HTML")
-                m = bot.send_message(admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
-                try:
-                    sent.append((admin_id, m.message_id))
-                except Exception:
-                    pass
+            return call_limited(bot.send_photo, admin_id, photo, caption=text, parse_mode="HTML", reply_markup=keyboard)
+        call_limited(bot.send_photo, admin_id, photo, caption="🖼️ تفاصيل الطلب في الرسالة التالية ⬇️", parse_mode="HTML")
+        return _send_text(bot, admin_id, text, keyboard)
     except Exception:
-        logging.exception("Failed sending admin photo/message; falling back to text-only")
-        for admin_id in _admin_targets():
-            m = bot.send_message(admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
-            try:
-                sent.append((admin_id, m.message_id))
-            except Exception:
-                pass
-    return sent
+        logging.exception("Failed sending admin photo to %s; falling back to text-only", admin_id)
+        return _send_text(bot, admin_id, text, keyboard)
 
-def process_queue(bot):
-    global _queue_cooldown
-    if _queue_cooldown:
-        return
+def _send_admin_with_photo(bot, photo_id: str, text: str, keyboard: InlineKeyboardMarkup):
+    # يرسل صورة/رسالة لكل الأدمن بالتوازي ويُعيد قائمة [(admin_id, message_id)] للرسائل ذات الأزرار.
+    admins = _admin_targets()
+    sent = []
+    if not _is_file_id(photo_id) and admins:
+        # رابط/ملف: ارفع مرة لأول أدمن ثم أعد استخدام file_id للبقية بدل رفعه لكل واحد
+        first = admins.pop(0)
+        try:
+            m = _send_photo_to(bot, first, photo_id, text, keyboard)
+            if getattr(m, "message_id", None):
+                sent.append((first, m.message_id))
+            if getattr(m, "photo", None):
+                photo_id = m.photo[-1].file_id
+        except Exception:
+            logging.exception("[QUEUE] admin notify failed for %s", first)
+    return sent + _fan_out(lambda aid: _send_photo_to(bot, aid, photo_id, text, keyboard), admins)
 
-    with _queue_lock:
-        req = get_next_request()
-        if not req:
-            return
+def _send_admin_with_album(bot, images: List[str], text: str, keyboard: InlineKeyboardMarkup):
+    # ألبوم ثم رسالة الأزرار لكل أدمن (بالتوازي بين الأدمن، وبالترتيب داخل محادثة كل أدمن).
+    admins = _admin_targets()
 
-        request_id = req.get("id")
+    def _one(aid, files):
+        try:
+            msgs = call_limited(bot.send_media_group, aid, [InputMediaPhoto(fid) for fid in files])
+        except Exception:
+            logging.exception("Failed to send media group to %s, fallback to message only", aid)
+            msgs = None
+        return msgs, _send_text(bot, aid, text, keyboard)
 
-        # منع تكرار إرسال نفس الطلب ضمن نافذة قصيرة
+    sent = []
+    if not all(_is_file_id(x) for x in images) and admins:
+        first = admins.pop(0)
+        try:
+            msgs, m = _one(first, images)
+            if getattr(m, "message_id", None):
+                sent.append((first, m.message_id))
+            if msgs and len(msgs) == len(images):
+                images = [x.photo[-1].file_id if getattr(x, "photo", None) else f for x, f in zip(msgs, images)]
+        except Exception:
+            logging.exception("[QUEUE] admin notify failed for %s", first)
+    return sent + _fan_out(lambda aid: _one(aid, images)[1], admins)
+
+def _queue_keyboard(request_id) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("📌 استلمت", callback_data=f"admin_queue_claim_{request_id}"),
+        InlineKeyboardButton("🔁 تأجيل",  callback_data=f"admin_queue_postpone_{request_id}"),
+        InlineKeyboardButton("✅ تأكيد",   callback_data=f"admin_queue_accept_{request_id}"),
+        InlineKeyboardButton("🚫 إلغاء",  callback_data=f"admin_queue_cancel_{request_id}"),
+        InlineKeyboardButton("✉️ رسالة للعميل", callback_data=f"admin_queue_message_{request_id}"),
+        InlineKeyboardButton("🖼️ صورة للعميل", callback_data=f"admin_queue_photo_{request_id}")
+    )
+    return keyboard
+
+def _dispatch(bot, req: Dict[str, Any]) -> None:
+    """يعرض طلبًا محجوزًا على كل الأدمن ويحفظ مراجع الرسائل في payload.admin_msgs."""
+    request_id = req.get("id")
+    text = req.get("request_text", "") or "طلب جديد"
+    keyboard = _queue_keyboard(request_id)
+
+    payload  = req.get("payload") or {}
+    typ      = payload.get("type")
+    photo_id = payload.get("photo")
+
+    # إعادة عرض بعد انتهاء المهلة: عطّل أزرار الرسائل القديمة
+    for entry in payload.get("admin_msgs") or []:
         try:
-            now_ts = int(time.time())
-            last   = _recently_sent.get(request_id)
-            if last and (now_ts - last) < _RECENT_TTL:
-                return
-            _recently_sent[request_id] = now_ts
+            if entry.get("admin_id") and entry.get("message_id"):
+                bot.edit_message_reply_markup(entry["admin_id"], entry["message_id"], reply_markup=None)
         except Exception:
             pass
 
-        text = req.get("request_text", "") or "طلب جديد"
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            InlineKeyboardButton("📌 استلمت", callback_data=f"admin_queue_claim_{request_id}"),
-            InlineKeyboardButton("🔁 تأجيل",  callback_data=f"admin_queue_postpone_{request_id}"),
-            InlineKeyboardButton("✅ تأكيد",   callback_data=f"admin_queue_accept_{request_id}"),
-            InlineKeyboardButton("🚫 إلغاء",  callback_data=f"admin_queue_cancel_{request_id}"),
-            InlineKeyboardButton("✉️ رسالة للعميل", callback_data=f"admin_queue_message_{request_id}"),
-            InlineKeyboardButton("🖼️ صورة للعميل", callback_data=f"admin_queue_photo_{request_id}")
-        )
+    sent_pairs = []  # [(admin_id, message_id)]
+
+    # =========== فرع شحن المحفظة ===========
+    if typ == "recharge" and photo_id:
+        sent_pairs = _send_admin_with_photo(bot, photo_id, text, keyboard)
 
-        payload  = req.get("payload") or {}
-        typ      = payload.get("type")
-        photo_id = payload.get("photo")
-
-        sent_pairs = []  # [(admin_id, message_id)]
-
-        # =========== فرع شحن المحفظة ===========
-        if typ == "recharge" and photo_id:
-            sent_pairs = _send_admin_with_photo(bot, photo_id, text, keyboard)
-
-        # =========== فرع إعلانات القناة ===========
-        elif typ == "ads":
-            images = payload.get("images", [])
-            if images:
-                if len(images) == 1:
-                    sent_pairs = _send_admin_with_photo(bot, images[0], text, keyboard)
-                else:
-                    try:
-                        media = [InputMediaPhoto(fid) for fid in images]
-                        for admin_id in _admin_targets():
-                            bot.send_media_group(admin_id, media)
-                    except Exception:
-                        logging.exception("Failed to send media group, fallback to message only")
-                    for admin_id in _admin_targets():
-                        m = bot.send_message(admin_id, text, parse_mode="HTML", reply_markup=keyboard)
-                        try:
-                            sent_pairs.append((admin_id, m.message_id))
-                        except Exception:
-                            pass
+    # =========== فرع إعلانات القناة ===========
+    elif typ == "ads":
+        images = payload.get("images", [])
+        if images:
+            if len(images) == 1:
+                sent_pairs = _send_admin_with_photo(bot, images[0], text, keyboard)
             else:
-                for admin_id in _admin_targets():
-                    m = bot.send_message(admin_id, text, parse_mode="HTML", reply_markup=keyboard)
-                    try:
-                        sent_pairs.append((admin_id, m.message_id))
-                    except Exception:
-                        pass
-
-        # =========== الأنواع الأخرى ===========
+                sent_pairs = _send_admin_with_album(bot, images, text, keyboard)
         else:
-            for admin_id in _admin_targets():
-                m = bot.send_message(admin_id, text, reply_markup=keyboard, parse_mode="HTML")
-                try:
-                    sent_pairs.append((admin_id, m.message_id))
-                except Exception:
-                    pass
+            sent_pairs = _fan_out(lambda aid: _send_text(bot, aid, text, keyboard))
 
-        # حفظ admin_msgs مع تفريغ القفل
-        try:
-            entries = [{'admin_id': aid, 'message_id': mid} for (aid, mid) in sent_pairs if aid and mid]
-            # لاحظ: نبقي payload الأخرى كما هي ونضيف/نحدث admin_msgs والقفل
-            old = _payload_get(request_id)
-            old['admin_msgs'] = entries
-            old['locked_by'] = None
-            old['locked_by_username'] = None
-            get_table(QUEUE_TABLE).update({"payload": old}).eq("id", request_id).execute()
-        except Exception:
-            logging.exception("Failed to persist admin message IDs for request %s", request_id)
+    # =========== الأنواع الأخرى ===========
+    else:
+        sent_pairs = _fan_out(lambda aid: _send_text(bot, aid, text, keyboard))
 
-def queue_cooldown_start(bot=None):
-    # إطلاق فترة خمول قصيرة ثم إعادة تشغيل الطابور.
-    global _queue_cooldown
-    _queue_cooldown = True
+    # حفظ admin_msgs (القفل صار في أعمدة claimed_by/lease_until)
+    try:
+        entries = [{'admin_id': aid, 'message_id': mid} for (aid, mid) in sent_pairs if aid and mid]
+        _payload_update(request_id, {"admin_msgs": entries})
+    except Exception:
+        logging.exception("Failed to persist admin message IDs for request %s", request_id)
+
+def _safe_dispatch(bot, req: Dict[str, Any]) -> None:
+    try:
+        _dispatch(bot, req)
+    except Exception:
+        logging.exception("[QUEUE] dispatch failed for request %s", req.get("id"))
+
+
+# ================= مسارات الأولوية + المجدول =================
+
+def lane_of(payload: Optional[Dict[str, Any]]) -> str:
+    typ = ((payload or {}).get("type") or "").strip()
+    return _TYPE_LANE.get(typ, DEFAULT_LANE)
+
+def _lane_conf(lane: Optional[str]) -> Tuple[Tuple[str, ...], int, float]:
+    return QUEUE_LANES.get(lane or DEFAULT_LANE) or QUEUE_LANES[DEFAULT_LANE]
+
+def sla_due_for(lane: str, created_at: datetime) -> datetime:
+    return created_at + timedelta(minutes=_lane_conf(lane)[1])
 
-    def release():
-        global _queue_cooldown
-        time.sleep(30)           # نصف دقيقة
-        _queue_cooldown = False
-        if bot is not None:
-            process_queue(bot)
+def _req_lane(req: Dict[str, Any]) -> str:
+    lane = req.get("lane")
+    return lane if lane in QUEUE_LANES else lane_of(req.get("payload"))
 
-    threading.Thread(target=release, daemon=True).start()
+def request_sla_due(req: Dict[str, Any]) -> datetime:
+    due = _parse_ts(req.get("sla_due_at"))
+    if due is None:
+        due = sla_due_for(_req_lane(req), _parse_ts(req.get("created_at")) or _now_utc())
+    return due
 
+def _aged(req: Dict[str, Any], now: datetime) -> bool:
+    """الطلب استهلك QUEUE_AGEING_FRACTION من SLA مساره → يتقدم على الحصص."""
+    sla = timedelta(minutes=_lane_conf(_req_lane(req))[1])
+    return request_sla_due(req) - now <= sla * (1.0 - QUEUE_AGEING_FRACTION)
 
-def reset_recent_silently(request_id: int):
+def _rank(cands: List[Dict[str, Any]], k: int, now: datetime) -> List[Dict[str, Any]]:
     """
-    ينسف كاش منع التكرار لطلب معيّن حتى يُسمَح بإعادة إرساله فورًا عند التأجيل.
-    يستخدم داخل postpone_request.
+    يختار حتى k طلبًا بالترتيب:
+      1) المتقادمة (قاربت/تجاوزت SLA) حسب الأقرب موعدًا.
+      2) الباقي بطابور عادل موزون (start-time fair queueing) بين المسارات،
+         وداخل المسار الأقرب موعدًا — فالمسار الأثقل وزنًا يأخذ حصة أكبر دون تجويع البقية.
+    لا يغيّر حالة المجدول؛ الخصم الفعلي في _charge لما يُحجز فعلًا.
     """
-    try:
-        _recently_sent.pop(request_id, None)
-    except Exception:
-        pass
+    ordered = sorted(cands, key=request_sla_due)
+    picked = [r for r in ordered if _aged(r, now)][:k]
+    taken = {id(r) for r in picked}
+    lanes: Dict[str, List[Dict[str, Any]]] = {}
+    for r in ordered:
+        if id(r) not in taken:
+            lanes.setdefault(_req_lane(r), []).append(r)
+    vt = dict(_lane_vtime)
+    while len(picked) < k and lanes:
+        for lane in lanes:
+            vt[lane] = max(vt.get(lane, 0.0), _vclock)
+        lane = min(lanes, key=lambda l: (vt[l], -_lane_conf(l)[2]))
+        picked.append(lanes[lane].pop(0))
+        vt[lane] += 1.0 / _lane_conf(lane)[2]
+        if not lanes[lane]:
+            del lanes[lane]
+    return picked
+
+def _charge(rows: List[Dict[str, Any]]) -> None:
+    """يحدّث الزمن الافتراضي للمسارات بما حُجز فعلًا."""
+    global _vclock
+    with _sched_lock:
+        for r in rows:
+            lane = _req_lane(r)
+            start = max(_lane_vtime.get(lane, 0.0), _vclock)
+            _lane_vtime[lane] = start + 1.0 / _lane_conf(lane)[2]
+            _vclock = start
+
+def sla_text(req: Dict[str, Any], now: Optional[datetime] = None) -> str:
+    """سطر «الوقت حتى SLA» لقائمة الطابور."""
+    now = now or _now_utc()
+    lane = _req_lane(req)
+    mins = int((request_sla_due(req) - now).total_seconds() // 60)
+    label = LANE_LABELS.get(lane, lane)
+    if mins >= 0:
+        return f"⏱️ {label} — متبقٍ {mins}د على SLA"
+    return f"🔴 {label} — متأخر {-mins}د عن SLA"
+
+
+# ================= الموزّع =================
+
+def _is_missing_rpc(e: Exception) -> bool:
+    msg = str(e)
+    return "PGRST202" in msg or "42883" in msg or "Could not find the function" in msg
+
+def _candidates(now: datetime) -> List[Dict[str, Any]]:
+    """طلبات غير محجوزة ومتاحة الآن، الأقرب موعد SLA أولًا."""
+    global _SLA_COLUMNS
+    q = (
+        get_table(QUEUE_TABLE)
+        .select("*")
+        .or_(f'lease_until.is.null,lease_until.lte."{now.isoformat()}"')
+    )
+    if _SLA_COLUMNS:
+        try:
+            res = q.order("sla_due_at", desc=False, nullsfirst=True).order("created_at").limit(QUEUE_CANDIDATES).execute()
+        except APIError as e:
+            if getattr(e, "code", None) != "42703":
+                raise
+            _SLA_COLUMNS = False  # ترحيل 0012 غير مطبّق: الترتيب بـ created_at
+            return _candidates(now)
+    else:
+        res = q.order("created_at").limit(QUEUE_CANDIDATES).execute()
+    return [r for r in (res.data or []) if (_parse_ts(r.get("available_at")) or now) <= now]
+
+def list_by_sla(limit: int = 30) -> List[Dict[str, Any]]:
+    """أقرب limit طلبًا موعد SLA (لقائمة الأدمن): الترتيب في القاعدة قبل الحد، لا بعده."""
+    global _SLA_COLUMNS
+    q = get_table(QUEUE_TABLE).select("*")
+    if _SLA_COLUMNS:
+        try:
+            res = q.order("sla_due_at", desc=False, nullsfirst=True).order("created_at").limit(limit).execute()
+            return sorted(res.data or [], key=request_sla_due)
+        except APIError as e:
+            if getattr(e, "code", None) != "42703":
+                raise
+            _SLA_COLUMNS = False
+            return list_by_sla(limit)
+    res = q.order("created_at").limit(limit).execute()
+    return sorted(res.data or [], key=request_sla_due)
+
+def _claim_rpc(ids: List[int]) -> List[Dict[str, Any]]:
+    r = client().rpc("queue_claim", {
+        "p_worker": _WORKER_ID,
+        "p_max_inflight": QUEUE_CONCURRENCY,
+        "p_lease_seconds": QUEUE_LEASE_SECONDS,
+        "p_ids": ids,
+    }).execute()
+    return r.data or []
+
+def _claim_legacy(ids: List[int]) -> List[Dict[str, Any]]:
+    # بدون الدالة: نفس المنطق عبر تحديثات شرطية (قد تتجاوز عدة نسخ الحد لحظيًا)
+    now = _now_utc()
+    now_q = f'"{now.isoformat()}"'
+    inflight = get_table(QUEUE_TABLE).select("id").gt("lease_until", now.isoformat()).execute()
+    slots = QUEUE_CONCURRENCY - len(inflight.data or [])
+    out = []
+    for rid in ids:
+        if len(out) >= slots:
+            break
+        r = (
+            get_table(QUEUE_TABLE)
+            .update({
+                "lease_owner": _WORKER_ID,
+                "lease_until": (now + timedelta(seconds=QUEUE_LEASE_SECONDS)).isoformat(),
+                "dispatched_at": now.isoformat(),
+                "claimed_by": None,
+                "claimed_by_username": None,
+            })
+            .eq("id", rid)
+            .or_(f"lease_until.is.null,lease_until.lte.{now_q}")
+            .execute()
+        )
+        out.extend(r.data or [])
+    return out
+
+def _claim_due() -> List[Dict[str, Any]]:
+    global _RPC_SUPPORTED
+    now = _now_utc()
+    cands = _candidates(now)
+    if not cands:
+        return []
+    ids = [int(r["id"]) for r in _rank(cands, QUEUE_CONCURRENCY, now)]
+    rows = None
+    if _RPC_SUPPORTED:
+        try:
+            rows = _claim_rpc(ids)
+        except Exception as e:
+            if not _is_missing_rpc(e):
+                raise
+            _RPC_SUPPORTED = False
+            logging.warning("[QUEUE] queue_claim(p_ids) not installed; using conditional updates")
+    if rows is None:
+        rows = _claim_legacy(ids)
+    _charge(rows)
+    return rows
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=max(1, QUEUE_CONCURRENCY), thread_name_prefix="queue")
+    return _pool
+
+def _dispatch_tick(bot) -> int:
+    rows = _claim_due()
+    for req in rows:
+        _get_pool().submit(_safe_dispatch, bot, req)
+    return len(rows)
+
+def _dispatcher_loop() -> None:
+    while True:
+        _wake.wait(timeout=QUEUE_POLL_SECONDS)
+        _wake.clear()
+        try:
+            _dispatch_tick(_bot)
+        except Exception as e:
+            logging.warning("[QUEUE] dispatcher tick error: %s", e)
+
+def _listen_loop(dsn: str) -> None:
+    """LISTEN pending_requests على اتصال Postgres مباشر؛ أي إشعار يوقظ الموزّع."""
+    import select
+    backoff = 1.0
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.set_isolation_level(0)  # autocommit
+            conn.cursor().execute("LISTEN pending_requests")
+            backoff = 1.0
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    _wake.set()
+        except Exception as e:
+            logging.warning("[QUEUE] LISTEN connection lost: %s (retry in %.0fs)", e, backoff)
+            time.sleep(backoff)
+            backoff = min(60.0, backoff * 2)
+        finally:
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+
+def notify_queue() -> None:
+    """يوقظ الموزّع (طلب جديد/تحررت خانة/تأجيل)."""
+    _wake.set()
+
+def start_queue_dispatcher(bot) -> None:
+    """يشغّل الموزّع مرة واحدة (وخيط LISTEN إن توفر QUEUE_LISTEN_DSN و psycopg2)."""
+    global _started, _bot
+    with _start_lock:
+        _bot = bot
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_dispatcher_loop, name="queue-dispatcher", daemon=True).start()
+    if QUEUE_LISTEN_DSN and psycopg2 is not None:
+        threading.Thread(target=_listen_loop, args=(QUEUE_LISTEN_DSN,), name="queue-listen", daemon=True).start()
+    elif QUEUE_LISTEN_DSN:
+        logging.warning("[QUEUE] QUEUE_LISTEN_DSN set but psycopg2 is not installed; local wake-ups only")
+    _wake.set()
+
+def process_queue(bot):
+    """متوافقة مع الاستدعاءات القديمة بعد add_pending_request: تضمن تشغيل الموزّع وتوقظه."""
+    start_queue_dispatcher(bot)
+    notify_queue()
+
+def queue_cooldown_start(bot=None):
+    # سابقًا: خمول 30 ثانية بعد كل إجراء. الآن الإجراء يحرر خانته فيُعرض التالي فورًا.
+    if bot is not None:
+        start_queue_dispatcher(bot)
+    notify_queue()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# services/rate_limiter.py — Token bucket لكل (مستخدم، مسار) داخل الذاكرة، مع خلفية Redis اختيارية
+"""
+- allow(user_id, route) يستهلك توكن واحد؛ False يعني تجاوز الحد.
+- حد كل مسار: capacity (أقصى دفعة) و per_seconds (زمن استعادة توكن واحد).
+  القيم الافتراضية تُمرَّر من المنادي، ويمكن تجاوزها عبر configure_route أو
+  متغير البيئة RATE_LIMITS="wallet_confirm_transfer=1/3,recharge_photo=2/1".
+- الذاكرة محدودة: الدلاء موزعة على RATE_LIMIT_SHARDS جزء (قفل لكل جزء حسب المستخدم)
+  وكل جزء يطرد الأقدم استخدامًا (LRU) عند تجاوز حصته من RATE_LIMIT_MAX_KEYS.
+- عند ضبط RATE_LIMIT_REDIS_URL (وتوفّر حزمة redis) تُحفظ الدلاء في Redis لتشترك
+  بها عدة نسخ من البوت؛ وأي عطل في Redis يرجع للذاكرة المحلية تلقائيًا.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+try:
+    import redis  # اختياري
+except Exception:
+    redis = None
+
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16") or 16)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000") or 50000)
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "").strip()
+
+# route -> (capacity, per_seconds)
+_ROUTES: Dict[str, Tuple[float, float]] = {}
+
+
+def configure_route(route: str, capacity: float = 1, per_seconds: float = 2.0) -> None:
+    """يضبط حد مسار معيّن (يتقدم على القيم الممررة من المنادي)."""
+    _ROUTES[route] = (max(1.0, float(capacity)), max(0.001, float(per_seconds)))
+
+
+def _load_env_routes() -> None:
+    for part in (os.getenv("RATE_LIMITS") or "").split(","):
+        part = part.strip()
+        if not part or "=" not in part:
+            continue
+        route, spec = part.split("=", 1)
+        try:
+            cap, _, per = spec.partition("/")
+            configure_route(route.strip(), float(cap), float(per or 1))
+        except Exception:
+            logging.warning("[rate_limiter] bad RATE_LIMITS entry: %s", part)
+
+_load_env_routes()
+
+
+# ---------- الخلفية المحلية ----------
+class _Shard:
+    __slots__ = ("lock", "buckets", "max_keys")
+
+    def __init__(self, max_keys: int):
+        self.lock = threading.Lock()
+        self.buckets: "OrderedDict[Tuple[int, str], list]" = OrderedDict()
+        self.max_keys = max_keys
+
+    def take(self, key: Tuple[int, str], capacity: float, per_seconds: float, now: float) -> bool:
+        with self.lock:
+            b = self.buckets.get(key)
+            if b is None:
+                b = [capacity, now]
+                self.buckets[key] = b
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                b[0] = min(capacity, b[0] + (now - b[1]) / per_seconds)
+                b[1] = now
+            if b[0] >= 1.0:
+                b[0] -= 1.0
+                return True
+            return False
+
+
+_shards = [_Shard(max(1, RATE_LIMIT_MAX_KEYS // max(1, RATE_LIMIT_SHARDS))) for _ in range(max(1, RATE_LIMIT_SHARDS))]
+
+
+def _local_take(user_id: int, route: str, capacity: float, per_seconds: float) -> bool:
+    shard = _shards[hash(user_id) % len(_shards)]
+    return shard.take((user_id, route), capacity, per_seconds, time.monotonic())
+
+
+# ---------- خلفية Redis (اختيارية) ----------
+# KEYS[1]=مفتاح الدلو, ARGV = capacity, per_seconds, ttl_ms ; الوقت من ساعة Redis نفسها
+_REDIS_LUA = """
+local cap = tonumber(ARGV[1])
+local per = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local v = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(v[1])
+local ts = tonumber(v[2])
+if tokens == nil then
+  tokens = cap
+else
+  tokens = math.min(cap, tokens + (now - ts) / per)
+end
+local ok = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  ok = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ttl)
+return ok
+"""
+
+_redis_script = None
+_redis_disabled_until = 0.0
+_REDIS_RETRY_AFTER = 30.0
+
+
+def _get_redis_script():
+    global _redis_script
+    if _redis_script is None and redis is not None and RATE_LIMIT_REDIS_URL:
+        r = redis.Redis.from_url(RATE_LIMIT_REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2)
+        _redis_script = r.register_script(_REDIS_LUA)
+    return _redis_script
+
+
+def _redis_take(user_id: int, route: str, capacity: float, per_seconds: float) -> Optional[bool]:
+    """True/False من Redis، أو None لو Redis غير مفعّل/متعطّل (→ الخلفية المحلية)."""
+    global _redis_disabled_until
+    if time.monotonic() < _redis_disabled_until:
+        return None
+    try:
+        script = _get_redis_script()
+        if script is None:
+            return None
+        ttl_ms = int(max(1.0, capacity * per_seconds) * 2000)
+        return bool(script(keys=[f"rl:{route}:{user_id}"], args=[capacity, per_seconds, ttl_ms]))
+    except Exception as e:
+        logging.warning("[rate_limiter] redis unavailable, using local buckets: %s", e)
+        _redis_disabled_until = time.monotonic() + _REDIS_RETRY_AFTER
+        return None
+
+
+# ---------- الواجهة ----------
+def allow(user_id: int, route: str, capacity: float = 1, per_seconds: float = 2.0) -> bool:
+    """يستهلك توكن لـ (user_id, route). يرجّع False إذا نفدت التوكنات (طلب سريع زيادة)."""
+    capacity, per_seconds = _ROUTES.get(route, (max(1.0, float(capacity)), max(0.001, float(per_seconds))))
+    uid = int(user_id)
+    res = _redis_take(uid, route, capacity, per_seconds)
+    if res is None:
+        res = _local_take(uid, route, capacity, per_seconds)
+    return res
+
+
+def reset(user_id: int, route: Optional[str] = None) -> None:
+    """يمسح دلاء المستخدم محليًا (كل المسارات أو مسارًا واحدًا)."""
+    uid = int(user_id)
+    shard = _shards[hash(uid) % len(_shards)]
+    with shard.lock:
+        for key in [k for k in shard.buckets if k[0] == uid and (route is None or k[1] == route)]:
+            shard.buckets.pop(key, None)
+
+
+def stats() -> Dict[str, int]:
+    return {
+        "keys": sum(len(s.buckets) for s in _shards),
+        "shards": len(_shards),
+        "redis": int(bool(RATE_LIMIT_REDIS_URL and redis is not None)),
+    }
@@ -4,9 +4,9 @@ from typing import Dict, Any, Tuple
 from datetime import datetime, timedelta, timezone
 import logging
 
-from telebot import apihelper
 from database.db import get_table
-from services.discount_service import create_discount, set_discount_active
+from services import membership_cache
+from services.discount_service import create_discount, set_discount_active, invalidate_discounts
 from config import FORCE_SUB_CHANNEL_ID, CHANNEL_USERNAME, BOT_USERNAME
 
 # محاولة استخدام ساعة المشروع (UTC-aware)، وإلا فـ fallback
@@ -29,15 +29,10 @@ def _ok_member_status(s: str) -> bool:
     return s in ("member", "administrator", "creator")
 
 
-def _is_member(bot, user_id: int) -> bool:
-    """فحص اشتراك المستخدم في القناة عبر get_chat_member."""
+def _is_member(bot, user_id: int, recheck_negative: bool = False) -> bool:
+    """فحص اشتراك المستخدم في القناة (get_chat_member عبر كاش العضوية)."""
     try:
-        m = bot.get_chat_member(FORCE_SUB_CHANNEL_ID, int(user_id))
-        st = getattr(m, "status", None)
-        return _ok_member_status(st)
-    except apihelper.ApiTelegramException as e:
-        logging.warning(f"[referral] get_chat_member failed for {user_id}: {e}")
-        return False
+        return membership_cache.is_member(bot, FORCE_SUB_CHANNEL_ID, int(user_id), recheck_negative=recheck_negative)
     except Exception as e:
         logging.exception(f"[referral] membership check error: {e}")
         return False
@@ -177,7 +172,7 @@ def verify_and_count(bot, referrer_id: int, referred_id: int) -> Tuple[bool, str
         return False, "⚠️ لا يوجد هدف فعال لهذا اليوم."
 
     goal = goals[0]
-    is_mem = _is_member(bot, referred_id)
+    is_mem = _is_member(bot, referred_id, recheck_negative=True)
 
     # حدّث سجل join
     try:
@@ -255,10 +250,13 @@ def revalidate_user_discount(bot, user_id: int) -> bool:
     jq = get_table(JOINS_TBL).select("*").eq("goal_id", goal["id"]).execute()
     joins = getattr(jq, "data", []) or []
 
+    # فحص فعلي لكل الأصدقاء بالتوازي (max_age=0: من غادر القناة لا يُحسب عضوًا من الكاش)
+    members = membership_cache.check_many(bot, FORCE_SUB_CHANNEL_ID, [int(j.get("referred_id")) for j in joins], max_age=0)
+
     still = 0
     for j in joins:
         rid = int(j.get("referred_id"))
-        is_mem = _is_member(bot, rid)
+        is_mem = members.get(rid, False)
         try:
             (
                 get_table(JOINS_TBL)
@@ -282,6 +280,7 @@ def revalidate_user_discount(bot, user_id: int) -> bool:
             if not ok:
                 try:
                     get_table(DISCOUNTS_TBL).update({"active": False}).eq("id", did).execute()
+                    invalidate_discounts()
                 except Exception:
                     pass
     return ok
@@ -1,12 +1,26 @@
 # services/report_service.py
-from datetime import datetime, timedelta
+# الأرقام تُقرأ من التجميعات اليومية (services/rollup_service)؛ لو الترحيل 0015 غير مطبق
+# نرجع لمسح الجداول الخام كما في السابق.
+from datetime import datetime, timedelta, timezone
 from database.db import get_table
+from services import rollup_service as rollups
 
 TRANSACTION_TABLE = "transactions"
 PURCHASES_TABLE   = "purchases"
 PENDING_TABLE     = "pending_requests"
 
 def totals_deposits_and_purchases_syp():
+    t = rollups.totals(("deposits", "spend"))
+    p = rollups.totals(("product",), by_dim=True)
+    if t is None or p is None:
+        return _legacy_totals()
+    dep = t.get("deposits", (0, 0))[0]
+    pur = t.get("spend", (0, 0))[0]
+    counter = {dim: cnt for (_m, dim), (_v, cnt) in p.items()}
+    top = sorted(counter.items(), key=lambda x: x[1], reverse=True)[:5]
+    return dep, pur, top
+
+def _legacy_totals():
     # إجمالي الإيداعات = مجموع المبالغ الموجبة
     resp = get_table(TRANSACTION_TABLE).select("amount, description").execute()
     dep = 0
@@ -31,6 +45,20 @@ def pending_queue_count():
     return len(resp.data or [])
 
 def summary(period: str = "day"):
+    # مع التجميعات: أيام تقويمية (UTC) — "day" = منذ بداية اليوم، "week" = آخر 7 أيام
+    start = rollups.since_day(7 if period == "week" else 1)
+    t = rollups.totals(("sales", "credits", "queue_new"), start=start)
+    if t is None:
+        return _legacy_summary(period)
+    return {
+        "since": datetime(start.year, start.month, start.day, tzinfo=timezone.utc).isoformat(),
+        "total_sales": t.get("sales", (0, 0))[0],
+        "count_sales": t.get("sales", (0, 0))[1],
+        "total_deposits": t.get("credits", (0, 0))[0],
+        "count_new_requests": t.get("queue_new", (0, 0))[1],
+    }
+
+def _legacy_summary(period: str = "day"):
     now = datetime.utcnow()
     if period == "week":
         since = now - timedelta(days=7)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# services/rollup_service.py
+"""
+تجميعات يومية للتقارير (database/sql/0015_daily_rollups.sql):
+  * rollup_compact: دالة على الخادم تضيف الصفوف الجديدة فقط من transactions/purchases/
+    purchase_history/discount_uses/admin_ledger إلى daily_rollups (علامة مائية بالـ id لكل مصدر).
+    تعمل كل ROLLUP_COMPACT_SECONDS — أقصر بكثير من نافذة تنظيف الـ14 ساعة، فلا يضيع شيء
+    من الجداول المؤقتة قبل تجميعه. التقارير تستدعي compact() قبل القراءة (رخيص: الجديد فقط).
+  * bump(): عدادات من التطبيق لا مصدر دائم لها (طلبات الطابور تُحذف بعد المعالجة)؛
+    تُجمع في الذاكرة وتُرسل دفعة واحدة مع كل ضغط عبر rollup_apply.
+  * read()/totals(): قراءة صفوف قليلة (يوم × مقياس × بُعد) بدل مسح الجداول الخام.
+
+لو الترحيل غير مطبق، أو فشل آخر ضغط، أو مرّ على آخر ضغط ناجح أكثر من ROLLUP_STALE_SECONDS،
+أو فشل مصدر مقياس مطلوب (0016: كل مصدر معزول ويُبلَّغ عنه في errors):
+read/totals ترجع None والمنادي يرجع لطريقته القديمة.
+"""
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from database.db import get_table, client
+
+ROLLUPS_TABLE = "daily_rollups"
+
+ROLLUP_COMPACT_SECONDS = int(os.getenv("ROLLUP_COMPACT_SECONDS", "120") or 120)
+ROLLUP_FRESH_SECONDS = float(os.getenv("ROLLUP_FRESH_SECONDS", "15") or 15)
+ROLLUP_STALE_SECONDS = float(os.getenv("ROLLUP_STALE_SECONDS", "900") or 900)
+_PAGE = 1000  # حد PostgREST الافتراضي للصفوف في الطلب
+
+_RPC_SUPPORTED = True
+_last_compact = 0.0          # آخر ضغط ناجح (monotonic)
+_compact_failed = False      # آخر محاولة فشلت كليًا
+_failed_sources: Dict[str, str] = {}  # مصدر → آخر خطأ (من errors في نتيجة rollup_compact)
+_compact_lock = threading.Lock()
+
+# مصدر → المقاييس المبنية منه (لتحديد ما يتأثر بفشل مصدر)
+_SOURCE_METRICS: Dict[str, Tuple[str, ...]] = {
+    "transactions": ("deposits", "spend", "credits", "user_in", "user_out"),
+    "purchases": ("sales", "product"),
+    "purchase_history": ("category",),
+    "discount_uses": ("discount",),
+    "admin_ledger": ("admin_deposit", "admin_spend"),
+}
+
+# (day_iso, metric, dim) -> [value, count]
+_pending: Dict[Tuple[str, str, str], List[int]] = {}
+_pending_lock = threading.Lock()
+
+
+def _is_missing_rpc(e: Exception) -> bool:
+    msg = str(e)
+    return "PGRST202" in msg or "42883" in msg or "Could not find the function" in msg
+
+def _is_missing_table(e: Exception) -> bool:
+    msg = str(e)
+    return "42P01" in msg or "PGRST205" in msg or "does not exist" in msg
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+def since_day(days: int) -> date:
+    """أول يوم في نافذة آخر days يومًا (اليوم الحالي محسوب)."""
+    return _today() - timedelta(days=max(1, int(days)) - 1)
+
+# ────────────────────────────────────────────────────────────
+# عدادات التطبيق
+# ────────────────────────────────────────────────────────────
+def bump(metric: str, value: int = 0, count: int = 1, dim: str = "") -> None:
+    """يزيد عدادًا ليوم اليوم (يُرسل مع الضغط التالي)."""
+    key = (_today().isoformat(), metric, str(dim or ""))
+    with _pending_lock:
+        acc = _pending.setdefault(key, [0, 0])
+        acc[0] += int(value or 0)
+        acc[1] += int(count or 0)
+
+def _flush_pending() -> None:
+    global _RPC_SUPPORTED
+    with _pending_lock:
+        if not _pending:
+            return
+        batch = dict(_pending)
+        _pending.clear()
+    rows = [
+        {"day": d, "metric": m, "dim": dim, "value": v, "count": c}
+        for (d, m, dim), (v, c) in batch.items()
+    ]
+    try:
+        client().rpc("rollup_apply", {"p_rows": rows}).execute()
+    except Exception as e:
+        if _is_missing_rpc(e):
+            _RPC_SUPPORTED = False
+            logging.warning("[rollups] rollup_apply not installed; dropping app counters")
+            return
+        # نعيدها للمخزن لتُرسل في الدورة التالية
+        with _pending_lock:
+            for key, (v, c) in batch.items():
+                acc = _pending.setdefault(key, [0, 0])
+                acc[0] += v
+                acc[1] += c
+        logging.warning(f"[rollups] apply failed: {e}")
+
+# ────────────────────────────────────────────────────────────
+# الضغط
+# ────────────────────────────────────────────────────────────
+def compact(max_age: float = 0.0) -> bool:
+    """
+    يشغّل rollup_compact (ويرسل العدادات المعلقة). max_age>0: يتخطى لو آخر ضغط أحدث من ذلك.
+    يرجع False لو التجميعات غير متاحة (الترحيل غير مطبق).
+    """
+    global _RPC_SUPPORTED, _last_compact, _compact_failed, _failed_sources
+    if not _RPC_SUPPORTED:
+        return False
+    if max_age and time.monotonic() - _last_compact < max_age:
+        return True
+    with _compact_lock:
+        if max_age and time.monotonic() - _last_compact < max_age:
+            return True
+        _flush_pending()
+        if not _RPC_SUPPORTED:
+            return False
+        try:
+            res = client().rpc("rollup_compact", {}).execute()
+            done = dict(getattr(res, "data", None) or {})
+            errors = done.pop("errors", None) or {}
+            _last_compact = time.monotonic()
+            _compact_failed = False
+            _failed_sources = dict(errors)
+            if errors:
+                logging.warning(f"[rollups] compact failed for sources {sorted(errors)}: {errors}")
+            if done:
+                logging.info(f"[rollups] compacted: {done}")
+        except Exception as e:
+            if _is_missing_rpc(e):
+                _RPC_SUPPORTED = False
+                logging.warning("[rollups] rollup_compact not installed; reports scan raw tables")
+                return False
+            _compact_failed = True
+            logging.warning(f"[rollups] compact failed: {e}")
+    return True
+
+def _usable(metrics: List[str]) -> bool:
+    """التجميعات موثوقة لهذه المقاييس: آخر ضغط نجح وحديث ولم يفشل أي مصدر لها."""
+    if _compact_failed or time.monotonic() - _last_compact > ROLLUP_STALE_SECONDS:
+        return False
+    for src in _failed_sources:
+        if set(_SOURCE_METRICS.get(src, ())) & set(metrics):
+            return False
+    return True
+
+def start_rollup_worker(every_seconds: int = ROLLUP_COMPACT_SECONDS):
+    """يُشغَّل من main.py: ضغط دوري للتجميعات اليومية."""
+    def _loop():
+        try:
+            compact()
+        except Exception as e:
+            logging.warning(f"[rollups] tick error: {e}")
+        if _RPC_SUPPORTED:
+            t = threading.Timer(every_seconds, _loop)
+            t.daemon = True
+            t.start()
+    t = threading.Timer(30, _loop)
+    t.daemon = True
+    t.start()
+
+# ────────────────────────────────────────────────────────────
+# القراءة
+# ────────────────────────────────────────────────────────────
+def read(metrics: Iterable[str], start: Optional[date] = None, end: Optional[date] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    صفوف daily_rollups للمقاييس المطلوبة بين start و end (شاملين، None = بلا حد).
+    يرجع None لو التجميعات غير متاحة → على المنادي الرجوع لمسح الجداول الخام.
+    """
+    global _RPC_SUPPORTED
+    if not compact(max_age=ROLLUP_FRESH_SECONDS):
+        return None
+    metrics = list(metrics)
+    if not _usable(metrics):
+        return None
+    out: List[Dict[str, Any]] = []
+    offset = 0
+    try:
+        while True:
+            q = get_table(ROLLUPS_TABLE).select("day, metric, dim, value, count").in_("metric", metrics)
+            if start is not None:
+                q = q.gte("day", start.isoformat())
+            if end is not None:
+                q = q.lte("day", end.isoformat())
+            rows = q.order("day").order("metric").order("dim").range(offset, offset + _PAGE - 1).execute().data or []
+            out.extend(rows)
+            if len(rows) < _PAGE:
+                break
+            offset += _PAGE
+    except Exception as e:
+        if _is_missing_table(e):
+            _RPC_SUPPORTED = False
+        logging.warning(f"[rollups] read failed: {e}")
+        return None
+    return out
+
+def totals(metrics: Iterable[str], start: Optional[date] = None, end: Optional[date] = None,
+           by_dim: bool = False) -> Optional[Dict[Any, Tuple[int, int]]]:
+    """
+    مجاميع (value, count) لكل metric — أو لكل (metric, dim) مع by_dim — عبر الأيام.
+    None = التجميعات غير متاحة.
+    """
+    rows = read(metrics, start, end)
+    if rows is None:
+        return None
+    acc: Dict[Any, List[int]] = {}
+    for r in rows:
+        key = (r.get("metric"), r.get("dim") or "") if by_dim else r.get("metric")
+        a = acc.setdefault(key, [0, 0])
+        a[0] += int(r.get("value") or 0)
+        a[1] += int(r.get("count") or 0)
+    return {k: (v[0], v[1]) for k, v in acc.items()}
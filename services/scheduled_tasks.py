@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
+import logging
 import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict, Any
 from zoneinfo import ZoneInfo
@@ -18,6 +20,7 @@ from services.ads_service import (
     is_first_service_day_today,
     allowed_times_today,
 )
+from services.metrics import observe_tick
 
 GLOBAL_MIN_GAP_MINUTES = 10  # فاصل عالمي بين أي إعلانين
 SYRIA_TZ = ZoneInfo("Asia/Damascus")
@@ -48,7 +51,7 @@ def _safe_publish(bot, ad_row) -> bool:
     try:
         return bool(publish_channel_ad(bot, ad_row))
     except Exception as e:
-        print(f"[ads_task] publish error for ad {ad_row.get('id')}: {e}")
+        logging.warning(f"[ads_task] publish error for ad {ad_row.get('id')}: {e}")
         return False
 
 
@@ -112,7 +115,7 @@ def expire_old_discounts():
             .execute()
         )
     except Exception as e:
-        print(f"[ads_task] expire_old_discounts error: {e}")
+        logging.warning(f"[ads_task] expire_old_discounts error: {e}")
 
 
 def purge_old_discounts(days: int = 2):
@@ -127,7 +130,7 @@ def purge_old_discounts(days: int = 2):
             .execute()
         )
     except Exception as e:
-        print(f"[ads_task] purge_old_discounts error: {e}")
+        logging.warning(f"[ads_task] purge_old_discounts error: {e}")
 
 
 def post_ads_task(bot=None, every_seconds: int = 60):
@@ -140,22 +143,23 @@ def post_ads_task(bot=None, every_seconds: int = 60):
       5) تعطيل الخصومات المنتهية وحذف القديمة اختياريًا.
     """
     def _tick():
+        t0 = time.perf_counter()
         now_utc = datetime.now(timezone.utc)
 
         # (1) تعليم المنتهي
         try:
             expire_old_ads()
         except Exception as e:
-            print(f"[ads_task] expire_old_ads error: {e}")
+            logging.warning(f"[ads_task] expire_old_ads error: {e}")
         try:
             expire_due_goals()
         except Exception as e:
-            print(f"[ads_task] expire_due_goals error: {e}")
+            logging.warning(f"[ads_task] expire_due_goals error: {e}")
 
         # (2) + (3) النشر
         try:
             if is_maintenance() or (not is_feature_enabled("ads")):
-                print("[ads_task] ads disabled or in maintenance; skipping publish tick")
+                logging.info("[ads_task] ads disabled or in maintenance; skipping publish tick")
             else:
                 ads = get_active_ads(limit=400)
 
@@ -179,19 +183,20 @@ def post_ads_task(bot=None, every_seconds: int = 60):
                         if _safe_publish(bot, ad):
                             mark_posted(int(ad["id"]))
         except Exception as e:
-            print(f"[ads_task] main loop error: {e}")
+            logging.warning(f"[ads_task] main loop error: {e}")
 
         # (4) تنظيف إعلانات القناة المنتهية
         try:
             removed = purge_expired_ads(hours_after=14)
             if removed:
-                print(f"[ads_task] purged expired channel ads: {removed}")
+                logging.info(f"[ads_task] purged expired channel ads: {removed}")
         except Exception as e:
-            print(f"[ads_task] purge_expired_ads error: {e}")
+            logging.warning(f"[ads_task] purge_expired_ads error: {e}")
 
         # (5) تعطيل وحذف خصومات منتهية
         expire_old_discounts()
         purge_old_discounts(2)
+        observe_tick("ads", time.perf_counter() - t0)
 
         # إعادة الجدولة
         threading.Timer(every_seconds, _tick).start()
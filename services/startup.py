@@ -0,0 +1,104 @@
+# services/startup.py
+"""
+مساعدات الإقلاع السريع (main.py):
+  * StartupProfile: توقيت كل مرحلة وطباعة ملخص واحد في السجل.
+  * HandlerGate: أول Middleware في السلسلة — يوقف التحديثات التي تصل قبل اكتمال تسجيل
+    الهاندلرز في الخلفية (telebot يمرّ على قائمة الهاندلرز نفسها بعد الانتظار، فيرى كل ما سُجّل).
+  * run_parallel: تشغيل نداءات الشبكة المستقلة معًا بدل التسلسل.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+from telebot.handler_backends import BaseMiddleware
+
+STARTUP_GATE_TIMEOUT = float(os.getenv("STARTUP_GATE_TIMEOUT", "60") or 60)
+
+
+class StartupProfile:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self._marks: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def mark(self, name: str, started: float) -> float:
+        """يسجل مرحلة بدأت عند started (perf_counter) وانتهت الآن؛ يرجع مدتها."""
+        now = time.perf_counter()
+        with self._lock:
+            self._marks.append((name, started - self.t0, now - started))
+        return now - started
+
+    def step(self, name: str):
+        prof = self
+
+        class _Step:
+            def __enter__(self):
+                self.started = time.perf_counter()
+                return self
+
+            def __exit__(self, *exc):
+                prof.mark(name, self.started)
+                return False
+        return _Step()
+
+    def report(self, title: str = "startup") -> str:
+        with self._lock:
+            marks = sorted(self._marks, key=lambda m: m[1])
+        parts = [f"{name} {dur * 1000:.0f}ms@{at * 1000:.0f}" for name, at, dur in marks]
+        line = f"[{title}] total {(time.perf_counter() - self.t0) * 1000:.0f}ms — " + ", ".join(parts)
+        logging.info(line)
+        return line
+
+
+class HandlerGate(BaseMiddleware):
+    """يحجز التحديثات حتى open() (أو STARTUP_GATE_TIMEOUT كحد أقصى)."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = [
+            "message", "edited_message", "callback_query", "inline_query",
+            "chosen_inline_result", "shipping_query", "pre_checkout_query",
+            "poll", "poll_answer", "my_chat_member", "chat_member", "chat_join_request",
+        ]
+        self._ready = threading.Event()
+
+    def open(self) -> None:
+        self._ready.set()
+
+    @property
+    def is_open(self) -> bool:
+        return self._ready.is_set()
+
+    def pre_process(self, message, data):
+        if not self._ready.is_set():
+            if not self._ready.wait(STARTUP_GATE_TIMEOUT):
+                logging.warning("[startup] handlers still registering after %.0fs; processing update anyway",
+                                STARTUP_GATE_TIMEOUT)
+
+    def post_process(self, message, data, exception):
+        pass
+
+
+def run_parallel(calls: Dict[str, Callable[[], Any]], profile: StartupProfile = None) -> Dict[str, Any]:
+    """
+    يشغّل النداءات معًا وينتظرها كلها. النتيجة {name: قيمة أو الاستثناء}.
+    """
+    def _timed(name, fn):
+        started = time.perf_counter()
+        try:
+            return fn()
+        except Exception as e:
+            return e
+        finally:
+            if profile is not None:
+                profile.mark(name, started)
+
+    out: Dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(calls)), thread_name_prefix="startup") as ex:
+        futs = {name: ex.submit(_timed, name, fn) for name, fn in calls.items()}
+        for name, f in futs.items():
+            out[name] = f.result()
+    return out
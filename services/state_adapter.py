@@ -1,22 +1,158 @@
 # services/state_adapter.py
+import logging
+import threading
 from collections.abc import MutableMapping
-from .state_service import get_data, set_data, set_kv, get_kv, clear_state
+from contextlib import contextmanager
+
+from telebot.handler_backends import BaseMiddleware
+
+from .state_service import get_data, set_data, set_kv, get_kv, clear_state, update_data, StateConflict
+
+# جلسة الحالة المفتوحة في هذا الخيط (خيط عامل telebot يعالج تحديثًا واحدًا في كل مرة)
+_local = threading.local()
+
+
+class StateSession:
+    """
+    وحدة عمل لحالة مستخدم واحد خلال تحديث تيليغرام واحد:
+    تُحمَّل الحالة مرة واحدة، وتُتتبَّع التغييرات محليًا، ثم تُسلَّم عند الإغلاق إلى مخزن
+    state_service (الذاكرة) ويدفعها خيط الدفع مجمّعة مع غيرها (تحقق version في القاعدة
+    حتى لا تضيع تحديثات متسابقة لنفس المستخدم). لا طلب شبكة على خيط الهاندلر.
+    """
+
+    def __init__(self, user_id: int, ttl_minutes: int = 120):
+        self.user_id = int(user_id)
+        self.ttl = ttl_minutes
+        self.data = get_data(self.user_id)
+        self._base = dict(self.data)
+        self._sets = {}
+        self._deletes = set()
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._sets or self._deletes)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self._sets[key] = value
+        self._deletes.discard(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        self._sets.pop(key, None)
+        self._deletes.add(key)
+
+    def replace(self, value: dict):
+        for key in list(self.data.keys()):
+            if key not in value:
+                self.delete(key)
+        for key, v in value.items():
+            self.set(key, v)
+
+    def commit(self):
+        """يرفع StateConflict بالمفاتيح التي غيّرها كاتب آخر (لم تُكتب؛ الباقي حُفظ)."""
+        if not self.dirty:
+            return
+        try:
+            update_data(self.user_id, dict(self._sets), set(self._deletes), base=self._base, ttl_minutes=self.ttl)
+        finally:
+            self._base = dict(self.data)
+            self._sets.clear()
+            self._deletes.clear()
+
+
+def active_session(user_id: int):
+    """ترجع جلسة هذا الخيط إن كانت مفتوحة لنفس المستخدم، وإلا None."""
+    s = getattr(_local, "session", None)
+    if s is not None and s.user_id == int(user_id):
+        return s
+    return None
+
+
+def _open_session(user_id: int):
+    """يفتح جلسة (أو يعيد المفتوحة لنفس المستخدم) ويرجع (الجلسة، السابقة، هل نحن المالك)."""
+    prev = getattr(_local, "session", None)
+    if prev is not None and prev.user_id == int(user_id):
+        return prev, prev, False
+    s = StateSession(user_id)
+    _local.session = s
+    return s, prev, True
+
+
+def _close_session(s: StateSession, prev, owner: bool):
+    if not owner:
+        return
+    _local.session = prev
+    try:
+        s.commit()
+    except StateConflict as e:
+        logging.warning("state session for user %s lost a race on keys %s; stored values kept", s.user_id, e.keys)
+    except Exception as e:
+        logging.warning("state session commit failed for user %s: %s", s.user_id, e)
+
+
+@contextmanager
+def state_session(user_id: int):
+    """with state_session(uid): ... — كل قراءات/كتابات user_states[uid] داخل الكتلة تمرّ عبر الجلسة."""
+    s, prev, owner = _open_session(user_id)
+    try:
+        yield s
+    finally:
+        _close_session(s, prev, owner)
+
+
+class StateSessionMiddleware(BaseMiddleware):
+    """يفتح جلسة حالة لكل تحديث وارد (رسالة/ضغطة زر) ويحفظها مرة واحدة بعد انتهاء الهاندلر."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, update, data):
+        uid = getattr(getattr(update, "from_user", None), "id", None)
+        if uid is None:
+            return
+        try:
+            data["state_session"] = _open_session(uid)
+        except Exception as e:
+            # فشل التحميل (شبكة): نكمل بدون جلسة، ويعمل الـ adapter مباشرة كما في السابق
+            logging.warning("state session open failed for user %s: %s", uid, e)
+
+    def post_process(self, update, data, exception):
+        opened = data.get("state_session")
+        if opened:
+            _close_session(*opened)
+
 
 class _DictProxy(MutableMapping):
     def __init__(self, user_id: int, ttl_minutes: int = 120):
         self.user_id = user_id
         self.ttl = ttl_minutes
 
+    def _data(self):
+        s = active_session(self.user_id)
+        return s.data if s is not None else get_data(self.user_id)
+
     def __getitem__(self, key):
-        data = get_data(self.user_id)
+        data = self._data()
         if key in data:
             return data[key]
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        s = active_session(self.user_id)
+        if s is not None:
+            s.set(key, value)
+            return
         set_kv(self.user_id, key, value, ttl_minutes=self.ttl)
 
     def __delitem__(self, key):
+        s = active_session(self.user_id)
+        if s is not None:
+            if key not in s.data:
+                raise KeyError(key)
+            s.delete(key)
+            return
         data = get_data(self.user_id)
         if key in data:
             data.pop(key, None)
@@ -25,12 +161,15 @@ class _DictProxy(MutableMapping):
             raise KeyError(key)
 
     def __iter__(self):
-        return iter(get_data(self.user_id))
+        return iter(list(self._data()))
 
     def __len__(self):
-        return len(get_data(self.user_id))
+        return len(self._data())
 
     def get(self, key, default=None):
+        s = active_session(self.user_id)
+        if s is not None:
+            return s.data.get(key, default)
         # السطر المقطوع المشار إليه هو ببساطة الاستدعاء التالي لاسترجاع القيمة أو الافتراضي:
         return get_kv(self.user_id, key, default)
 
@@ -42,7 +181,7 @@ class _DictProxy(MutableMapping):
         return current
 
 class UserStateDictLike:
-    """واجهة مشابهة للقاموس: user_states[user_id]['step'] = '...' يكتب فوراً في القاعدة."""
+    """واجهة مشابهة للقاموس: user_states[user_id]['step'] = '...' — تُحفظ عبر جلسة التحديث الحالي أو فورًا خارجها."""
     def __getitem__(self, user_id: int) -> _DictProxy:
         return _DictProxy(user_id)
 
@@ -54,15 +193,26 @@ class UserStateDictLike:
             # نحافظ على الحزم مع الأنواع الأخرى (علشان ما نخزن هياكل غير متوقعة)
             raise TypeError("user_states[user_id] يجب أن يكون dict أو str (يُحفظ كـ step)")
 
+        s = active_session(user_id)
+        if s is not None:
+            s.replace(value)
+            return
         # TTL زي ما هو (120 دقيقة)
         set_data(user_id, value, ttl_minutes=120)
 
     def get(self, user_id: int, default=None):
-        data = get_data(user_id)
+        s = active_session(user_id)
+        data = dict(s.data) if s is not None else get_data(user_id)
         return data if data else (default if default is not None else {})
 
     def pop(self, user_id: int, default=None):
         try:
+            s = active_session(user_id)
+            if s is not None:
+                v = dict(s.data)
+                clear_state(user_id)
+                s.replace({})
+                return v
             v = get_data(user_id)
             clear_state(user_id)
             set_data(user_id, {}, ttl_minutes=0)
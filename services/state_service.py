@@ -8,13 +8,20 @@
 - عند الانتهاء نحذف المفاتيح، وإذا أصبحت vars فارغة نحذف الصف بالكامل.
 - يتم ضبط expires_at (عمود الجدول) بالتزامن مع __state_exp لسهولة التنظيف المجدول.
 - تعتمد الدوال على قيد UNIQUE(user_id, state_key) لكي يعمل upsert على نحو صحيح.
+- القراءة والكتابة تمرّان عبر مخزن داخل الذاكرة (write-behind): التعديلات تُطبَّق محليًا
+  ويُدفع آخر vars لكل مستخدم إلى الجدول في الخلفية بعد مهلة قصيرة (upsert مُجمَّع).
 """
 
 from __future__ import annotations
 
+import atexit
+import os
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any, Tuple
-from database.db import get_table
+from typing import Optional, Dict, Any, Tuple, List
+import httpx
+from database.db import get_table, client
 import logging, time  # ← إضافة
 
 TABLE = "user_state"
@@ -46,58 +53,390 @@ def _expires_from_ttl(ttl_minutes: Optional[int]) -> Optional[datetime]:
 
 # ===================== Low-level DB =====================
 
-# ← إضافة: منطق إعادة المحاولة مع backoff خفيف
-_RETRIES = 3
-_BACKOFF = 0.8  # seconds
-
-def _with_retry(op, *args, **kwargs):
-    for i in range(_RETRIES):
-        try:
-            return op(*args, **kwargs)
-        except Exception as e:
-            if i == _RETRIES - 1:
-                raise
-            logging.warning("state_service retry %s/%s: %s", i + 1, _RETRIES, e)
-            time.sleep(_BACKOFF * (i + 1))
+# إعادة المحاولة عند أعطال الشبكة تتم مركزيًا في database/transport (RetryPolicy + circuit breaker)
 
 def _select_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Optional[Dict[str, Any]]:
     tbl = get_table(TABLE)
-    resp = _with_retry(
-        tbl.select("*").eq("user_id", user_id).eq("state_key", state_key).limit(1).execute
-    )
+    resp = tbl.select("*").eq("user_id", user_id).eq("state_key", state_key).limit(1).execute()
     data = getattr(resp, "data", None) or []
     return data[0] if data else None
 
-def _upsert_row(user_id: int, *, vars_dict: Dict[str, Any], expires_at: Optional[datetime], state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
-    tbl = get_table(TABLE)
-    payload = {
-        "user_id": user_id,
-        "state_key": state_key,
-        "vars": vars_dict,
-    }
-    if expires_at is not None:
-        payload["expires_at"] = _to_iso(expires_at)
+def _upsert_rows(rows: List[Dict[str, Any]]) -> None:
     # on_conflict requires UNIQUE(user_id,state_key)
-    resp = _with_retry(tbl.upsert(payload, on_conflict="user_id,state_key").execute)
-    return getattr(resp, "data", None) or []
+    get_table(TABLE).upsert(rows, on_conflict="user_id,state_key").execute()
+
+def _delete_rows(user_ids: List[int], *, state_key: str = DEFAULT_STATE_KEY) -> None:
+    get_table(TABLE).delete().in_("user_id", user_ids).eq("state_key", state_key).execute()
+
+# ===================== In-process write-behind store =====================
+# كل (user_id, state_key) له مدخل في الذاكرة يحوي آخر vars معروفة.
+# - القراءة: من المخزن مباشرة (صفر طلبات شبكة) ما دام المدخل حديثًا أو متسخًا.
+# - الكتابة: تُطبَّق محليًا ويُعلَّم المدخل dirty مع موعد دفع (deadline)،
+#   وتُحفظ التغييرات على مستوى المفتاح (ops) لإعادة تطبيقها عند التعارض.
+# - الدفع: خيط خلفي يرسل المداخل المستحقة في استدعاء RPC واحد (user_state_commit)
+#   مع تحقق تفاؤلي من عمود version؛ الصف المتعارض يُعاد تحميله وتُطبَّق ops عليه —
+#   إلا المفتاح الذي غيّره كاتب آخر عن القيمة التي بُني عليها تعديلنا (base): قيمته المخزنة
+#   تبقى، ويُسقط تعديلنا ويُبلَّغ عنه (StateConflict في flush_state).
+# - الحجم محدود (LRU): نُخرج الأقدم من المداخل النظيفة فقط.
+
+_STORE_MAX   = int(os.getenv("STATE_CACHE_MAX", "5000"))
+_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "1.5"))  # ثوانٍ بين أول تعديل والدفع
+_FLUSH_TICK  = 0.5     # دورية استيقاظ خيط الدفع
+_CLEAN_TTL   = 300.0   # بعدها نعيد قراءة المدخل النظيف من القاعدة
+_COMMIT_RPC  = "user_state_commit"
+_COMMIT_ATTEMPTS = 3
+_QUARANTINE_AFTER = int(os.getenv("STATE_QUARANTINE_AFTER", "5"))  # رفضات متتالية قبل إسقاط الصف
+
+# يصبح False إن لم تُطبَّق ترحيلة 0006 (لا عمود version أو لا دالة RPC): نعود لـ upsert عادي
+_CAS_SUPPORTED = True
+
+_DELETED = object()   # علامة حذف مفتاح داخل ops
+
+class _Entry:
+    __slots__ = ("vars", "expires_at", "version", "ops", "base", "dirty", "deadline", "gen", "loaded_at", "fails")
+
+    def __init__(self, vars_dict: Dict[str, Any], expires_at: Optional[str], version: Optional[int]):
+        self.vars = vars_dict
+        self.expires_at = expires_at
+        self.version = version  # None = لا يوجد صف في القاعدة
+        self.ops: Dict[str, Any] = {}
+        self.base: Dict[str, Any] = {}  # المفتاح → قيمته المخزنة التي بُني عليها التعديل (_DELETED = غير موجود)
+        self.dirty = False
+        self.deadline = 0.0
+        self.gen = 0            # يزيد مع كل تعديل؛ يمنع تنظيف مدخل تغيّر أثناء الدفع
+        self.loaded_at = time.monotonic()
+        self.fails = 0          # مرات رفض القاعدة لهذا الصف على التوالي
+
+class StateConflict(Exception):
+    """تحديث متسابق لنفس المستخدم: keys لم تُكتب لأن كاتبًا آخر غيّرها أولًا (أو استُنفدت المحاولات)."""
+
+    def __init__(self, message: str, keys=()):
+        super().__init__(message)
+        self.keys = sorted(keys)
+
+# مفاتيح يفوز فيها آخر كاتب دائمًا (تمديد الانتهاء ليس تعارضًا)
+_LWW_KEYS = {"__state_exp"}
+
+_store: "OrderedDict[Tuple[int, str], _Entry]" = OrderedDict()
+_store_lock = threading.RLock()
+_hits = 0
+_misses = 0
+_flush_lock = threading.Lock()      # دفعة واحدة في كل مرة (خلفية أو قسرية)
+_flush_wakeup = threading.Event()
+_flusher_started = False
+
+def _skey(user_id: int, state_key: str) -> Tuple[int, str]:
+    return (int(user_id), state_key or DEFAULT_STATE_KEY)
+
+def _row_version(row: Optional[Dict[str, Any]]) -> Optional[int]:
+    global _CAS_SUPPORTED
+    if not row:
+        return None
+    if "version" not in row:
+        if _CAS_SUPPORTED:
+            logging.warning("user_state.version missing (migration 0006 not applied); falling back to plain upsert")
+        _CAS_SUPPORTED = False
+        return 0
+    return int(row.get("version") or 0)
+
+def _apply_ops(base: Dict[str, Any], ops: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(base)
+    for k, v in ops.items():
+        if v is _DELETED:
+            out.pop(k, None)
+        else:
+            out[k] = v
+    return out
+
+def _evict_locked() -> None:
+    if len(_store) <= _STORE_MAX:
+        return
+    for k in list(_store.keys()):
+        if len(_store) <= _STORE_MAX:
+            return
+        if not _store[k].dirty:
+            del _store[k]
+    # كل ما تبقى متسخ: أيقظ خيط الدفع، وسيُخرج لاحقًا عند الحاجة
+    _flush_wakeup.set()
+
+def _load_entry(user_id: int, state_key: str) -> _Entry:
+    global _hits, _misses
+    k = _skey(user_id, state_key)
+    with _store_lock:
+        e = _store.get(k)
+        if e is not None and (e.dirty or (time.monotonic() - e.loaded_at) < _CLEAN_TTL):
+            _store.move_to_end(k)
+            _hits += 1
+            return e
+        _misses += 1
+    row = _select_row(user_id, state_key=state_key)  # خارج القفل: طلب شبكة
+    with _store_lock:
+        e = _store.get(k)
+        if e is not None and e.dirty:
+            # كاتب آخر سبقنا أثناء القراءة: نسخته المحلية هي الأحدث
+            _store.move_to_end(k)
+            return e
+        e = _Entry(
+            dict(row.get("vars") or {}) if row else {},
+            row.get("expires_at") if row else None,
+            _row_version(row),
+        )
+        _store[k] = e
+        _evict_locked()
+        return e
+
+def cache_stats() -> Dict[str, int]:
+    """عدادات كاش الحالة (services/metrics): إصابات/إخفاقات منذ التشغيل وعدد المداخل."""
+    with _store_lock:
+        return {"hits": _hits, "misses": _misses, "entries": len(_store)}
+
+def _mark_dirty_locked(e: _Entry) -> None:
+    e.gen += 1
+    if not e.dirty:
+        e.dirty = True
+        e.deadline = time.monotonic() + _FLUSH_DELAY
+    _ensure_flusher()
+
+def _ensure_flusher() -> None:
+    global _flusher_started
+    if _flusher_started:
+        return
+    _flusher_started = True
+    threading.Thread(target=_flusher_loop, name="state-flusher", daemon=True).start()
 
-def _delete_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> None:
-    tbl = get_table(TABLE)
-    _with_retry(tbl.delete().eq("user_id", user_id).eq("state_key", state_key).execute)
+def _flusher_loop() -> None:
+    while True:
+        _flush_wakeup.wait(_FLUSH_TICK)
+        _flush_wakeup.clear()
+        try:
+            conflicts = _flush(force=False)
+            if conflicts:
+                _reload_conflicts(conflicts)
+        except Exception as e:
+            logging.warning("state_service flush failed (will retry): %s", e)
+
+def _commit_rows(rows: List[Dict[str, Any]]) -> Optional[Dict[Tuple[int, str], Dict[str, Any]]]:
+    """
+    يرسل الدفعة إلى RPC user_state_commit ويرجع نتيجة كل صف.
+    يرجع None إن لم تكن الدالة موجودة (نعود عندها للمسار القديم).
+    """
+    global _CAS_SUPPORTED
+    try:
+        resp = client().rpc(_COMMIT_RPC, {"p_rows": rows}).execute()
+    except Exception as e:
+        msg = str(e)
+        if "PGRST202" in msg or "42883" in msg:
+            logging.warning("%s RPC unavailable; falling back to plain upsert: %s", _COMMIT_RPC, e)
+            _CAS_SUPPORTED = False
+            return None
+        raise
+    out: Dict[Tuple[int, str], Dict[str, Any]] = {}
+    for r in (getattr(resp, "data", None) or []):
+        out[_skey(r.get("user_id"), r.get("state_key"))] = r
+    return out
+
+def _is_outage(e: Exception) -> bool:
+    """عطل شبكة/قاطع دائرة مفتوح — لا يُحسب على الصف."""
+    return isinstance(e, httpx.TransportError)
+
+def _send_batch(batch: list) -> Optional[Dict[Tuple[int, str], Dict[str, Any]]]:
+    """
+    يرسل دفعة مداخل: RPC user_state_commit (نتيجة كل صف) أو upsert/delete عادي (يرجع None).
+    يرفع الاستثناء كما هو عند الفشل.
+    """
+    results = None
+    if _CAS_SUPPORTED:
+        results = _commit_rows([
+            {"user_id": k[0], "state_key": k[1], "vars": v, "expires_at": exp, "expected_version": ver}
+            for (k, _g, v, exp, ver) in batch
+        ])
+    if results is None:
+        upserts = [
+            {"user_id": k[0], "state_key": k[1], "vars": v, "expires_at": exp}
+            for (k, _g, v, exp, _ver) in batch if v
+        ]
+        deletes: Dict[str, List[int]] = {}
+        for (k, _g, v, _exp, _ver) in batch:
+            if not v:
+                deletes.setdefault(k[1], []).append(k[0])
+        if upserts:
+            _upsert_rows(upserts)
+        for sk, ids in deletes.items():
+            _delete_rows(ids, state_key=sk)
+    return results
+
+def _flush(force: bool, only: Optional[Tuple[int, str]] = None) -> List[Tuple[int, str]]:
+    """
+    يدفع المداخل المستحقة (أو كلها عند force) إلى user_state بأقل عدد من الطلبات.
+    يرجع مفاتيح المداخل التي رفضتها القاعدة بسبب تعارض version.
+    فشل الدفعة → إعادة صفًا صفًا؛ الصف المرفوض _QUARANTINE_AFTER مرات يُسجَّل ويُسقط.
+    """
+    with _flush_lock:
+        now = time.monotonic()
+        batch: List[Tuple[Tuple[int, str], int, Dict[str, Any], Optional[str], Optional[int]]] = []
+        with _store_lock:
+            for k, e in _store.items():
+                if not e.dirty:
+                    continue
+                if only is not None and k != only:
+                    continue
+                if force or e.deadline <= now:
+                    batch.append((k, e.gen, dict(e.vars), e.expires_at, e.version))
+        if not batch:
+            return []
+
+        sent: List[Tuple[list, Optional[Dict[Tuple[int, str], Dict[str, Any]]]]] = []
+        failed: List[Tuple[tuple, Exception]] = []
+        try:
+            sent.append((batch, _send_batch(batch)))
+        except Exception as e:
+            if len(batch) == 1 or _is_outage(e):
+                failed.extend((item, e) for item in batch)
+            else:
+                # صف واحد مرفوض (JSON غير صالح/قيد) لا يوقف حفظ حالة الجميع: صفًا صفًا
+                logging.warning("state_service batch flush failed (%s rows), retrying row by row: %s", len(batch), e)
+                for i, item in enumerate(batch):
+                    try:
+                        sent.append(([item], _send_batch([item])))
+                    except Exception as e1:
+                        if _is_outage(e1):
+                            failed.extend((rest, e1) for rest in batch[i:])
+                            break
+                        failed.append((item, e1))
+
+        conflicts: List[Tuple[int, str]] = []
+        with _store_lock:
+            for items, results in sent:
+                for (k, gen, v, _exp, ver) in items:
+                    e = _store.get(k)
+                    if e is None:
+                        continue
+                    e.fails = 0
+                    if results is not None:
+                        res = results.get(k)
+                        if res is None or res.get("conflict"):
+                            conflicts.append(k)
+                            continue
+                        e.version = res.get("version")
+                    else:
+                        e.version = (ver or 0) if v else None
+                    if e.gen == gen:
+                        e.dirty = False
+                        e.ops.clear()
+                        e.base.clear()
+                        e.loaded_at = time.monotonic()
+            for (k, gen, _v, _exp, _ver), err in failed:
+                e = _store.get(k)
+                if e is None:
+                    continue
+                if _is_outage(err):
+                    # القاعدة غير متاحة: ليس ذنب الصف، يبقى متسخًا ويُعاد لاحقًا
+                    e.deadline = time.monotonic() + _FLUSH_DELAY
+                    continue
+                e.fails += 1
+                if e.fails >= _QUARANTINE_AFTER:
+                    logging.error(
+                        "user_state for user %s (%s) rejected %s times; dropping unsaved keys %s: %s",
+                        k[0], k[1], e.fails, sorted(e.ops.keys()), err,
+                    )
+                    _store.pop(k, None)  # القراءة التالية تعيد تحميل آخر نسخة محفوظة
+                else:
+                    logging.warning("user_state flush failed for user %s (%s), attempt %s: %s", k[0], k[1], e.fails, err)
+                    e.deadline = time.monotonic() + _FLUSH_DELAY * (2 ** e.fails)
+            _evict_locked()
+        return conflicts
+
+def _reload_conflicts(keys: List[Tuple[int, str]]) -> Dict[Tuple[int, str], List[str]]:
+    """
+    يعيد تحميل الصفوف المتعارضة ويطبّق عليها تغييراتنا المعلّقة (على مستوى المفتاح).
+    المفتاح الذي تغيّرت قيمته المخزنة عن base لا يُكتب فوقه: يُسقط تعديلنا ويُرجع ضمن الناتج.
+    """
+    lost_by_key: Dict[Tuple[int, str], List[str]] = {}
+    for k in keys:
+        row = _select_row(k[0], state_key=k[1])
+        stored = dict(row.get("vars") or {}) if row else {}
+        with _store_lock:
+            e = _store.get(k)
+            if e is None:
+                continue
+            lost = [
+                key for key, val in e.ops.items()
+                if key not in _LWW_KEYS
+                and stored.get(key, _DELETED) != e.base.get(key, _DELETED)
+                and stored.get(key, _DELETED) != val
+            ]
+            for key in lost:
+                e.ops.pop(key, None)
+            e.base = {key: stored.get(key, _DELETED) for key in e.ops}
+            if lost:
+                lost_by_key[k] = lost
+                logging.warning(
+                    "user_state conflict for user %s (%s): keys %s changed by another writer; keeping stored values",
+                    k[0], k[1], sorted(lost),
+                )
+            e.vars = _apply_ops(stored, e.ops)
+            e.version = _row_version(row)
+            e.gen += 1
+            e.dirty = bool(e.ops)
+            e.deadline = time.monotonic()
+            e.loaded_at = time.monotonic()
+    return lost_by_key
+
+def flush_state(user_id: Optional[int] = None, *, state_key: str = DEFAULT_STATE_KEY) -> None:
+    """
+    ادفع التعديلات المعلّقة فورًا (لمستخدم واحد أو للجميع).
+    عند التعارض يُعاد التحميل والدمج ثم المحاولة. يُرفع StateConflict لو أُسقط تعديل مفتاح
+    غيّره كاتب آخر، أو بعد استنفاد المحاولات.
+    """
+    only = _skey(user_id, state_key) if user_id is not None else None
+    lost: List[str] = []
+    for _ in range(_COMMIT_ATTEMPTS):
+        conflicts = _flush(force=True, only=only)
+        if not conflicts:
+            if lost:
+                raise StateConflict(f"user_state keys {sorted(set(lost))} were changed by another writer", lost)
+            return
+        for keys in _reload_conflicts(conflicts).values():
+            lost.extend(keys)
+    raise StateConflict(f"user_state commit kept conflicting for {conflicts}", lost)
+
+def _flush_at_exit() -> None:
+    try:
+        flush_state()
+    except Exception as e:
+        logging.warning("state_service final flush failed: %s", e)
+
+atexit.register(_flush_at_exit)
 
 # ===================== Vars helpers =====================
 
 def _get_vars(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
-    row = _select_row(user_id, state_key=state_key)
-    return dict(row.get("vars") or {}) if row else {}
+    e = _load_entry(user_id, state_key)
+    with _store_lock:
+        return dict(e.vars)
 
 def _set_vars(user_id: int, vars_dict: Dict[str, Any], *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: Optional[int] = None) -> None:
-    # إذا كانت vars فارغة نحذف الصف تمامًا
-    if not vars_dict:
-        _delete_row(user_id, state_key=state_key)
-        return
-    expires_at = _expires_from_ttl(ttl_minutes) or _from_iso(vars_dict.get("__state_exp"))
-    _upsert_row(user_id, vars_dict=vars_dict, expires_at=expires_at, state_key=state_key)
+    # إذا كانت vars فارغة يُحذف الصف تمامًا عند الدفع
+    k = _skey(user_id, state_key)
+    expires_at = _expires_from_ttl(ttl_minutes) or _from_iso((vars_dict or {}).get("__state_exp"))
+    e = _load_entry(user_id, state_key)  # نحتاج version الحالي حتى للحذف
+    new_vars = dict(vars_dict or {})
+    with _store_lock:
+        e = _store.get(k) or e
+        _store[k] = e
+        for key in e.vars.keys() - new_vars.keys():
+            e.base.setdefault(key, e.vars[key])
+            e.ops[key] = _DELETED
+        for key, val in new_vars.items():
+            if key not in e.vars or e.vars[key] != val:
+                e.base.setdefault(key, e.vars.get(key, _DELETED))
+                e.ops[key] = val
+        e.vars = new_vars
+        if expires_at is not None:
+            e.expires_at = _to_iso(expires_at)
+        _store.move_to_end(k)
+        _mark_dirty_locked(e)
+        _evict_locked()
 
 # ===================== Public API =====================
 
@@ -152,10 +491,7 @@ def clear_state(user_id: int, key: Optional[str] = None, *, state_key: str = DEF
         vars_dict.pop("__state_exp", None)
     else:
         vars_dict.pop(key, None)
-    if vars_dict:
-        _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=None)
-    else:
-        _delete_row(user_id, state_key=state_key)
+    _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=None)
 
 def pop_state(user_id: int, default=None, *, state_key: str = DEFAULT_STATE_KEY):
     val = get_state_key(user_id, default, state_key=state_key)
@@ -175,34 +511,14 @@ def set_var(user_id: int, key: str, value, *, state_key: str = DEFAULT_STATE_KEY
 # ====== واجهة مستوى أعلى لتعامل القاموس بالكامل (باستثناء المفاتيح الداخلية) ======
 _INTERNAL_KEYS = {"__state", "__state_exp"}
 
-# ← إضافة: كاش خفيف لقراءات get_data فقط
-_CACHE = {}
-_CACHE_TTL = 2.0  # ثانيتان
-
-def _cache_key(user_id, state_key):
-    return f"{user_id}:{state_key or 'global'}"
-
-def _cache_get(user_id, state_key):
-    t, val = _CACHE.get(_cache_key(user_id, state_key), (0, None))
-    return val if (time.time() - t) < _CACHE_TTL else None
-
-def _cache_set(user_id, state_key, val):
-    _CACHE[_cache_key(user_id, state_key)] = (time.time(), val)
-
 def get_data(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
     """يرجع نسخة من المتغيرات العامة (بدون مفاتيح النظام)."""
-    cached = _cache_get(user_id, state_key)
-    if cached is not None:
-        return cached
     try:
-        row = _select_row(user_id, state_key=state_key)
+        vars_dict = _get_vars(user_id, state_key=state_key)
     except Exception:
         # فشل الشبكة: ارجع حالة فارغة بدل الكراش
         return {}
-    vars_dict = dict(row.get("vars") or {}) if row else {}
-    result = {k: v for k, v in vars_dict.items() if k not in _INTERNAL_KEYS}
-    _cache_set(user_id, state_key, result)
-    return result
+    return {k: v for k, v in vars_dict.items() if k not in _INTERNAL_KEYS}
 
 def set_data(user_id: int, data: Dict[str, Any], *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: int = 120) -> None:
     """يحفظ القاموس كاملاً مع الإبقاء على مفاتيح النظام كما هي وتحديث وقت الانتهاء."""
@@ -213,7 +529,43 @@ def set_data(user_id: int, data: Dict[str, Any], *, state_key: str = DEFAULT_STA
     _set_vars(user_id, merged, state_key=state_key, ttl_minutes=ttl_minutes)
 
 
+def update_data(user_id: int, sets: Dict[str, Any], deletes=(), *, base: Optional[Dict[str, Any]] = None,
+                state_key: str = DEFAULT_STATE_KEY, ttl_minutes: Optional[int] = 120) -> None:
+    """
+    يطبّق تغييرات على مستوى المفتاح (تعيين/حذف) دفعة واحدة — تستخدمه جلسات state_adapter.
+    base: القيم التي بُنيت عليها التغييرات؛ مفتاح غيّره كاتب آخر في الأثناء لا يُكتب فوقه
+    (تبقى قيمته المخزنة)، وتُطبَّق بقية التغييرات ثم يُرفع StateConflict بالمفاتيح المرفوضة.
+    """
+    k = _skey(user_id, state_key)
+    e = _load_entry(user_id, state_key)
+    with _store_lock:  # المقارنة والتطبيق ذريّان أمام كتّاب هذه النسخة
+        vars_dict = dict((_store.get(k) or e).vars)
+        raced: List[str] = []
+        if base is not None:
+            missing = object()
+            raced = [
+                key for key in list(sets.keys()) + list(deletes)
+                if vars_dict.get(key, missing) != base.get(key, missing)
+            ]
+        sets = {key: v for key, v in (sets or {}).items() if key not in raced}
+        deletes = [key for key in deletes if key not in raced]
+        for key in deletes:
+            vars_dict.pop(key, None)
+        vars_dict.update(sets)
+        if sets and ttl_minutes is not None:
+            vars_dict["__state_exp"] = _to_iso(_expires_from_ttl(ttl_minutes))
+        if sets or deletes:
+            _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=ttl_minutes if sets else None)
+    if raced:
+        raise StateConflict(f"state for user {user_id} changed concurrently on keys {sorted(raced)}", raced)
+
+
 # ===== حذف كل حالة المستخدم فورًا (يمسح الصف) =====
 def purge_state(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> None:
-    """Delete the entire state row for this user (no TTL, no leftovers)."""
-    _delete_row(user_id, state_key=state_key)
+    """Delete the entire state row for this user (no TTL, no leftovers) — flushed now, not write-behind."""
+    _set_vars(user_id, {}, state_key=state_key, ttl_minutes=None)
+    try:
+        flush_state(user_id, state_key=state_key)
+    except Exception as e:
+        # يبقى الحذف معلّقًا في المخزن ويدفعه خيط الدفع
+        logging.warning("purge_state flush failed for user %s (deferred): %s", user_id, e)
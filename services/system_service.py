@@ -1,22 +1,90 @@
 # services/system_service.py
-import json, os, time
-from typing import Optional
+import json, logging, os, tempfile, threading, time
+from typing import Any, Callable, Iterable, List, Optional, Tuple
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 STATE_FILE = os.path.join(DATA_DIR, "system_state.json")
 LOG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs", "bot.log")
 
-def _load_state() -> dict:
+# ────────────────────────────────────────────────────────────
+# الحالة في الذاكرة: تُقرأ من الملف فقط عند تغيّر (mtime, inode, size)،
+# والكتابة ذرّية (ملف مؤقت + os.replace) فلا يرى القارئ ملفًا نصف مكتوب.
+# subscribe(fn): fn(key, old, new) لكل مفتاح تغيّر (كتابة من هنا أو تعديل خارجي للملف).
+# ────────────────────────────────────────────────────────────
+_state: dict = {}
+_state_sig: Optional[tuple] = None
+_state_lock = threading.RLock()
+_subscribers: List[Tuple[Callable[[str, Any, Any], None], Optional[frozenset]]] = []
+
+def _file_sig() -> Optional[tuple]:
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+        st = os.stat(STATE_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+def subscribe(fn: Callable[[str, Any, Any], None], keys: Optional[Iterable[str]] = None) -> None:
+    """يسجل fn(key, old, new) لتغيّرات الحالة (keys=None = كل المفاتيح)."""
+    with _state_lock:
+        _subscribers.append((fn, frozenset(keys) if keys else None))
+
+def _notify(old: dict, new: dict) -> None:
+    changed = [k for k in set(old) | set(new) if old.get(k) != new.get(k)]
+    if not changed:
+        return
+    for fn, keys in list(_subscribers):
+        for k in changed:
+            if keys is None or k in keys:
+                try:
+                    fn(k, old.get(k), new.get(k))
+                except Exception as e:
+                    logging.warning("[system_state] subscriber failed for %s: %s", k, e)
+
+def _load_state() -> dict:
+    """نسخة من الحالة الحالية (لا تُقرأ من القرص إلا إذا تغيّر الملف)."""
+    global _state, _state_sig
+    sig = _file_sig()
+    if sig == _state_sig:
+        return dict(_state)
+    with _state_lock:
+        sig = _file_sig()
+        if sig != _state_sig:
+            old = _state
+            try:
+                with open(STATE_FILE, "r", encoding="utf-8") as f:
+                    fresh = json.load(f)
+                if not isinstance(fresh, dict):
+                    fresh = {}
+            except FileNotFoundError:
+                fresh = {}
+            except Exception as e:
+                # ملف تالف (تعديل يدوي مثلًا): نبقي آخر حالة سليمة
+                logging.warning("[system_state] read failed: %s", e)
+                fresh = old
+            _state, _state_sig = fresh, sig
+            _notify(old, fresh)
+        return dict(_state)
 
 def _save_state(state: dict):
+    global _state, _state_sig
     os.makedirs(DATA_DIR, exist_ok=True)
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with _state_lock:
+        old = _state
+        fd, tmp = tempfile.mkstemp(prefix=".system_state.", suffix=".tmp", dir=DATA_DIR)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, STATE_FILE)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        _state, _state_sig = dict(state), _file_sig()
+        _notify(old, _state)
 
 def set_maintenance(on: bool, message: Optional[str] = None):
     st = _load_state()
@@ -31,15 +99,42 @@ def is_maintenance() -> bool:
 def maintenance_message() -> str:
     return _load_state().get("maintenance_message") or "🛠️ نعمل على صيانة سريعة الآن. جرّب لاحقًا."
 
+def _tail_lines(path: str, max_lines: int, block: int = 8192) -> List[str]:
+    """آخر max_lines سطرًا بالقراءة من نهاية الملف (كتل للخلف) بدل قراءة الملف كله."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= max_lines:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    return lines[-max_lines:] if max_lines > 0 else []
+
+def _render_log_line(line: str) -> str:
+    # سطور JSON (services/error_log_setup) تُعرض نصًا مقروءًا
+    if not line.startswith("{"):
+        return line
+    try:
+        evt = json.loads(line)
+    except Exception:
+        return line
+    who = f" u={evt['user_id']}" if evt.get("user_id") is not None else ""
+    out = f"{evt.get('ts', '')} [{evt.get('level', '')}]{who} {evt.get('msg', '')}"
+    if evt.get("exc"):
+        out += "\n" + evt["exc"]
+    return out
+
 def get_logs_tail(max_lines: int = 30) -> str:
     try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()[-max_lines:]
-        return "".join(lines) or "لا يوجد سجلات بعد."
+        lines = _tail_lines(LOG_FILE, max_lines)
+        return "\n".join(_render_log_line(l) for l in lines) or "لا يوجد سجلات بعد."
     except Exception:
         return "لا يمكن قراءة السجلات."
 
-# ملاحظة: يعتمد إعادة التحقق من الاشتراك على كاش مشروعك. هنا فقط نضع إشارة زمنية لمسح أي كاش داخلي.
+# إعادة التحقق من الاشتراك: إشارة زمنية محفوظة؛ كاش العضوية مشترك عبر subscribe ويُبطَل معها.
 def force_sub_recheck():
     st = _load_state()
     st["force_sub_epoch"] = int(time.time())
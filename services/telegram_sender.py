@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# services/telegram_sender.py — إرسال مشترك يحترم حدود تيليغرام (عام + لكل محادثة) ويطبّق retry_after
+"""
+كل إرسال جماعي/خلفي (outbox، البث، إشعارات الأدمن) يمرّ من هنا حتى لا تتجاوز
+خيوط متعددة حدود Bot API معًا:
+  * حد عام TG_GLOBAL_RATE رسالة/ثانية (الافتراضي 25، والحد الرسمي ~30).
+  * حد لكل محادثة: رسالة كل TG_PER_CHAT_INTERVAL ثانية (الافتراضي 1).
+  * عند 429 نقرأ parameters.retry_after ونوقف كل الإرسال حتى انقضائها
+    (حظر الفيضان في تيليغرام يطال البوت كله، لا المحادثة وحدها).
+
+الاستخدام:
+    from services.telegram_sender import send_message, send_photo, call_limited
+    send_message(bot, chat_id, "نص", parse_mode="HTML")
+    call_limited(bot.send_document, chat_id, file_id, caption="...")
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from telebot import apihelper
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25") or 25)
+TG_PER_CHAT_INTERVAL = float(os.getenv("TG_PER_CHAT_INTERVAL", "1.0") or 1.0)
+TG_MAX_WAIT = float(os.getenv("TG_MAX_WAIT", "30") or 30)  # أقصى انتظار داخل الاستدعاء قبل رمي الخطأ للمنادي
+_PER_CHAT_MAX = 20000
+
+_lock = threading.Lock()
+_global_tokens = TG_GLOBAL_RATE
+_global_ts = time.monotonic()
+_paused_until = 0.0
+_chat_next: Dict[int, float] = {}
+
+
+class RateLimited(Exception):
+    """تيليغرام طلب الانتظار retry_after ثانية (أو الانتظار المطلوب يتجاوز TG_MAX_WAIT)."""
+
+    def __init__(self, retry_after: float, original: Optional[Exception] = None):
+        super().__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = float(retry_after)
+        self.original = original
+
+
+def retry_after_of(exc: Exception) -> Optional[float]:
+    """يرجع retry_after من ApiTelegramException 429 (أو None)."""
+    if isinstance(exc, RateLimited):
+        return exc.retry_after
+    if isinstance(exc, apihelper.ApiTelegramException) and getattr(exc, "error_code", None) == 429:
+        try:
+            return float((exc.result_json or {}).get("parameters", {}).get("retry_after") or 1)
+        except Exception:
+            return 1.0
+    return None
+
+
+def is_permanent_error(exc: Exception) -> bool:
+    """أخطاء لن تنجح بالإعادة: البوت محظور/المحادثة غير موجودة/المستخدم محذوف."""
+    if not isinstance(exc, apihelper.ApiTelegramException):
+        return False
+    code = getattr(exc, "error_code", None)
+    desc = str(getattr(exc, "description", "") or exc).lower()
+    if code == 403:
+        return True
+    return code == 400 and ("chat not found" in desc or "user not found" in desc or "peer_id_invalid" in desc)
+
+
+def pause_for(seconds: float) -> None:
+    """يوقف كل الإرسال عبر هذه الطبقة لمدة seconds (بعد 429)."""
+    global _paused_until
+    with _lock:
+        _paused_until = max(_paused_until, time.monotonic() + max(0.0, float(seconds)))
+
+
+def _reserve(chat_id: Optional[int]) -> float:
+    """
+    يحجز خانة إرسال ويرجع كم ثانية يجب الانتظار قبل الإرسال (0 = الآن).
+    لو الانتظار أطول من TG_MAX_WAIT لا يُحجز شيء (المنادي سيؤجل الإرسال).
+    """
+    global _global_tokens, _global_ts
+    with _lock:
+        now = time.monotonic()
+        _global_tokens = min(TG_GLOBAL_RATE, _global_tokens + (now - _global_ts) * TG_GLOBAL_RATE)
+        _global_ts = now
+        at = max(now, _paused_until)
+        if _global_tokens < 1.0:
+            at = max(at, now + (1.0 - _global_tokens) / TG_GLOBAL_RATE)
+        if chat_id is not None:
+            at = max(at, _chat_next.get(chat_id, 0.0))
+        if at - now > TG_MAX_WAIT:
+            return at - now
+        if chat_id is not None:
+            _chat_next[chat_id] = at + TG_PER_CHAT_INTERVAL
+            if len(_chat_next) > _PER_CHAT_MAX:
+                for k in [k for k, v in _chat_next.items() if v < now][: _PER_CHAT_MAX // 2]:
+                    _chat_next.pop(k, None)
+        # نخصم التوكن الآن (قد يصبح سالبًا = دين يُسدَّد بالانتظار)
+        _global_tokens -= 1.0
+        return at - now
+
+
+def call_limited(fn: Callable[..., Any], chat_id: Optional[int], *args, retries: int = 1, **kwargs) -> Any:
+    """
+    ينفّذ fn(chat_id, *args, **kwargs) ضمن الحدود. عند 429 ينتظر retry_after ويعيد
+    حتى retries مرة؛ لو الانتظار المطلوب أطول من TG_MAX_WAIT يرمي RateLimited للمنادي.
+    """
+    attempt = 0
+    while True:
+        wait = _reserve(chat_id)
+        if wait > TG_MAX_WAIT:
+            raise RateLimited(wait)
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            return fn(chat_id, *args, **kwargs) if chat_id is not None else fn(*args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            ra = retry_after_of(e)
+            if ra is None:
+                raise
+            pause_for(ra)
+            logging.warning("[tg_sender] 429 for chat %s, retry_after=%s", chat_id, ra)
+            if attempt >= retries or ra > TG_MAX_WAIT:
+                raise RateLimited(ra, e)
+            attempt += 1
+
+
+def send_message(bot, chat_id: int, text: str, **kwargs):
+    return call_limited(bot.send_message, chat_id, text, **kwargs)
+
+
+def send_photo(bot, chat_id: int, photo, **kwargs):
+    return call_limited(bot.send_photo, chat_id, photo, **kwargs)
+
+
+def send_document(bot, chat_id: int, document, **kwargs):
+    return call_limited(bot.send_document, chat_id, document, **kwargs)
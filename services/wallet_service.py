@@ -1,10 +1,10 @@
 # services/wallet_service.py
 
+import asyncio
+import heapq
 import logging
+import os
 import uuid
-import time
-from httpx import ReadError
-from postgrest.exceptions import APIError
 
 from config import SUPABASE_TABLE_NAME
 from datetime import datetime, timedelta
@@ -20,6 +20,7 @@ from database.db import (
     transfer_amount_rpc as _rpc_transfer_amount,
     try_deduct_rpc as _rpc_try_deduct,
 )
+from services.purchase_history import record_purchase
 
 # أسماء الجداول
 USER_TABLE = (SUPABASE_TABLE_NAME or DEFAULT_TABLE or "houssin363")
@@ -42,24 +43,6 @@ def _is_uuid_like(x) -> bool:
         return False
 
 
-def _exec(q, tries: int = 3, base_delay: float = 0.4):
-    """
-    ينفّذ q.execute() مع إعادة محاولة تلقائية عند مشاكل الشبكة (HTTPX ReadError).
-    يحافظ على منطق الدوال كما هو بدون تغييره.
-    """
-    for i in range(tries):
-        try:
-            return q.execute()
-        except ReadError as e:
-            logging.warning("[NET] ReadError (try %d/%d): %s", i + 1, tries, e)
-            time.sleep(base_delay * (2 ** i))
-            continue
-        except APIError:
-            # أخطاء PostgREST المنطقية ليست شبكة — أعِد رفعها فورًا
-            raise
-    raise ReadError("Supabase execute() retry exhausted")
-
-
 # ================= عمليات المستخدم =================
 
 def register_user_if_not_exist(user_id: int, name: str = "مستخدم") -> None:
@@ -81,7 +64,7 @@ def get_balance(user_id: int) -> int:
         .eq("user_id", user_id)
         .limit(1)
     )
-    response = _exec(q)  # ← إعادة محاولة عند ReadError
+    response = q.execute()  # إعادة المحاولة عند أعطال الشبكة تتم في database/transport
     return response.data[0]["balance"] if response.data else 0
 
 def get_available_balance(user_id: int) -> int:
@@ -213,7 +196,8 @@ def add_purchase(user_id: int, product_id, product_name: str, price: int, player
         "created_at": datetime.utcnow().isoformat(),
         "expire_at": expire_at.isoformat(),
     }
-    get_table(PURCHASES_TABLE).insert(data).execute()
+    resp = get_table(PURCHASES_TABLE).insert(data).execute()
+    record_purchase(user_id, PURCHASES_TABLE, product_name, price, player_id, data["created_at"], resp)
     deduct_balance(user_id, int(price), f"شراء {product_name}")
 
 
@@ -330,67 +314,90 @@ def user_has_admin_approval(user_id):
 
 
 # ================= إضافات العرض الموحّد =================
-# (تبقى كما هي — لا تغييرات على هذا القسم)
+# كل المصادر تُستعلم بالتوازي على حلقة async_db مع مهلة كلية واحدة،
+# ثم دمج k-way حسب created_at (كل مصدر مرتب تنازليًا مسبقًا) مع توقف مبكر عند limit.
+
+PURCHASES_FANOUT_DEADLINE = float(os.getenv("PURCHASES_FANOUT_DEADLINE", "4") or 4)
+
+# (الجدول، حقل العنوان، أعمدة المعرّف/الرقم بترتيب الأولوية)
+_PURCHASE_SOURCES = [
+    (PURCHASES_TABLE, "product_name", ("player_id",)),
+    ("game_purchases", "product_name", ("player_id",)),
+    ("ads_purchases", "ad_name", ()),
+    ("bill_and_units_purchases", "bill_name", ("number",)),
+    ("cash_transfer_purchases", "transfer_name", ("number",)),
+    ("companies_transfer_purchases", "company_name", ()),
+    ("internet_providers_purchases", "provider_name", ("phone",)),
+    ("university_fees_purchases", "university_name", ()),
+    ("wholesale_purchases", "wholesale_name", ()),
+]
+# جداول رفضت الإسقاط (عمود غير موجود في مخططها) → نرجع لها select("*") ونفحص المعرّف من الصف
+_STAR_TABLES = set()
+_ID_PROBE = ["player_id","phone","number","msisdn","account","account_number","student_id","student_number","target_id","target","line","game_id"]
+
+
+async def _afetch_purchases(tname: str, title_field: str, id_cols, user_id: int, limit: int):
+    from database.async_db import aget_table
+
+    async def _q(cols):
+        t = await aget_table(tname)
+        return await t.select(cols).eq("user_id", user_id).order("created_at", desc=True).limit(limit).execute()
+
+    cols = "*" if tname in _STAR_TABLES else ",".join((title_field, "price", "created_at") + tuple(id_cols))
+    try:
+        resp = await _q(cols)
+    except Exception as e:
+        # 42703 = undefined_column: مخطط الجدول لا يطابق الإسقاط
+        if cols == "*" or getattr(e, "code", None) != "42703":
+            raise
+        _STAR_TABLES.add(tname)
+        resp = await _q("*")
+
+    probe = id_cols if cols != "*" else _ID_PROBE
+    out = []
+    for r in (resp.data or []):
+        idp = None
+        for k in probe:
+            if r.get(k):
+                idp = r.get(k)
+                break
+        out.append({
+            "title": r.get(title_field) or ("منتج" if tname == PURCHASES_TABLE else tname),
+            "price": int(r.get("price") or 0),
+            "created_at": r.get("created_at"),
+            "id_or_phone": idp,
+        })
+    return out
+
+
+async def _afanout_purchases(user_id: int, limit: int, deadline: float):
+    tasks = [
+        asyncio.ensure_future(_afetch_purchases(t, f, ids, user_id, limit))
+        for t, f, ids in _PURCHASE_SOURCES
+    ]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for t in pending:
+        t.cancel()
+    if pending:
+        logging.warning("[wallet_service] purchases fan-out: %s/%s sources missed the %.1fs deadline",
+                        len(pending), len(tasks), deadline)
+    streams = []
+    for t in tasks:
+        if t in done and not t.cancelled() and t.exception() is None:
+            streams.append(t.result())
+    return streams
+
 
 def get_all_purchases_structured(user_id: int, limit: int = 50):
-    # ... (المحتوى كما في نسختك السابقة)
     from datetime import datetime as _dt  # لتفادي أي التباس بالأسماء
-    items = []
+    from database.async_db import run
 
+    deadline = PURCHASES_FANOUT_DEADLINE
     try:
-        resp = (
-            get_table(PURCHASES_TABLE)
-            .select("id,product_name,price,created_at,player_id")
-            .eq("user_id", user_id)
-            .order("created_at", desc=True)
-            .limit(limit * 2)
-            .execute()
-        )
-        for r in (resp.data or []):
-            items.append({
-                "title": r.get("product_name") or "منتج",
-                "price": int(r.get("price") or 0),
-                "created_at": r.get("created_at"),
-                "id_or_phone": r.get("player_id"),
-            })
-    except Exception:
-        pass
-
-    tables = [
-        ("game_purchases", "product_name"),
-        ("ads_purchases", "ad_name"),
-        ("bill_and_units_purchases", "bill_name"),
-        ("cash_transfer_purchases", "transfer_name"),
-        ("companies_transfer_purchases", "company_name"),
-        ("internet_providers_purchases", "provider_name"),
-        ("university_fees_purchases", "university_name"),
-        ("wholesale_purchases", "wholesale_name"),
-    ]
-    probe = ["player_id","phone","number","msisdn","account","account_number","student_id","student_number","target_id","target","line","game_id"]
-    for tname, title_field in tables:
-        try:
-            resp = (
-                get_table(tname)
-                .select("*")
-                .eq("user_id", user_id)
-                .order("created_at", desc=True)
-                .limit(limit * 2)
-                .execute()
-            )
-            for r in (resp.data or []):
-                idp = None
-                for k in probe:
-                    if k in r and r.get(k):
-                        idp = r.get(k)
-                        break
-                items.append({
-                    "title": r.get(title_field) or tname,
-                    "price": int(r.get("price") or 0),
-                    "created_at": r.get("created_at"),
-                    "id_or_phone": idp,
-                })
-        except Exception:
-            continue
+        streams = run(_afanout_purchases(user_id, limit, deadline), timeout=deadline + 1)
+    except Exception as e:
+        logging.error(f"[wallet_service] purchases fan-out failed: {e}")
+        streams = []
 
     def _to_sec(s: str):
         if not s:
@@ -403,7 +410,8 @@ def get_all_purchases_structured(user_id: int, limit: int = 50):
 
     seen_lastsec = {}
     uniq = []
-    for it in sorted(items, key=lambda x: x.get("created_at") or "", reverse=True):
+    merged = heapq.merge(*streams, key=lambda x: x.get("created_at") or "", reverse=True)
+    for it in merged:
         key = (it.get("title"), int(it.get("price") or 0), it.get("id_or_phone"))
         sec = _to_sec(it.get("created_at"))
         last = seen_lastsec.get(key)
@@ -455,7 +463,7 @@ def get_wallet_transfers_only(user_id: int, limit: int = 50):
 
 
 # ===== تسجيلات إضافية في الجداول المتخصصة (Write-through) =====
-# (تبقى كما هي — بدون تغيير)
+# كل إدراج ناجح يُكتب أيضًا في purchase_history (نموذج القراءة الموحّد)
 
 def add_game_purchase(user_id: int, product_id, product_name: str, price: int, player_id: str, created_at: str = None):
     pid = int(product_id) if product_id else None
@@ -475,7 +483,8 @@ def add_game_purchase(user_id: int, product_id, product_name: str, price: int, p
         "player_id": str(player_id or ""),
         "created_at": (created_at or datetime.utcnow().isoformat()),
     }
-    get_table("game_purchases").insert(data).execute()
+    resp = get_table("game_purchases").insert(data).execute()
+    record_purchase(user_id, "game_purchases", product_name, price, data["player_id"], data["created_at"], resp)
 
 def add_bill_or_units_purchase(user_id: int, bill_name: str, price: int, number: str, created_at: str = None):
     data = {
@@ -486,9 +495,10 @@ def add_bill_or_units_purchase(user_id: int, bill_name: str, price: int, number:
         "number": number
     }
     try:
-        get_table("bill_and_units_purchases").insert(data).execute()
+        resp = get_table("bill_and_units_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "bill_and_units_purchases", bill_name, price, data["number"], data["created_at"], resp)
 
 def add_internet_purchase(user_id: int, provider_name: str, price: int, phone: str, speed: str = None, created_at: str = None):
     data = {
@@ -500,9 +510,10 @@ def add_internet_purchase(user_id: int, provider_name: str, price: int, phone: s
         "speed": speed
     }
     try:
-        get_table("internet_providers_purchases").insert(data).execute()
+        resp = get_table("internet_providers_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "internet_providers_purchases", provider_name, price, data["phone"], data["created_at"], resp)
 
 def add_cash_transfer_purchase(user_id: int, transfer_name: str, price: int, number: str, created_at: str = None):
     data = {
@@ -513,9 +524,10 @@ def add_cash_transfer_purchase(user_id: int, transfer_name: str, price: int, num
         "number": number
     }
     try:
-        get_table("cash_transfer_purchases").insert(data).execute()
+        resp = get_table("cash_transfer_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "cash_transfer_purchases", transfer_name, price, data["number"], data["created_at"], resp)
 
 def add_companies_transfer_purchase(user_id: int, company_name: str, price: int, beneficiary_number: str, created_at: str = None):
     data = {
@@ -526,9 +538,10 @@ def add_companies_transfer_purchase(user_id: int, company_name: str, price: int,
         "beneficiary_number": beneficiary_number
     }
     try:
-        get_table("companies_transfer_purchases").insert(data).execute()
+        resp = get_table("companies_transfer_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "companies_transfer_purchases", company_name, price, data["beneficiary_number"], data["created_at"], resp)
 
 def add_university_fees_purchase(user_id: int, university_name: str, price: int, university_id: str, created_at: str = None):
     data = {
@@ -539,11 +552,13 @@ def add_university_fees_purchase(user_id: int, university_name: str, price: int,
         "university_id": university_id
     }
     try:
-        get_table("university_fees_purchases").insert(data).execute()
+        resp = get_table("university_fees_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "university_fees_purchases", university_name, price, data["university_id"], data["created_at"], resp)
 
-def add_ads_purchase(user_id: int, ad_name: str, price: int, created_at: str = None):
+def add_ads_purchase(user_id: int, ad_name: str, price: int, created_at: str = None, channel_username: str = None):
+    # channel_username: يمرّره handlers/admin ولا يوجد له عمود في ads_purchases (يُتجاهل)
     data = {
         "user_id": user_id,
         "ad_name": ad_name,
@@ -551,9 +566,10 @@ def add_ads_purchase(user_id: int, ad_name: str, price: int, created_at: str = N
         "created_at": (created_at or datetime.utcnow().isoformat())
     }
     try:
-        get_table("ads_purchases").insert(data).execute()
+        resp = get_table("ads_purchases").insert(data).execute()
     except Exception:
-        pass
+        return
+    record_purchase(user_id, "ads_purchases", ad_name, price, None, data["created_at"], resp)
 
 
 # ===== واجهات الحجز (للاستخدام من الهاندلرز) =====